@@ -1,10 +1,13 @@
 import math
-import random
 from functools import partial
+import numpy as np
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
+from optirider import evaluation
+from optirider import exchange
 from optirider import setup
 from optirider import start_day as optisolver
+from optirider.budget import TimeBudget
 
 from optirider.constants import (
     MISS_PENALTY,
@@ -55,7 +58,12 @@ def solve_constrained_vrp(
 
     # Adds time as the metric which model will try to minimize.
     transit_callback_index = routing.RegisterTransitCallback(
-        partial(setup.gen_time_callback(tour_data), manager)
+        partial(
+            setup.gen_time_callback(
+                tour_data, setup.get_time_slot(tour_data, int(cur_time))
+            ),
+            manager,
+        )
     )
     # Set arc cost as time taken for travel.
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
@@ -103,7 +111,7 @@ def solve_constrained_vrp(
     search_parameters.first_solution_strategy = (
         routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
     )
-    search_parameters.time_limit.seconds = time_limit
+    search_parameters.time_limit.FromMilliseconds(math.ceil(time_limit * 1000))
 
     routing.CloseModelWithParameters(search_parameters)
 
@@ -150,16 +158,194 @@ def solve_constrained_vrp(
     return updated_tour, tour_timings, missed_point, start_time
 
 
+def plan_upcoming_tours(tours, data, vehicles, begin_at, extra_points, time_limit):
+    """Plans the upcoming tours (all tours but the first) of `vehicles` afresh,
+    along with extra_points.
+
+    :param begin_at: Time at which each vehicle may begin its upcoming tours.
+    :returns: The upcoming tours (in problem nodes) & timings of each of
+        `vehicles`, and the points which could not be planned.
+    """
+    points = [data["depot"]]
+    for vehicle_id in vehicles:
+        for tour in tours[vehicle_id][1:]:
+            points += [order_no for order_no in tour if order_no != data["depot"]]
+    points += extra_points
+
+    upcoming_tour_data = setup.extract_data(
+        data, points, vehicles, [begin_at[vehicle_id] for vehicle_id in vehicles]
+    )
+    upcoming_tour, upcoming_time, _ = optisolver.start_day(
+        upcoming_tour_data, [MISS_PENALTY] * len(points), time_limit
+    )
+
+    upcoming_tour = [
+        [[points[loc] for loc in tour] for tour in vehicle_tours]
+        for vehicle_tours in upcoming_tour
+    ]
+    planned = evaluation.flatten_plan(upcoming_tour).nodes
+    missed_points = [point for point in points[1:] if point not in planned]
+    return upcoming_tour, upcoming_time, missed_points
+
+
+def get_infeasible_vehicles(tours, timings, data):
+    """Vehicles whose upcoming tours break the hard constraints."""
+    plan = evaluation.flatten_plan(
+        [vehicle_tours[1:] for vehicle_tours in tours],
+        [vehicle_timings[1:] for vehicle_timings in timings],
+    )
+    tour_ids = [
+        tour_id
+        for violations in evaluation.check_plan(plan, data).values()
+        for tour_id in violations
+    ]
+    return set(plan.tour_riders()[tour_ids].tolist())
+
+
+def get_nearest_vehicles(tours, points, begin_at, data, time_matrix):
+    """Vehicles whose upcoming tours pass nearest to each of the points.
+
+    Every vehicle passes by the depot, ties go to the vehicle free first.
+    """
+    if len(points) == 0:
+        return set()
+    vehicles = sorted(range(len(tours)), key=lambda vehicle_id: begin_at[vehicle_id])
+    distances = []
+    for vehicle_id in vehicles:
+        stops = [data["depot"]]
+        for tour in tours[vehicle_id][1:]:
+            stops += tour
+        distances.append(time_matrix[np.ix_(stops, points)].min(axis=0))
+    return {vehicles[idx] for idx in np.argmin(distances, axis=0).tolist()}
+
+
+def get_remaining_stops(tours, data, vehicle_id):
+    """Stops left in the current tour of the vehicle, from the one it is heading
+    to, ending at the depot."""
+    stops = []
+    if data["tour_location"][vehicle_id] != -1:
+        stops = [
+            order_no
+            for order_no in tours[vehicle_id][0][data["tour_location"][vehicle_id] :]
+            if order_no > 0
+        ]
+    # Riders at (or heading to) the depot make a round trip.
+    if len(stops) == 0:
+        stops = [data["depot"]]
+    return stops + [data["depot"]]
+
+
+def insertion_lower_bounds(stops, points, time_matrix):
+    """Least travel time each of the points adds to a path over the stops (from
+    the first one to the last one), whatever their order.
+
+    A point is visited between two of the stops, and (given the triangle
+    inequality) adds at least its detour between them.
+    """
+    before = np.asarray(stops[:-1])
+    after = np.asarray(stops[1:])
+    detours = (
+        time_matrix[np.ix_(before, points)][:, None, :]
+        + time_matrix[np.ix_(points, after)].T[None, :, :]
+        - time_matrix[np.ix_(before, after)][:, :, None]
+    )
+    # A stop is not followed by itself.
+    same_stop = np.arange(len(before))[:, None] == np.arange(1, len(stops))[None, :]
+    return np.where(same_stop[:, :, None], np.inf, detours).min(axis=(0, 1))
+
+
+class RiderShortlist:
+    """Riders each pickup is offered to: the `size` riders (all, if None) whose
+    current tours it adds the least travel time to, at best.
+
+    Riders are tried once each, nearest first, so their current tours are only
+    looked at once per request.
+    """
+
+    def __init__(self, tours, data, time_matrix, pickup_points, size=None):
+        self.columns = {point: idx for idx, point in enumerate(pickup_points)}
+        # Lower bounds, riders x pickups.
+        self.bounds = np.array(
+            [
+                insertion_lower_bounds(
+                    get_remaining_stops(tours, data, vehicle_id),
+                    pickup_points,
+                    time_matrix,
+                )
+                for vehicle_id in range(len(tours))
+            ]
+        )
+        nearest = np.argsort(self.bounds, axis=0, kind="stable")[:size]
+        self.riders = {
+            point: set(nearest[:, idx].tolist()) for point, idx in self.columns.items()
+        }
+        self.tried = set()
+
+    def remaining_riders(self, points):
+        """Riders not tried yet, which any of the points is offered to."""
+        return set().union(*[self.riders[point] for point in points]) - self.tried
+
+    def next_rider(self, points):
+        """Takes the rider not tried yet nearest to any of the points.
+
+        :returns: The rider (None if there is none left), and the points
+            offered to it.
+        """
+        candidates = [
+            (self.bounds[vehicle_id, self.columns[point]], vehicle_id)
+            for point in points
+            for vehicle_id in self.riders[point] - self.tried
+        ]
+        if len(candidates) == 0:
+            return None, []
+        _, vehicle_id = min(candidates)
+        self.tried.add(vehicle_id)
+        offered = [point for point in points if vehicle_id in self.riders[point]]
+        return vehicle_id, offered
+
+
 # Bug: Initial tour may be empty. (Handled)
 # Run time issues: This function may take much time to run.
 
 
-def add_pickup(tours, timings, data):
+def add_pickup(
+    tours,
+    timings,
+    data,
+    budget=None,
+    upcoming_share=0.5,
+    shortlist_size=None,
+    exchange_time_limit=0,
+    **exchange_options,
+):
+    """Inserts the pickups into the current tours, then fits whatever could
+    not be inserted into the upcoming tours.
+
+    Each pickup is only offered to the `shortlist_size` riders whose current
+    tours pass nearest to it (see `RiderShortlist`). Stops then move between
+    the current tours (see `exchange.ExchangeSearch`), for
+    `exchange_time_limit` seconds at most.
+
+    Upcoming tours are kept as they are, only pushed back after the current
+    tours. Only the vehicles whose upcoming tours become infeasible, or which
+    pass nearest to the points left over, have their upcoming tours planned
+    again (all vehicles, if those cannot take all the points).
+
+    :param budget: `TimeBudget` of the request, if it has a deadline. The
+        upcoming tours re-solve keeps `upcoming_share` of it, the riders tried
+        for insertion share the rest, and riders are no longer tried once the
+        time left for them is too short.
+    """
+    if budget is None:
+        budget = TimeBudget(math.inf)
 
     if "cur_time" not in data.keys():
         data["cur_time"] = GLOBAL_END_TIME
 
     num_vehicles = len(tours)
+    # Looked up as a whole by the shortlist & the nearest vehicles (an ndarray
+    # already when the matrix was set by the request).
+    time_matrix = np.asarray(data["time_matrix"])
 
     pickup_points = data["pickup_indices"]
 
@@ -170,14 +356,9 @@ def add_pickup(tours, timings, data):
         (cur_day_delivery_penalty - 1) / len(pickup_points)
     )
 
-    # All delivery points except depot
-    further_points = []
+    # Points which could not be inserted into the current tours.
+    spilled_points = []
     for vehicles in range(num_vehicles):
-        for tour_no in range(1, len(tours[vehicles])):
-            for order_no in tours[vehicles][tour_no]:
-                if order_no != data["depot"]:
-                    further_points.append(order_no)
-
         for current_order in tours[vehicles][0]:
             if current_order != data["depot"]:
                 data["penalty"][current_order] = cur_day_delivery_penalty
@@ -194,14 +375,18 @@ def add_pickup(tours, timings, data):
                 timings[vehicle_id][0][-1] + WAIT_TIME_AT_WAREHOUSE
             )
 
-    vehicle_list_random = [_ for _ in range(num_vehicles)]
-    random.shuffle(vehicle_list_random)
+    shortlist = RiderShortlist(tours, data, time_matrix, pickup_points, shortlist_size)
 
     current_tour = [[tours[vehicle][0]] for vehicle in range(num_vehicles)]
     current_timings = [[timings[vehicle][0]] for vehicle in range(num_vehicles)]
 
-    for cnt_vehicle, vehicle_id in enumerate(vehicle_list_random):
-        if len(pickup_points) == 0:
+    upcoming_reserve = min(upcoming_tour_runtime, budget.remaining() * upcoming_share)
+
+    while len(pickup_points) > 0:
+        rem_vehicles = len(shortlist.remaining_riders(pickup_points))
+        vehicle_id, offered_points = shortlist.next_rider(pickup_points)
+        # Pickups no rider took go to the upcoming tours.
+        if vehicle_id is None:
             break
 
         tour_idx = []
@@ -231,7 +416,7 @@ def add_pickup(tours, timings, data):
         tour_idx.append(0)
         end_idx = len(tour_idx) - 1
 
-        for points in pickup_points:
+        for points in offered_points:
             tour_idx.append(points)
 
         # Run vrp for points in tour_idx starting at tour_idx[0] and ending at tour_idx[len(tour_idx)-2]
@@ -245,15 +430,29 @@ def add_pickup(tours, timings, data):
             tour_data["start"] = [0]
         tour_data["end"] = [end_idx]
 
-        rem_vehicles = num_vehicles - cnt_vehicle
-        rem_pickups = len(pickup_points)
+        rem_pickups = len(offered_points)
 
         expected_pickup_per_rider = math.ceil(rem_vehicles/rem_pickups)
         tour_data['route_length'] = len(initial_tour) + 1 + expected_pickup_per_rider + 2
 
-        (updated_tour, tour_timings, missed_point, start_time,) = solve_constrained_vrp(
-            tour_data, initial_tour, start_time, cur_time, cur_free_space
+        # Riders left share the time left before the upcoming tours.
+        result = budget.run(
+            partial(
+                solve_constrained_vrp,
+                tour_data,
+                initial_tour,
+                start_time,
+                cur_time,
+                cur_free_space,
+            ),
+            single_vehicle_vrp_default_runtime,
+            share=1 / rem_vehicles,
+            reserve=upcoming_reserve,
         )
+        # Pickups not inserted by now go to the upcoming tours.
+        if result is None:
+            break
+        updated_tour, tour_timings, missed_point, start_time = result
 
         begin_next_journey_at[vehicle_id] = start_time + WAIT_TIME_AT_WAREHOUSE
 
@@ -268,47 +467,78 @@ def add_pickup(tours, timings, data):
             current_tour[vehicle_id][0].append(tour_idx[loc])
             current_timings[vehicle_id][0].append(tour_timings[loc_id])
 
-        pickup_points = []
+        pickup_points = [
+            point for point in pickup_points if point not in offered_points
+        ]
         for point in missed_point:
             order_id = tour_idx[point]
             if data["package_volume"][order_id] > 0:  # Delivery order
-                further_points.append(order_id)
+                spilled_points.append(order_id)
             else:  # Pickup order
                 pickup_points.append(order_id)
 
     # Make penalty of pickup equal to cur_day_delivery penalty for upcoming penalty.
     for points in pickup_points:
-        further_points.append(points)
+        spilled_points.append(points)
         data["penalty"][points] = cur_day_delivery_penalty
 
-    further_points.insert(0, 0)
+    total_tour = []
+    total_timings = []
+    for vehicle_id in range(num_vehicles):
+        total_tour.append(current_tour[vehicle_id] + tours[vehicle_id][1:])
+        total_timings.append(current_timings[vehicle_id] + timings[vehicle_id][1:])
+        evaluation.propagate_trip_starts(total_timings[vehicle_id])
 
-    upcoming_tour_data = setup.extract_data(
-        data,
-        further_points,
-        [vehicle_id for vehicle_id in range(num_vehicles)],
-        begin_next_journey_at,
+    replan_vehicles = get_infeasible_vehicles(total_tour, total_timings, data)
+    replan_vehicles |= get_nearest_vehicles(
+        total_tour, spilled_points, begin_next_journey_at, data, time_matrix
     )
+    if len(replan_vehicles) > 0:
+        replan_vehicles = sorted(replan_vehicles)
+        # The upcoming tours must be planned, even past the deadline.
+        upcoming_tour, upcoming_time, missed_points = budget.run(
+            partial(
+                plan_upcoming_tours,
+                total_tour,
+                data,
+                replan_vehicles,
+                begin_next_journey_at,
+                spilled_points,
+            ),
+            upcoming_tour_runtime,
+            required=True,
+        )
+        if len(missed_points) > 0 and len(replan_vehicles) < num_vehicles:
+            replan_vehicles = [vehicle_id for vehicle_id in range(num_vehicles)]
+            upcoming_tour, upcoming_time, missed_points = budget.run(
+                partial(
+                    plan_upcoming_tours,
+                    total_tour,
+                    data,
+                    replan_vehicles,
+                    begin_next_journey_at,
+                    spilled_points,
+                ),
+                upcoming_tour_runtime,
+                required=True,
+            )
+        for idx, vehicle_id in enumerate(replan_vehicles):
+            total_tour[vehicle_id] = total_tour[vehicle_id][:1] + upcoming_tour[idx]
+            total_timings[vehicle_id] = (
+                total_timings[vehicle_id][:1] + upcoming_time[idx]
+            )
 
-    # Update the time for which algo will run and see if guided local search is required or not.
-    # Integrate miss penalty into data only.
-    upcoming_tour, upcoming_time, upcoming_penalty = optisolver.start_day(
-        upcoming_tour_data, [MISS_PENALTY] * upcoming_tour_data["num_locations"], upcoming_tour_runtime
-    )
+    # Current tours were solved one rider at a time.
+    exchange_time_limit = min(exchange_time_limit, budget.remaining())
+    if exchange_time_limit > 0:
+        exchange.improve_current_tours(
+            total_tour, total_timings, data, exchange_time_limit, **exchange_options
+        )
 
-    total_tour = [element for element in current_tour]
-    total_timings = [element for element in current_timings]
     for vehicle in range(num_vehicles):
         if len(total_tour[vehicle][0]) == 0:
             total_tour[vehicle].pop(0)
             total_timings[vehicle].pop(0)
-        for trip_idx in range(len(upcoming_tour[vehicle])):
-            total_tour[vehicle].append(
-                [further_points[loc] for loc in upcoming_tour[vehicle][trip_idx]]
-            )
-            total_timings[vehicle].append(
-                [time for time in upcoming_time[vehicle][trip_idx]]
-            )
 
     return total_tour, total_timings
 
@@ -50,7 +50,12 @@ def solve_constrained_vrp(
 
     # Adds time as the metric which model will try to minimize.
     transit_callback_index = routing.RegisterTransitCallback(
-        partial(setup.gen_time_callback(tour_data), manager)
+        partial(
+            setup.gen_time_callback(
+                tour_data, setup.get_time_slot(tour_data, int(cur_time))
+            ),
+            manager,
+        )
     )
     # Set arc cost as time taken for travel.
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
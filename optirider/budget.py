@@ -0,0 +1,49 @@
+import time
+
+
+class TimeBudget:
+    """Wall clock time a request may take, shared out between its solves.
+
+    Each solve asks for the time limit it would run with on its own, and runs
+    with less when the deadline does not leave enough. The budget is
+    `truncated` once a solve is cut short by the deadline, or is not run at
+    all for lack of time.
+
+    :param seconds: Time from now to the deadline.
+    :param min_solve_time: Time limit under which a solve is not worth
+        starting, as it could not find a first solution.
+    """
+
+    def __init__(self, seconds, min_solve_time=0.0):
+        self.deadline = time.monotonic() + seconds
+        self.min_solve_time = min_solve_time
+        self.truncated = False
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+    def run(self, solve, wanted, share=1.0, reserve=0.0, required=False):
+        """Calls `solve(time_limit)` with the time limit allotted to it.
+
+        :param wanted: Time limit (seconds) the solve asks for.
+        :param share: Share of the remaining time the solve may take at most.
+        :param reserve: Time kept for the solves after this one.
+        :param required: Run the solve (with min_solve_time) even when the
+            deadline leaves less time than that.
+        :returns: What the solve returns, or None if it was not run.
+        """
+        available = max(0.0, (self.remaining() - reserve) * share)
+        if available >= wanted:
+            return solve(wanted)
+        if available < self.min_solve_time:
+            self.truncated = True
+            if not required:
+                return None
+            available = self.min_solve_time
+
+        started_at = time.monotonic()
+        result = solve(available)
+        # Searches stop early when no better solution is to be found.
+        if time.monotonic() - started_at >= available:
+            self.truncated = True
+        return result
@@ -24,3 +24,4 @@ MIN_MISS_PENALTY = 43200
 
 CAPACITY_DIMENSION_NAME = "Free Space"
 TIME_DIMENSION_NAME = "Time"
+TRIP_TIME_DIMENSION_NAME = "Trip Time"
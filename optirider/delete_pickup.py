@@ -1,3 +1,4 @@
+from optirider import evaluation
 from optirider import setup
 from optirider import start_day
 from optirider.constants import WAIT_TIME_AT_WAREHOUSE, GLOBAL_END_TIME, MISS_PENALTY
@@ -28,7 +29,7 @@ def delete_pickup(tours, timings, data):
                 prev = tours[vehicle_id][0][idx - 1]
                 next = tours[vehicle_id][0][idx + 1]
 
-                time_saved = (
+                time_saved = int(
                     data["time_matrix"][prev][loc]
                     + data["time_matrix"][loc][next]
                     + data["service_time"][loc]
@@ -42,12 +43,14 @@ def delete_pickup(tours, timings, data):
                 break
 
         if changed_tour != -1:
-            for idx in range(changed_tour, len(tours[vehicle_id][0])):
-                timings[vehicle_id][0][idx] -= time_saved
+            timings[vehicle_id][0][changed_tour:] = evaluation.shift_times(
+                timings[vehicle_id][0][changed_tour:], -time_saved
+            )
 
             for tour_id in range(1, len(tours[vehicle_id])):
-                for loc in range(len(tours[vehicle_id][tour_id])):
-                    timings[vehicle_id][tour_id][loc] -= time_saved
+                timings[vehicle_id][tour_id] = evaluation.shift_times(
+                    timings[vehicle_id][tour_id], -time_saved
+                )
 
             changed_tour = vehicle_id
             break
@@ -0,0 +1,255 @@
+import numpy as np
+
+from optirider.constants import (
+    LATE_DELIVERY_PENALTY_PER_SEC,
+    MAX_TRIP_TIME,
+    GLOBAL_END_TIME,
+    MISS_PENALTY,
+    WAIT_TIME_AT_WAREHOUSE,
+)
+
+# Evaluates plans (tours & timings of all riders) with NumPy, rather than
+# walking the tours stop by stop. All tours of all riders are laid out one
+# after the other in flat arrays, with offsets marking where tours & riders
+# begin. Pass the time matrix as a NumPy array, converting a nested list costs
+# more than evaluating the plan.
+
+
+class FlatPlan:
+    """Tours (and timings) of all riders, as flat arrays.
+
+    :ivar nodes: Nodes visited, tour after tour, rider after rider.
+    :ivar times: Time at which each of the nodes is reached (or None).
+    :ivar tour_offsets: Tour t visits nodes[tour_offsets[t]:tour_offsets[t + 1]].
+    :ivar rider_offsets: Rider r does tours rider_offsets[r]:rider_offsets[r + 1].
+    """
+
+    def __init__(self, nodes, tour_offsets, rider_offsets, times=None):
+        self.nodes = nodes
+        self.tour_offsets = tour_offsets
+        self.rider_offsets = rider_offsets
+        self.times = times
+
+    @property
+    def num_riders(self):
+        return len(self.rider_offsets) - 1
+
+    @property
+    def num_tours(self):
+        return len(self.tour_offsets) - 1
+
+    def tour_lengths(self):
+        return np.diff(self.tour_offsets)
+
+    def tour_ids(self):
+        """Tour of each stop."""
+        return np.repeat(np.arange(self.num_tours), self.tour_lengths())
+
+    def tour_riders(self):
+        """Rider of each tour."""
+        return np.repeat(np.arange(self.num_riders), np.diff(self.rider_offsets))
+
+    def tour_starts(self):
+        """Positions of the first stops of all non empty tours."""
+        lengths = self.tour_lengths()
+        return self.tour_offsets[:-1][lengths > 0]
+
+    def tour_ends(self):
+        """Positions of the last stops of all non empty tours."""
+        lengths = self.tour_lengths()
+        return self.tour_offsets[1:][lengths > 0] - 1
+
+    def arc_mask(self):
+        """Whether stop i and stop i + 1 are in the same tour, ie. an arc."""
+        mask = np.ones(max(0, len(self.nodes) - 1), dtype=bool)
+        starts = self.tour_starts()
+        mask[starts[starts > 0] - 1] = False
+        return mask
+
+    def to_lists(self):
+        """Converts back to the nested tours & timings lists."""
+        nodes = self.nodes.tolist()
+        times = self.times.tolist() if self.times is not None else None
+        offsets = self.tour_offsets.tolist()
+        tours = []
+        timings = []
+        for rider_id in range(self.num_riders):
+            tours.append([])
+            timings.append([])
+            for tour_id in range(
+                self.rider_offsets[rider_id], self.rider_offsets[rider_id + 1]
+            ):
+                begin, end = offsets[tour_id], offsets[tour_id + 1]
+                tours[-1].append(nodes[begin:end])
+                if times is not None:
+                    timings[-1].append(times[begin:end])
+        return tours, timings
+
+
+def flatten_plan(tours, timings=None):
+    """Lays out nested tours (& timings), as used by the solver, flat."""
+    tour_lengths = []
+    rider_tour_counts = []
+    nodes = []
+    times = []
+    for rider_id, rider_tours in enumerate(tours):
+        rider_tour_counts.append(len(rider_tours))
+        for tour_id, tour in enumerate(rider_tours):
+            tour_lengths.append(len(tour))
+            nodes.extend(tour)
+            if timings is not None:
+                times.extend(timings[rider_id][tour_id])
+
+    tour_offsets = np.zeros(len(tour_lengths) + 1, dtype=np.int64)
+    np.cumsum(tour_lengths, out=tour_offsets[1:])
+    rider_offsets = np.zeros(len(rider_tour_counts) + 1, dtype=np.int64)
+    np.cumsum(rider_tour_counts, out=rider_offsets[1:])
+    return FlatPlan(
+        np.array(nodes, dtype=np.int64),
+        tour_offsets,
+        rider_offsets,
+        np.array(times, dtype=np.int64) if timings is not None else None,
+    )
+
+
+def arc_travel_times(plan, time_matrix):
+    """Travel time from each stop to the next one (zero across tours)."""
+    if isinstance(time_matrix, np.ndarray):
+        travel = time_matrix[plan.nodes[:-1], plan.nodes[1:]]
+    else:
+        # Gather the arcs from list matrices rather than converting them whole.
+        travel = np.array(
+            [
+                time_matrix[origin][destination]
+                for origin, destination in zip(
+                    plan.nodes[:-1].tolist(), plan.nodes[1:].tolist()
+                )
+            ],
+            dtype=np.int64,
+        )
+    return np.where(plan.arc_mask(), travel, 0)
+
+
+def travel_cost(plan, time_matrix):
+    return int(arc_travel_times(plan, time_matrix).sum())
+
+
+def within_tour_cumsum(plan, values):
+    """Cumulative sum of `values`, restarting at the first stop of each tour."""
+    totals = np.cumsum(values)
+    starts = plan.tour_starts()
+    lengths = plan.tour_lengths()
+    restart = totals[starts] - values[starts]
+    return totals - np.repeat(restart, lengths[lengths > 0])
+
+
+def arrival_times(plan, time_matrix, service_time, tour_start_times):
+    """Time at which each stop is reached, when tour t begins at
+    tour_start_times[t] and there is no waiting."""
+    service_time = np.asarray(service_time)
+    steps = np.zeros(len(plan.nodes), dtype=np.int64)
+    steps[1:] = arc_travel_times(plan, time_matrix) + np.where(
+        plan.arc_mask(), service_time[plan.nodes[:-1]], 0
+    )
+    return (
+        within_tour_cumsum(plan, steps) + np.asarray(tour_start_times)[plan.tour_ids()]
+    )
+
+
+def lateness(plan, delivery_time, times=None, num_depots=1):
+    """Seconds each stop is reached after its delivery time (zero at depots)."""
+    if times is None:
+        times = plan.times
+    late = times - np.asarray(delivery_time)[plan.nodes]
+    return np.where(plan.nodes >= num_depots, np.maximum(late, 0), 0)
+
+
+def missed_orders(plan, num_locations, num_depots=1):
+    """Orders which are not visited by any tour."""
+    return np.setdiff1d(np.arange(num_depots, num_locations), plan.nodes)
+
+
+def tour_loads(plan, package_volume):
+    """Load carried after each stop, and the load at the start of each tour.
+
+    Deliveries (positive volume) are loaded at the depot & unloaded at their
+    stop, pickups (negative volume) are loaded at their stop.
+    """
+    volume = np.asarray(package_volume)[plan.nodes]
+    tour_ids = plan.tour_ids()
+    initial_load = np.bincount(
+        tour_ids, weights=np.maximum(volume, 0), minlength=plan.num_tours
+    ).astype(np.int64)
+    load = initial_load[tour_ids] - within_tour_cumsum(plan, volume)
+    return load, initial_load
+
+
+def plan_cost(plan, data):
+    """Travel time & late delivery penalty of a plan."""
+    late = lateness(plan, data["delivery_time"])
+    return (
+        travel_cost(plan, data["time_matrix"])
+        + int(late.sum()) * LATE_DELIVERY_PENALTY_PER_SEC
+    )
+
+
+def plan_penalty(plan, data):
+    """Objective of a plan, the same as `setup.get_penalty`: travel time, late
+    delivery penalty, and miss penalty for every order not delivered."""
+    # All points except depot is counted as missed (start & end are depots).
+    missed_points = data["num_locations"] - 1 - int((plan.tour_lengths() - 2).sum())
+    return plan_cost(plan, data) + missed_points * MISS_PENALTY
+
+
+def check_plan(plan, data):
+    """Finds the tours breaking the hard constraints of a plan.
+
+    :returns: A dictionary with the ids of the tours which overflow the bag,
+        take longer than MAX_TRIP_TIME, or end after GLOBAL_END_TIME.
+    """
+    non_empty = np.flatnonzero(plan.tour_lengths() > 0)
+    starts = plan.tour_starts()
+    ends = plan.tour_ends()
+    if len(non_empty) == 0:
+        return {"over_capacity": [], "over_trip_time": [], "after_end_time": []}
+
+    load, initial_load = tour_loads(plan, data["package_volume"])
+    peak_load = np.maximum(np.maximum.reduceat(load, starts), initial_load[non_empty])
+    capacity = np.asarray(data["vehicle_capacity"])[plan.tour_riders()[non_empty]]
+    trip_time = plan.times[ends] - plan.times[starts]
+    return {
+        "over_capacity": non_empty[peak_load > capacity].tolist(),
+        "over_trip_time": non_empty[trip_time > MAX_TRIP_TIME].tolist(),
+        "after_end_time": non_empty[plan.times[ends] > GLOBAL_END_TIME].tolist(),
+    }
+
+
+def timing_deltas(plan):
+    """Time from the previous stop of the tour, to each stop (the time itself
+    for the first stops)."""
+    deltas = plan.times.copy()
+    deltas[1:] -= plan.times[:-1]
+    starts = plan.tour_starts()
+    deltas[starts] = plan.times[starts]
+    return deltas
+
+
+def shift_times(times, delta):
+    """Shifts a list of timings by delta seconds."""
+    return (np.asarray(times, dtype=np.int64) + delta).tolist()
+
+
+def propagate_trip_starts(timings, first_trip=1):
+    """Pushes back the trips, from first_trip on, which would begin before the
+    previous trip is over (and the rider has waited at the warehouse).
+
+    Trips only move later, and propagation stops at the first trip which does
+    not move, as the trips after it do not move either.
+    """
+    for trip in range(max(first_trip, 1), len(timings)):
+        if len(timings[trip - 1]) == 0 or len(timings[trip]) == 0:
+            continue
+        delay = timings[trip - 1][-1] + WAIT_TIME_AT_WAREHOUSE - timings[trip][0]
+        if delay <= 0:
+            break
+        timings[trip] = shift_times(timings[trip], delay)
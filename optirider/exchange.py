@@ -0,0 +1,437 @@
+import logging
+import time
+
+import numpy as np
+
+from optirider import evaluation, horizon
+from optirider.constants import (
+    GLOBAL_END_TIME,
+    LATE_DELIVERY_PENALTY_PER_SEC,
+    MAX_TRIP_TIME,
+    WAIT_TIME_AT_WAREHOUSE,
+)
+
+# Moves orders between the current tours of riders, which the single vehicle
+# solves never do. tours and timings are those of all riders, as in
+# add_multiple_pickup: the current tour first, then the upcoming tours. Each
+# current tour is locked up to the stop its rider is heading to
+# (data['tour_location']), and may only change after it.
+#
+# Moves are screened on the travel time they save, over all pairs of riders at
+# once with NumPy, and only the most promising ones are evaluated exactly
+# (lateness, bag capacity, trip time). Deliveries are in the bag of a rider once
+# it has left the depot, so they only move between riders which have not.
+# A current tour ending later pushes back the upcoming tours of its rider, the
+# lateness this adds counts in the cost of the move.
+#
+# The screens are computed a chunk of rows at a time (of `chunk_size` moves at
+# most), so that a step stops at the deadline, and its memory stays bounded.
+# Plans with more than `max_screen_size` moves to screen per step are left as
+# they are, as no step would end in time.
+
+logger = logging.getLogger(__name__)
+
+RELOCATE = "relocate"
+CROSS_EXCHANGE = "cross_exchange"
+TWO_OPT_STAR = "two_opt_star"
+
+
+class Route:
+    """Current tour of a rider: the locked stops (up to the stop it is heading
+    to, or the depot it starts at), the stops after them, and the depot."""
+
+    def __init__(self, vehicle_id, tour, tour_timings, heading_index):
+        self.vehicle_id = vehicle_id
+        self.prefix = tour[: heading_index + 1]
+        self.prefix_timings = tour_timings[: heading_index + 1]
+        self.stops = tour[heading_index + 1 : -1]
+        self.end = tour[-1]
+        self.departed = heading_index > 0
+
+    def sequence(self, stops=None):
+        """Nodes from the stop the rider is heading to, to the depot."""
+        stops = self.stops if stops is None else stops
+        return [self.prefix[-1]] + stops + [self.end]
+
+
+class RouteLayout:
+    """Sequences of all routes laid out flat, to screen moves on.
+
+    :ivar nodes: Nodes of the sequences, one route after the other.
+    :ivar route_ids: Route of each of the nodes.
+    :ivar positions: Position of each of the nodes in its sequence.
+    """
+
+    def __init__(self, routes, package_volume):
+        sequences = [route.sequence() for route in routes]
+        lengths = np.array([len(sequence) for sequence in sequences])
+        self.offsets = np.concatenate(([0], np.cumsum(lengths)))
+        self.nodes = np.concatenate(sequences)
+        self.route_ids = np.repeat(np.arange(len(routes)), lengths)
+        self.positions = np.arange(len(self.nodes)) - self.offsets[self.route_ids]
+        # Deliveries among the first i nodes.
+        self.deliveries = np.concatenate(
+            ([0], np.cumsum(package_volume[self.nodes] > 0))
+        )
+        self.route_ends = self.offsets[1:][self.route_ids] - 1
+
+    def arcs(self):
+        """Flat indices of the nodes which begin an arc."""
+        return np.flatnonzero(np.arange(len(self.nodes)) < self.route_ends)
+
+    def segments(self, length):
+        """Flat indices of the first nodes of the segments of free stops of
+        `length` stops."""
+        first = np.arange(len(self.nodes))
+        return first[(self.positions > 0) & (first + length <= self.route_ends)]
+
+    def has_delivery(self, begin, end):
+        return self.deliveries[end] > self.deliveries[begin]
+
+
+class ExchangeSearch:
+    """Inter-route local search over the current tours of the riders."""
+
+    def __init__(
+        self,
+        tours,
+        timings,
+        data,
+        max_segment_length=2,
+        candidates=32,
+        chunk_size=2**16,
+        max_screen_size=None,
+    ):
+        self.tours = tours
+        self.timings = timings
+        self.data = data
+        self.max_segment_length = max_segment_length
+        self.candidates = candidates
+        self.chunk_size = chunk_size
+        self.max_screen_size = max_screen_size
+        self.time_matrix = np.asarray(data["time_matrix"])
+        self.service_time = np.asarray(data["service_time"])
+        self.package_volume = np.asarray(data["package_volume"])
+        self.delivery_time = np.asarray(data["delivery_time"])
+
+        self.routes = []
+        self.latest_end = []
+        self.min_room = []
+        for vehicle_id, heading_index in enumerate(data["tour_location"]):
+            tour = tours[vehicle_id][0]
+            # Riders on their way back to the depot have nothing to move.
+            if len(tour) == 0 or heading_index >= len(tour) - 1:
+                continue
+            # Riders without a current tour before the request begin it now.
+            route = Route(
+                vehicle_id, tour, timings[vehicle_id][0], max(heading_index, 0)
+            )
+            self.routes.append(route)
+            # Routes already past their limits may get no worse.
+            tour_timings = timings[vehicle_id][0]
+            latest_end = min(GLOBAL_END_TIME, tour_timings[0] + MAX_TRIP_TIME)
+            self.latest_end.append(max(latest_end, tour_timings[-1]))
+            capacity = data["vehicle_capacity"][vehicle_id]
+            self.min_room.append(min(0, horizon.trip_room(tour, capacity, data)))
+        # Routes whose stops were moved.
+        self.changed = set()
+        self.costs = [
+            self.evaluate(route_id, route.stops)[0]
+            for route_id, route in enumerate(self.routes)
+        ]
+
+    def evaluate(self, route_id, stops):
+        """Cost of the route over the given stops (travel time & lateness
+        penalty, from the stop its rider is heading to), whether it is
+        feasible, and the times the stops & the depot are reached at."""
+        route = self.routes[route_id]
+        nodes = np.asarray(route.sequence(stops))
+        travel = self.time_matrix[nodes[:-1], nodes[1:]]
+        times = route.prefix_timings[-1] + np.cumsum(
+            self.service_time[nodes[:-1]] + travel
+        )
+        late = np.maximum(times[:-1] - self.delivery_time[nodes[1:-1]], 0).sum()
+        cost = int(travel.sum()) + int(late) * LATE_DELIVERY_PENALTY_PER_SEC
+
+        room = horizon.trip_room(
+            route.prefix + stops + [route.end],
+            self.data["vehicle_capacity"][route.vehicle_id],
+            self.data,
+        )
+        feasible = (
+            times[-1] <= self.latest_end[route_id] and room >= self.min_room[route_id]
+        )
+        if feasible:
+            delay_cost, feasible = self.delay_upcoming(route.vehicle_id, times[-1])
+            cost += delay_cost
+        return cost, feasible, times
+
+    def delay_upcoming(self, vehicle_id, end):
+        """Lateness penalty added to the upcoming tours of the rider, pushed
+        back by its current tour ending at `end`, and whether they still end
+        before GLOBAL_END_TIME."""
+        cost = 0
+        for tour, tour_timings in zip(
+            self.tours[vehicle_id][1:], self.timings[vehicle_id][1:]
+        ):
+            delay = end + WAIT_TIME_AT_WAREHOUSE - tour_timings[0]
+            if delay <= 0:
+                break
+            plan = evaluation.flatten_plan([[tour]], [[tour_timings]])
+            added_lateness = evaluation.lateness(
+                plan, self.delivery_time, plan.times + delay
+            ) - evaluation.lateness(plan, self.delivery_time)
+            cost += int(added_lateness.sum()) * LATE_DELIVERY_PENALTY_PER_SEC
+            end = tour_timings[-1] + delay
+            if end > GLOBAL_END_TIME:
+                return cost, False
+        return cost, True
+
+    def allowed(self, has_delivery, from_routes, to_routes):
+        """Whether stops may move between the routes."""
+        departed = np.array([route.departed for route in self.routes])
+        return ~has_delivery | (~departed[from_routes] & ~departed[to_routes])
+
+    def screen_size(self, layout):
+        """Number of moves the screens of a step go over."""
+        num_stops = len(layout.segments(1))
+        num_arcs = len(layout.arcs())
+        num_segments = sum(
+            len(layout.segments(length))
+            for length in range(1, self.max_segment_length + 1)
+        )
+        return num_stops * num_arcs + num_segments**2 + num_arcs**2
+
+    def row_chunks(self, num_rows, num_columns):
+        """Slices of the rows of a screen, of `chunk_size` moves at most."""
+        step = max(1, self.chunk_size // max(num_columns, 1))
+        for begin in range(0, num_rows, step):
+            yield slice(begin, begin + step)
+
+    def screen_relocate(self, layout):
+        """Travel time saved moving a stop to an arc of another route."""
+        nodes = layout.segments(1)
+        arcs = layout.arcs()
+        tm = self.time_matrix
+        arc_from, arc_to = layout.nodes[arcs], layout.nodes[arcs + 1]
+        arc_time = tm[arc_from, arc_to]
+        to_routes = layout.route_ids[arcs][None, :]
+        for rows in self.row_chunks(len(nodes), len(arcs)):
+            chunk = nodes[rows]
+            stop, before, after = (
+                layout.nodes[chunk],
+                layout.nodes[chunk - 1],
+                layout.nodes[chunk + 1],
+            )
+            removal = tm[before, stop] + tm[stop, after] - tm[before, after]
+            insertion = (
+                tm[np.ix_(arc_from, stop)].T
+                + tm[np.ix_(stop, arc_to)]
+                - arc_time[None, :]
+            )
+            from_routes = layout.route_ids[chunk][:, None]
+            valid = (from_routes != to_routes) & self.allowed(
+                layout.has_delivery(chunk, chunk + 1)[:, None], from_routes, to_routes
+            )
+            yield chunk, arcs, np.where(valid, insertion - removal[:, None], np.inf)
+
+    def screen_cross_exchange(self, layout):
+        """Travel time saved swapping segments of stops between two routes."""
+        first = np.concatenate(
+            [
+                layout.segments(length)
+                for length in range(1, self.max_segment_length + 1)
+            ]
+        )
+        lengths = np.concatenate(
+            [
+                np.full(len(layout.segments(length)), length)
+                for length in range(1, self.max_segment_length + 1)
+            ]
+        )
+        last = first + lengths - 1
+        tm = self.time_matrix
+        before, head = layout.nodes[first - 1], layout.nodes[first]
+        tail, after = layout.nodes[last], layout.nodes[last + 1]
+        old = tm[before, head] + tm[tail, after]
+        routes = layout.route_ids[first]
+        has_delivery = layout.has_delivery(first, last + 1)
+        for rows in self.row_chunks(len(first), len(first)):
+            # Segment i goes between the ends of segment j, and j between those
+            # of i.
+            new = (
+                tm[np.ix_(before[rows], head)]
+                + tm[np.ix_(tail[rows], after)]
+                + tm[np.ix_(before, head[rows])].T
+                + tm[np.ix_(tail, after[rows])].T
+            )
+            valid = (
+                (routes[rows, None] < routes[None, :])
+                & self.allowed(
+                    has_delivery[rows, None], routes[rows, None], routes[None, :]
+                )
+                & self.allowed(
+                    has_delivery[None, :], routes[None, :], routes[rows, None]
+                )
+            )
+            delta = new - old[rows, None] - old[None, :]
+            yield (
+                (first[rows], lengths[rows]),
+                (first, lengths),
+                np.where(valid, delta, np.inf),
+            )
+
+    def screen_two_opt_star(self, layout):
+        """Travel time saved swapping the ends of two routes, after an arc of
+        each."""
+        arcs = layout.arcs()
+        tm = self.time_matrix
+        arc_from, arc_to = layout.nodes[arcs], layout.nodes[arcs + 1]
+        routes = layout.route_ids[arcs]
+        # The stops after the arc, up to the depot.
+        has_delivery = layout.has_delivery(arcs + 1, layout.route_ends[arcs])
+        old = tm[arc_from, arc_to]
+        for rows in self.row_chunks(len(arcs), len(arcs)):
+            valid = (
+                (routes[rows, None] < routes[None, :])
+                & self.allowed(
+                    has_delivery[rows, None], routes[rows, None], routes[None, :]
+                )
+                & self.allowed(
+                    has_delivery[None, :], routes[None, :], routes[rows, None]
+                )
+            )
+            delta = (
+                tm[np.ix_(arc_from[rows], arc_to)]
+                + tm[np.ix_(arc_from, arc_to[rows])].T
+                - old[rows, None]
+                - old[None, :]
+            )
+            yield arcs[rows], arcs, np.where(valid, delta, np.inf)
+
+    def best_moves(self, kind, rows, columns, delta):
+        """The `candidates` moves of a screen saving the most travel time."""
+        moves = []
+        if delta.size == 0:
+            return moves
+        flat = delta.ravel()
+        best = np.argpartition(flat, min(self.candidates, flat.size - 1))
+        for idx in best[: self.candidates].tolist():
+            if flat[idx] == np.inf:
+                continue
+            row, column = divmod(idx, delta.shape[1])
+            if kind == CROSS_EXCHANGE:
+                first = (rows[0][row], rows[1][row])
+                second = (columns[0][column], columns[1][column])
+            else:
+                first, second = rows[row], columns[column]
+            moves.append((flat[idx], kind, first, second))
+        return moves
+
+    def apply(self, kind, layout, first, second):
+        """Stops of the two routes after the move.
+
+        :returns: The ids of the two routes, and their new stops.
+        """
+        if kind == CROSS_EXCHANGE:
+            (first, first_length), (second, second_length) = first, second
+        elif kind == RELOCATE:
+            first_length, second_length = 1, 0
+        else:
+            first_length = layout.route_ends[first] - first - 1
+            second_length = layout.route_ends[second] - second - 1
+            # Ends are swapped after the arcs.
+            first, second = first + 1, second + 1
+        if kind == RELOCATE:
+            # Inserted after the node beginning the arc.
+            second += 1
+
+        route_ids = layout.route_ids[first], layout.route_ids[second]
+        # Stops are the sequence without the stop heading to (position 0).
+        begin = layout.positions[first] - 1, layout.positions[second] - 1
+        stops = self.routes[route_ids[0]].stops, self.routes[route_ids[1]].stops
+        first_segment = stops[0][begin[0] : begin[0] + first_length]
+        second_segment = stops[1][begin[1] : begin[1] + second_length]
+        return route_ids, (
+            stops[0][: begin[0]] + second_segment + stops[0][begin[0] + first_length :],
+            stops[1][: begin[1]] + first_segment + stops[1][begin[1] + second_length :],
+        )
+
+    def step(self, deadline):
+        """Makes the first improving move among the most promising ones.
+
+        :returns: Whether a move was made.
+        """
+        layout = RouteLayout(self.routes, self.package_volume)
+        candidates = []
+        for kind, screen in (
+            (RELOCATE, self.screen_relocate),
+            (CROSS_EXCHANGE, self.screen_cross_exchange),
+            (TWO_OPT_STAR, self.screen_two_opt_star),
+        ):
+            moves = []
+            for rows, columns, delta in screen(layout):
+                if time.monotonic() >= deadline:
+                    return False
+                moves.extend(self.best_moves(kind, rows, columns, delta))
+            moves.sort(key=lambda move: move[0])
+            candidates.extend(moves[: self.candidates])
+
+        candidates.sort(key=lambda candidate: candidate[0])
+        for _, kind, first, second in candidates:
+            if time.monotonic() >= deadline:
+                return False
+            route_ids, new_stops = self.apply(kind, layout, first, second)
+            new_costs = []
+            for route_id, stops in zip(route_ids, new_stops):
+                cost, feasible, _ = self.evaluate(route_id, stops)
+                if not feasible:
+                    break
+                new_costs.append(cost)
+            else:
+                old_cost = sum(self.costs[route_id] for route_id in route_ids)
+                if sum(new_costs) < old_cost:
+                    for route_id, stops, cost in zip(route_ids, new_stops, new_costs):
+                        self.routes[route_id].stops = stops
+                        self.changed.add(route_id)
+                        self.costs[route_id] = cost
+                    return True
+        return False
+
+    def run(self, time_limit):
+        """Moves stops while that improves the plan, for time_limit seconds at
+        most, then updates the tours & timings.
+
+        :returns: Whether the plan was improved.
+        """
+        deadline = time.monotonic() + time_limit
+        improved = False
+        if len(self.routes) > 1 and self.max_screen_size is not None:
+            screen_size = self.screen_size(
+                RouteLayout(self.routes, self.package_volume)
+            )
+            if screen_size > self.max_screen_size:
+                logger.debug(f"Skipping the exchange search, over {screen_size} moves")
+                return False
+        while len(self.routes) > 1 and time.monotonic() < deadline:
+            if not self.step(deadline):
+                break
+            improved = True
+
+        # Timings of the other tours stay as they were given.
+        for route_id in sorted(self.changed):
+            route = self.routes[route_id]
+            _, _, times = self.evaluate(route_id, route.stops)
+            self.tours[route.vehicle_id][0] = route.prefix + route.stops + [route.end]
+            self.timings[route.vehicle_id][0] = route.prefix_timings + times.tolist()
+            evaluation.propagate_trip_starts(self.timings[route.vehicle_id])
+        return improved
+
+
+def improve_current_tours(tours, timings, data, time_limit, **kwargs):
+    """Improves the current tours of the riders in place, by moving stops
+    between them (see `ExchangeSearch`).
+
+    :returns: Whether the plan was improved.
+    """
+    return ExchangeSearch(tours, timings, data, **kwargs).run(time_limit)
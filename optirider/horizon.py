@@ -0,0 +1,186 @@
+import numpy as np
+
+from optirider import setup
+from optirider.constants import (
+    GLOBAL_END_TIME,
+    MAX_TRIP_TIME,
+    WAIT_TIME_AT_WAREHOUSE,
+)
+
+# Orders due beyond the planning horizon (eg. on later days) are left out of
+# the start day model, and only slotted into the room left in the plan once
+# it is made, by cheapest insertion. An insertion never makes another stop
+# later than it is due (nor later at all, if it is late already), nor pushes
+# the trips after it back. As in the model, an order is only taken when
+# serving it costs less travel time than its miss penalty.
+
+
+def trip_room(tour, capacity, data):
+    """Volume which the trip may still carry, all along."""
+    volume = np.asarray(data["package_volume"])[tour]
+    initial_load = volume[volume > 0].sum()
+    loads = initial_load - np.cumsum(volume)
+    return capacity - max(initial_load, loads.max(initial=0))
+
+
+def trip_begin_times(tours, timings, data):
+    """Time at which each rider may begin a trip after its last one."""
+    begin_at = []
+    for vehicle_id in range(data["num_vehicles"]):
+        if len(tours[vehicle_id]) == 0:
+            begin_at.append(data["start_time"][vehicle_id])
+        else:
+            begin_at.append(timings[vehicle_id][-1][-1] + WAIT_TIME_AT_WAREHOUSE)
+    return begin_at
+
+
+def has_room(tours, timings, data, volume):
+    """Whether a package of `volume` fits in any trip, or in a new trip of a
+    rider whose day is not over yet.
+
+    Only needs the volumes & timings of the plan, not its durations.
+    """
+    for vehicle_id, begin_at in enumerate(trip_begin_times(tours, timings, data)):
+        capacity = data["vehicle_capacity"][vehicle_id]
+        if begin_at < GLOBAL_END_TIME and volume <= capacity:
+            return True
+        for tour in tours[vehicle_id]:
+            if volume <= trip_room(tour, capacity, data):
+                return True
+    return False
+
+
+def trip_slack(tour, tour_timings, next_trip_start, data):
+    """Time by which the stops of the trip may get later, from each stop on.
+
+    Stops may not get later than they are due (late stops not at all), the
+    trip may not take longer than MAX_TRIP_TIME, nor end after GLOBAL_END_TIME
+    or after the next trip has to begin.
+    """
+    tour = np.asarray(tour)
+    times = np.asarray(tour_timings)
+    end_slack = min(GLOBAL_END_TIME - times[-1], MAX_TRIP_TIME - (times[-1] - times[0]))
+    if next_trip_start is not None:
+        end_slack = min(end_slack, next_trip_start - WAIT_TIME_AT_WAREHOUSE - times[-1])
+
+    slack = np.maximum(np.asarray(data["delivery_time"])[tour] - times, 0)
+    slack = np.where(np.isin(tour, setup.get_depots(data)), end_slack, slack)
+    slack[-1] = end_slack
+    # Delaying a stop delays all the stops after it.
+    return np.minimum.accumulate(slack[::-1])[::-1]
+
+
+def travel_times(data, slots, from_nodes, to_nodes):
+    """Durations of the arcs, on the time slot of each (if any)."""
+    if "time_tensor" in data:
+        return np.asarray(data["time_tensor"])[slots, from_nodes, to_nodes]
+    return np.asarray(data["time_matrix"])[from_nodes, to_nodes]
+
+
+class TripArcs:
+    """Arcs of a trip, which an order may be inserted on."""
+
+    def __init__(self, tour, tour_timings, next_trip_start, capacity, data):
+        slot = setup.get_time_slot(data, tour_timings[0])
+        self.before = np.asarray(tour[:-1])
+        self.after = np.asarray(tour[1:])
+        self.slots = np.full(len(self.before), slot or 0)
+        self.travel = travel_times(data, self.slots, self.before, self.after)
+        self.slack = trip_slack(tour, tour_timings, next_trip_start, data)[1:]
+        self.room = np.full(len(self.before), trip_room(tour, capacity, data))
+
+
+def fill_in(tours, timings, data, candidates):
+    """Slots the candidate orders into the room left in the plan, in place,
+    the orders due first first.
+
+    Each one goes on the arc where it adds the least travel time: in a trip,
+    or in a new trip after the last one of a rider.
+
+    :param tours: Trips of each rider, as problem nodes.
+    :param data: The problem, over all nodes (candidates included).
+    :returns: The candidates inserted.
+    """
+    depot = data["depot"]
+    service_time = np.asarray(data["service_time"])
+    # An empty trip after the last one of each rider, to begin new trips in.
+    for vehicle_id, begin_at in enumerate(trip_begin_times(tours, timings, data)):
+        tours[vehicle_id].append([depot, depot])
+        timings[vehicle_id].append([begin_at, begin_at])
+
+    def get_arcs(vehicle_id, trip):
+        next_trip_start = None
+        # The empty trip (the last one) begins whenever the one before is over.
+        if trip + 2 < len(tours[vehicle_id]):
+            next_trip_start = timings[vehicle_id][trip + 1][0]
+        return TripArcs(
+            tours[vehicle_id][trip],
+            timings[vehicle_id][trip],
+            next_trip_start,
+            data["vehicle_capacity"][vehicle_id],
+            data,
+        )
+
+    trip_arcs = {
+        (vehicle_id, trip): get_arcs(vehicle_id, trip)
+        for vehicle_id in range(data["num_vehicles"])
+        for trip in range(len(tours[vehicle_id]))
+    }
+    inserted = []
+    for node in sorted(candidates, key=lambda node: data["delivery_time"][node]):
+        keys = list(trip_arcs)
+        arcs = [trip_arcs[key] for key in keys]
+        before = np.concatenate([trip.before for trip in arcs])
+        after = np.concatenate([trip.after for trip in arcs])
+        slots = np.concatenate([trip.slots for trip in arcs])
+        added_time = (
+            travel_times(data, slots, before, node)
+            + service_time[node]
+            + travel_times(data, slots, node, after)
+            - np.concatenate([trip.travel for trip in arcs])
+        )
+        feasible = (added_time <= np.concatenate([trip.slack for trip in arcs])) & (
+            abs(data["package_volume"][node])
+            <= np.concatenate([trip.room for trip in arcs])
+        )
+        if not feasible.any():
+            continue
+        arc = int(np.argmin(np.where(feasible, added_time, np.iinfo(np.int64).max)))
+        if added_time[arc] >= data["penalty"][node]:
+            continue
+
+        trip_ends = np.cumsum([len(trip.before) for trip in arcs])
+        key_index = int(np.searchsorted(trip_ends, arc, side="right"))
+        vehicle_id, trip = keys[key_index]
+        position = arc - (trip_ends[key_index] - len(arcs[key_index].before)) + 1
+        tour = tours[vehicle_id][trip]
+        tour_timings = timings[vehicle_id][trip]
+        previous = tour[position - 1]
+        arrival = (
+            tour_timings[position - 1]
+            + int(service_time[previous])
+            + int(travel_times(data, slots[arc], previous, node))
+        )
+        # Later stops are delayed by the added time, at most.
+        tour.insert(position, node)
+        tour_timings[position:] = [arrival] + [
+            time + int(added_time[arc]) for time in tour_timings[position:]
+        ]
+        inserted.append(node)
+
+        if trip == len(tours[vehicle_id]) - 1:
+            # A new trip was begun, the rider gets another empty one after it.
+            tours[vehicle_id].append([depot, depot])
+            timings[vehicle_id].append([0, 0])
+            trip_arcs[vehicle_id, trip + 1] = None
+        # The empty trip after the last one begins once that one is over.
+        begin_at = timings[vehicle_id][-2][-1] + WAIT_TIME_AT_WAREHOUSE
+        timings[vehicle_id][-1] = [begin_at, begin_at]
+        for other_trip in (trip, len(tours[vehicle_id]) - 1):
+            trip_arcs[vehicle_id, other_trip] = get_arcs(vehicle_id, other_trip)
+
+    for vehicle_id in range(data["num_vehicles"]):
+        kept = [trip for trip, tour in enumerate(tours[vehicle_id]) if len(tour) > 2]
+        tours[vehicle_id] = [tours[vehicle_id][trip] for trip in kept]
+        timings[vehicle_id] = [timings[vehicle_id][trip] for trip in kept]
+    return inserted
@@ -0,0 +1,153 @@
+import random
+import time
+import numpy as np
+
+from optirider import evaluation
+from optirider import progress
+from optirider.add_multiple_pickup import plan_upcoming_tours
+from optirider.constants import WAIT_TIME_AT_WAREHOUSE
+
+# Improves a live plan by large neighbourhood search, while nothing else is
+# being solved. tours and timings are those of all riders, the current tour of
+# each rider first (empty if it has none), then its upcoming tours. The stops
+# each rider has reached (before data['tour_location']) are locked: the
+# current tour may only be re-ordered from the stop the rider is heading to,
+# and the upcoming tours of a few riders nearby are planned again together.
+
+
+def get_begin_times(tours, timings, data):
+    """Time at which each rider may begin its upcoming tours."""
+    begin_at = []
+    for vehicle_id in range(len(tours)):
+        if len(timings[vehicle_id][0]) == 0:
+            begin_at.append(data["cur_time"])
+        else:
+            begin_at.append(timings[vehicle_id][0][-1] + WAIT_TIME_AT_WAREHOUSE)
+    return begin_at
+
+
+def get_cost(tours, timings, data, vehicles, first_tour=0):
+    """Travel time & late delivery penalty of the tours of `vehicles`, from
+    their first_tour on."""
+    return evaluation.plan_cost(
+        evaluation.flatten_plan(
+            [tours[vehicle_id][first_tour:] for vehicle_id in vehicles],
+            [timings[vehicle_id][first_tour:] for vehicle_id in vehicles],
+        ),
+        data,
+    )
+
+
+def get_neighbourhood(tours, data, vehicle_id, size):
+    """The rider, and the size - 1 riders whose upcoming tours pass nearest to
+    its upcoming tours (by travel time between their stops)."""
+    time_matrix = np.asarray(data["time_matrix"])
+    stops = [data["depot"]]
+    for tour in tours[vehicle_id][1:]:
+        stops += tour
+
+    distances = []
+    for other_id in range(len(tours)):
+        other_stops = [data["depot"]]
+        for tour in tours[other_id][1:]:
+            other_stops += tour
+        distances.append(time_matrix[np.ix_(stops, other_stops)].min())
+    distances[vehicle_id] = -1
+    return sorted(np.argsort(distances, kind="stable")[:size].tolist())
+
+
+def resequence_move(tours, timings, data, vehicle_id):
+    """Re-orders the rest of the current tour of a rider, if that is cheaper.
+
+    :returns: Whether the plan was changed.
+    """
+    heading_index = data["tour_location"][vehicle_id]
+    # At least two stops (besides the depot at the end) to re-order.
+    if heading_index == -1 or len(tours[vehicle_id][0]) - heading_index < 3:
+        return False
+
+    resequenced = progress.resequence_current_tour(
+        tours[vehicle_id], timings[vehicle_id], heading_index, data, vehicle_id
+    )
+    if resequenced is None:
+        return False
+    cost = get_cost(tours, timings, data, [vehicle_id])
+    resequenced_cost = evaluation.plan_cost(
+        evaluation.flatten_plan([resequenced[0]], [resequenced[1]]), data
+    )
+    if resequenced_cost >= cost:
+        return False
+    tours[vehicle_id], timings[vehicle_id] = resequenced
+    return True
+
+
+def replan_move(tours, timings, data, vehicles, time_limit):
+    """Plans the upcoming tours of `vehicles` again together, if that is
+    cheaper and leaves no order out.
+
+    :returns: Whether the plan was changed.
+    """
+    upcoming_tour, upcoming_time, missed_points = plan_upcoming_tours(
+        tours, data, vehicles, get_begin_times(tours, timings, data), [], time_limit
+    )
+    if len(missed_points) > 0:
+        return False
+    cost = get_cost(tours, timings, data, vehicles, first_tour=1)
+    replanned_cost = evaluation.plan_cost(
+        evaluation.flatten_plan(upcoming_tour, upcoming_time), data
+    )
+    if replanned_cost >= cost:
+        return False
+    for idx, vehicle_id in enumerate(vehicles):
+        tours[vehicle_id] = tours[vehicle_id][:1] + upcoming_tour[idx]
+        timings[vehicle_id] = timings[vehicle_id][:1] + upcoming_time[idx]
+    return True
+
+
+def improve_plan(
+    tours,
+    timings,
+    data,
+    time_limit,
+    neighbourhood_size=3,
+    move_time_limit=1,
+    replan_all=False,
+    seed=None,
+):
+    """Improves the plan in place, for time_limit seconds at most.
+
+    Each move picks a rider at random, re-orders the rest of its current tour,
+    then plans the upcoming tours of its neighbourhood again.
+
+    :param replan_all: First plan the upcoming tours of all riders again.
+    :returns: Whether the plan was improved.
+    """
+    rng = random.Random(seed)
+    deadline = time.monotonic() + time_limit
+    improved = False
+
+    if replan_all:
+        improved |= replan_move(
+            tours, timings, data, list(range(len(tours))), time_limit
+        )
+
+    # Riders with stops they have not reached yet.
+    vehicles = [
+        vehicle_id
+        for vehicle_id in range(len(tours))
+        if len(tours[vehicle_id]) > 1
+        or len(tours[vehicle_id][0]) - data["tour_location"][vehicle_id] >= 3
+    ]
+    while len(vehicles) > 0 and time.monotonic() < deadline:
+        vehicle_id = rng.choice(vehicles)
+        improved |= resequence_move(tours, timings, data, vehicle_id)
+
+        neighbourhood = get_neighbourhood(
+            tours, data, vehicle_id, rng.randint(2, max(2, neighbourhood_size))
+        )
+        time_left = deadline - time.monotonic()
+        if time_left > 0:
+            improved |= replan_move(
+                tours, timings, data, neighbourhood, min(move_time_limit, time_left)
+            )
+    return improved
@@ -0,0 +1,199 @@
+import bisect
+import numpy as np
+from ortools.constraint_solver import pywrapcp
+
+from optirider import setup
+from optirider.constants import (
+    LATE_DELIVERY_PENALTY_PER_SEC,
+    MAX_TRIP_TIME,
+    TIME_DIMENSION_NAME,
+    CAPACITY_DIMENSION_NAME,
+    TRIP_TIME_DIMENSION_NAME,
+)
+
+
+class RoutingModelBuilder:
+    """Builds routing models over subsets of the nodes of a problem.
+
+    The per node arrays of the problem (durations, service times, volumes,
+    delivery times) are converted to NumPy once. A model over a subset of the
+    nodes then only gathers the rows & columns of that subset, and registers
+    them as OR-Tools transit matrices & vectors, so that no Python callback is
+    called during the search.
+
+    The nodes of a model are given as problem nodes, depots first (in the
+    order of the problem). A depot may also appear again after the depots, as
+    a copy of it where the rider reloads the bag & begins a new trip (see
+    `add_reloads`), so that several trips per rider fit in a single model.
+    """
+
+    def __init__(self, data):
+        self.num_vehicles = data["num_vehicles"]
+        self.depot = data["depot"]
+        self.num_depots = len(setup.get_depots(data))
+        self.starts = data.get("starts")
+        self.ends = data.get("ends")
+        self.neighbour_limit = data.get("neighbour_limit")
+
+        # Kept in the dtype they come in (eg. int32 when memory mapped), only
+        # the rows & columns of a model are converted.
+        self.time_matrix = np.asarray(data["time_matrix"])
+        self.time_tensor = None
+        self.time_slots = None
+        if "time_tensor" in data:
+            self.time_tensor = np.asarray(data["time_tensor"])
+            self.time_slots = data["time_slots"]
+        self.service_time = np.asarray(data["service_time"], dtype=np.int64)
+        self.package_volume = np.asarray(data["package_volume"], dtype=np.int64)
+        self.delivery_time = np.asarray(data["delivery_time"], dtype=np.int64)
+        self.vehicle_capacity = [int(capacity) for capacity in data["vehicle_capacity"]]
+
+    def get_time_slot(self, time):
+        if self.time_tensor is None:
+            return None
+        return max(0, bisect.bisect_right(self.time_slots, time) - 1)
+
+    def transit_matrix(self, nodes, slot=None, reload_service_time=0):
+        """Travel (and service) time between the nodes, on the durations of
+        time slot `slot` if given. Depot copies take reload_service_time."""
+        nodes = np.asarray(nodes, dtype=np.int64)
+        time_matrix = self.time_matrix if slot is None else self.time_tensor[slot]
+        is_reload = nodes < self.num_depots
+        is_reload[: self.num_depots] = False
+        service_time = np.where(
+            is_reload, reload_service_time, self.service_time[nodes]
+        )
+        return (
+            time_matrix[np.ix_(nodes, nodes)].astype(np.int64) + service_time[:, None]
+        )
+
+    def build(
+        self, nodes, start_time, drop_penalty, end_time=None, reload_service_time=0
+    ):
+        """Builds the routing model of a trip of every vehicle over `nodes`.
+
+        :param start_time: Time at which each vehicle starts its trip.
+        :param drop_penalty: Penalty of dropping each of the nodes (by position
+            in `nodes`), nodes with no penalty are optional.
+        :param end_time: Time by which each vehicle must be back, see
+            `setup.add_start_time_constraint`.
+        :param reload_service_time: Time spent at each visited depot copy.
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        if self.starts is not None:
+            manager = pywrapcp.RoutingIndexManager(
+                len(nodes), self.num_vehicles, self.starts, self.ends
+            )
+        else:
+            manager = pywrapcp.RoutingIndexManager(
+                len(nodes), self.num_vehicles, self.depot
+            )
+        routing = pywrapcp.RoutingModel(manager)
+
+        is_reload = nodes < self.num_depots
+        is_reload[: self.num_depots] = False
+        has_reloads = bool(is_reload.any())
+        max_capacity = max(self.vehicle_capacity, default=0)
+
+        # Bag capacity (hard constraint, should never be violated). At depot
+        # copies, the slack lets the free space take any value: the bag is
+        # emptied of pickups and refilled with the next trip's deliveries.
+        volume = np.where(is_reload, -max_capacity, self.package_volume[nodes])
+        volume_evaluator_index = routing.RegisterUnaryTransitVector(volume.tolist())
+        routing.AddDimensionWithVehicleCapacity(
+            volume_evaluator_index,
+            2 * max_capacity if has_reloads else 0,  # Cannot overflow the bag.
+            self.vehicle_capacity,
+            False,
+            CAPACITY_DIMENSION_NAME,
+        )
+
+        # Time, on the time slot each vehicle starts its trip in.
+        transit_callback_indices = []
+        slot_callback_index = {}
+        for vehicle_id in range(self.num_vehicles):
+            slot = self.get_time_slot(start_time[vehicle_id])
+            if slot not in slot_callback_index:
+                slot_callback_index[slot] = routing.RegisterTransitMatrix(
+                    self.transit_matrix(nodes, slot, reload_service_time).tolist()
+                )
+            transit_callback_indices.append(slot_callback_index[slot])
+            routing.SetArcCostEvaluatorOfVehicle(
+                transit_callback_indices[-1], vehicle_id
+            )
+        setup.add_start_time_constraint(
+            routing,
+            {"num_vehicles": self.num_vehicles, "start_time": start_time},
+            transit_callback_indices,
+            TIME_DIMENSION_NAME,
+            end_time,
+        )
+        if has_reloads:
+            self.add_reloads(routing, manager, nodes, is_reload, start_time)
+
+        # Late deliveries attract a penalty, dropped nodes a (larger) one.
+        time_dimension = routing.GetDimensionOrDie(TIME_DIMENSION_NAME)
+        delivery_time = self.delivery_time[nodes].tolist()
+        for location_idx in range(self.num_depots, len(nodes)):
+            index = manager.NodeToIndex(location_idx)
+            if not is_reload[location_idx]:
+                time_dimension.SetCumulVarSoftUpperBound(
+                    index, delivery_time[location_idx], LATE_DELIVERY_PENALTY_PER_SEC
+                )
+            routing.AddDisjunction([index], int(drop_penalty[location_idx]))
+
+        if self.neighbour_limit is not None:
+            setup.add_neighbour_pruning(
+                routing,
+                manager,
+                self.time_matrix[np.ix_(nodes, nodes)],
+                self.num_depots,
+                self.num_vehicles,
+                self.neighbour_limit,
+                reload_nodes=np.flatnonzero(is_reload).tolist(),
+            )
+
+        return manager, routing
+
+    def add_reloads(self, routing, manager, nodes, is_reload, start_time):
+        """Makes each visit to a depot copy end a trip and begin the next one.
+
+        The free space may only change at depot copies, and the time since
+        the trip began (limited to MAX_TRIP_TIME) restarts from zero there.
+        """
+        capacity_dimension = routing.GetDimensionOrDie(CAPACITY_DIMENSION_NAME)
+
+        # Trip time transits from a depot copy take MAX_TRIP_TIME off, and the
+        # slack there is whatever brings the trip time back to zero.
+        trip_callback_indices = []
+        slot_callback_index = {}
+        for vehicle_id in range(self.num_vehicles):
+            slot = self.get_time_slot(start_time[vehicle_id])
+            if slot not in slot_callback_index:
+                trip_matrix = self.transit_matrix(nodes, slot)
+                trip_matrix[is_reload] -= MAX_TRIP_TIME
+                slot_callback_index[slot] = routing.RegisterTransitMatrix(
+                    trip_matrix.tolist()
+                )
+            trip_callback_indices.append(slot_callback_index[slot])
+        routing.AddDimensionWithVehicleTransits(
+            trip_callback_indices,
+            MAX_TRIP_TIME,
+            MAX_TRIP_TIME,  # A trip cannot exceed MAX_TRIP_TIME.
+            True,  # Trips start from zero.
+            TRIP_TIME_DIMENSION_NAME,
+        )
+        trip_time_dimension = routing.GetDimensionOrDie(TRIP_TIME_DIMENSION_NAME)
+
+        solver = routing.solver()
+        is_reload = is_reload.tolist()
+        for index in range(routing.Size()):
+            if is_reload[manager.IndexToNode(index)]:
+                solver.Add(
+                    trip_time_dimension.SlackVar(index)
+                    + trip_time_dimension.CumulVar(index)
+                    == MAX_TRIP_TIME
+                )
+            else:
+                capacity_dimension.SlackVar(index).SetValue(0)
+                trip_time_dimension.SlackVar(index).SetValue(0)
@@ -0,0 +1,169 @@
+import logging
+
+from optirider import setup
+from optirider.constants import (
+    DEFAULT_TIME_LIMIT,
+    GLOBAL_END_TIME,
+    TIME_DIMENSION_NAME,
+    WAIT_TIME_AT_WAREHOUSE,
+)
+from optirider.model_builder import RoutingModelBuilder
+from optirider.start_day import get_expected_loops, get_search_parameters, start_day
+
+logger = logging.getLogger(__name__)
+
+# Plans the whole day of every rider in a single routing model, rather than
+# one trip at a time (see `start_day.start_day`). Each rider gets copies of
+# its depot to reload at, each visited copy ending a trip and beginning the
+# next one, so trips are planned jointly rather than greedily.
+#
+# Arcs of a routing model have a single transit time each, for the whole day,
+# while with time slots (data['time_tensor']) each trip is to be planned on the
+# durations of the slot it starts in. Such days are planned one trip at a time
+# instead.
+
+
+def get_reload_vehicles(data, num_trips):
+    """Rider of each depot copy, num_trips - 1 copies per rider."""
+    return [
+        vehicle_id
+        for vehicle_id in range(data["num_vehicles"])
+        for _ in range(num_trips - 1)
+    ]
+
+
+def get_initial_routes(initial_tours, num_locations, num_depots, reload_vehicles):
+    """Routes (positions in the model) of the trips of `initial_tours`, each
+    trip joined to the next one through a copy of the depot."""
+    reloads = [[] for _ in initial_tours]
+    for copy_idx, vehicle_id in enumerate(reload_vehicles):
+        reloads[vehicle_id].append(num_locations + copy_idx)
+
+    initial_routes = [[] for _ in initial_tours]
+    for vehicle_id, vehicle_tours in enumerate(initial_tours):
+        for trip_no, tour in enumerate(vehicle_tours[: len(reloads[vehicle_id]) + 1]):
+            if trip_no > 0:
+                initial_routes[vehicle_id].append(reloads[vehicle_id][trip_no - 1])
+            # Orders keep their problem node as position.
+            initial_routes[vehicle_id] += [node for node in tour if node >= num_depots]
+    return initial_routes
+
+
+def split_trips(nodes, route, route_timings, num_depots):
+    """Splits the route of a rider at the depot copies it visits.
+
+    :returns: The trips (in problem nodes) & their timings, empty trips left
+        out.
+    """
+    tours = []
+    timings = []
+    tour = [nodes[route[0]]]
+    tour_timings = [route_timings[0]]
+    for position, time in zip(route[1:], route_timings[1:]):
+        tour.append(nodes[position])
+        tour_timings.append(time)
+        # Back at the depot (or a copy of it), the trip is over.
+        if nodes[position] < num_depots:
+            if len(tour) > 2:
+                tours.append(tour)
+                timings.append(tour_timings)
+            # The next trip begins once the rider has waited at the warehouse.
+            tour = [nodes[position]]
+            tour_timings = [time + WAIT_TIME_AT_WAREHOUSE]
+    return tours, timings
+
+
+def start_day_single_model(
+    data,
+    drop_penalty,
+    time_to_limit=DEFAULT_TIME_LIMIT,
+    initial_tours=None,
+    stop_when=None,
+    extra_trips=1,
+):
+    """Plans all trips of all riders in a single routing model.
+
+    Same interface as `start_day.start_day`. Riders may do up to
+    `extra_trips` more trips than needed to carry all deliveries. Days with
+    time slots are planned by `start_day.start_day`.
+    """
+    if "time_tensor" in data:
+        logger.info("Time slots are enabled, planning the day one trip at a time")
+        return start_day(data, drop_penalty, time_to_limit, initial_tours, stop_when)
+
+    tours = [[] for _ in range(data["num_vehicles"])]
+    timings = [[] for _ in range(data["num_vehicles"])]
+    total_penalty = 0
+
+    if data["num_locations"] == 0:
+        return tours, timings, total_penalty
+
+    num_locations = data["num_locations"]
+    num_depots = len(setup.get_depots(data))
+    num_trips = get_expected_loops(data) + extra_trips
+    reload_vehicles = get_reload_vehicles(data, num_trips)
+    starts = data.get("starts", [data["depot"]] * data["num_vehicles"])
+
+    nodes = [loc for loc in range(num_locations)]
+    nodes += [starts[vehicle_id] for vehicle_id in reload_vehicles]
+    # Depot copies are optional.
+    drop_penalty = [penalty for penalty in data["penalty"]]
+    drop_penalty += [0] * len(reload_vehicles)
+
+    manager, routing = RoutingModelBuilder(data).build(
+        nodes,
+        data["start_time"],
+        drop_penalty,
+        end_time=[GLOBAL_END_TIME] * data["num_vehicles"],
+        reload_service_time=WAIT_TIME_AT_WAREHOUSE,
+    )
+    # Copies of a depot are only for the rider they were made for.
+    for copy_idx, vehicle_id in enumerate(reload_vehicles):
+        routing.SetAllowedVehiclesForIndex(
+            [vehicle_id], manager.NodeToIndex(num_locations + copy_idx)
+        )
+
+    if stop_when is not None:
+
+        def stop_search():
+            if stop_when():
+                routing.solver().FinishCurrentSearch()
+
+        routing.AddAtSolutionCallback(stop_search)
+
+    search_parameters = get_search_parameters(data, time_to_limit)
+    solution = None
+    if initial_tours is not None:
+        routing.CloseModelWithParameters(search_parameters)
+        initial_solution = routing.ReadAssignmentFromRoutes(
+            get_initial_routes(
+                initial_tours, num_locations, num_depots, reload_vehicles
+            ),
+            True,
+        )
+        if initial_solution:
+            solution = routing.SolveFromAssignmentWithParameters(
+                initial_solution, search_parameters
+            )
+    if not solution:
+        solution = routing.SolveWithParameters(search_parameters)
+    if not solution:
+        return tours, timings, total_penalty
+
+    time_dimension = routing.GetDimensionOrDie(TIME_DIMENSION_NAME)
+    for vehicle_id in range(data["num_vehicles"]):
+        route = []
+        route_timings = []
+        index = routing.Start(vehicle_id)
+        while True:
+            route.append(manager.IndexToNode(index))
+            route_timings.append(solution.Value(time_dimension.CumulVar(index)))
+            if routing.IsEnd(index):
+                break
+            index = solution.Value(routing.NextVar(index))
+        tours[vehicle_id], timings[vehicle_id] = split_trips(
+            nodes, route, route_timings, num_depots
+        )
+
+    # total penalty will always be zero.
+    return tours, timings, total_penalty
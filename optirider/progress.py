@@ -0,0 +1,94 @@
+from optirider import evaluation
+from optirider import setup
+from optirider.add_multiple_pickup import solve_constrained_vrp
+
+# Keeps the planned timings of a rider in line with its actual progress.
+# tours and timings are those of a single rider: its ongoing tour first, then
+# its upcoming tours, timings being absolute (seconds). heading_index is the
+# index, in the ongoing tour, of the stop the rider is heading to (as in
+# data['tour_location']). Timings are updated in place, touching only the
+# remaining stops of the ongoing tour and the upcoming tours which move.
+
+
+def propagate_arrival(timings, heading_index, arrival):
+    """Shifts the schedule of a rider, so that it reaches the stop it is
+    heading to at arrival."""
+    current_timings = timings[0]
+    delay = arrival - current_timings[heading_index]
+    if delay == 0:
+        return
+    current_timings[heading_index:] = evaluation.shift_times(
+        current_timings[heading_index:], delay
+    )
+    evaluation.propagate_trip_starts(timings)
+
+
+def catch_up(timings, tour_locations, cur_time):
+    """Moves the remaining stops of riders, which should have been reached
+    before cur_time, to cur_time at the earliest."""
+    for vehicle_id, heading_index in enumerate(tour_locations):
+        if heading_index == -1:
+            continue
+        if timings[vehicle_id][0][heading_index] < cur_time:
+            propagate_arrival(timings[vehicle_id], heading_index, cur_time)
+
+
+def remaining_lateness(tours, timings, heading_index, delivery_time):
+    """Lateness (seconds) of each of the stops the rider has yet to reach."""
+    remaining_plan = evaluation.flatten_plan(
+        [[tours[0][heading_index:]] + tours[1:]],
+        [[timings[0][heading_index:]] + timings[1:]],
+    )
+    return evaluation.lateness(remaining_plan, delivery_time)
+
+
+def resequence_current_tour(tours, timings, heading_index, data, vehicle_id):
+    """Re-orders the remaining stops of the ongoing tour of a rider (from the
+    stop it is heading to), then moves the upcoming tours accordingly.
+
+    :returns: The updated tours & timings of the rider, or None if the
+        remaining stops cannot all be visited in a single tour anymore.
+    """
+    tour = tours[0]
+    tour_timings = timings[0]
+
+    # Deliveries left in the bag, and pickups already made, take up space.
+    cur_free_space = data["vehicle_capacity"][vehicle_id]
+    for i in range(heading_index):
+        cur_free_space += min(data["package_volume"][tour[i]], 0)
+
+    tour_idx = []
+    initial_tour = []
+    for i in range(heading_index, len(tour)):
+        if tour[i] > 0:
+            tour_idx.append(tour[i])
+            if i != heading_index:
+                initial_tour.append(len(tour_idx) - 1)
+            cur_free_space -= max(data["package_volume"][tour[i]], 0)
+
+    # This is the index of depot.
+    tour_idx.append(0)
+    end_idx = len(tour_idx) - 1
+
+    start_time = tour_timings[0]
+    tour_data = setup.extract_data(data, tour_idx, [vehicle_id], [start_time])
+    tour_data["start"] = [end_idx] if heading_index == 0 else [0]
+    tour_data["end"] = [end_idx]
+    tour_data["route_length"] = len(tour_idx)
+
+    updated_tour, updated_timings, missed_point, _ = solve_constrained_vrp(
+        tour_data,
+        initial_tour,
+        start_time,
+        tour_timings[heading_index],
+        cur_free_space,
+    )
+    if len(missed_point) > 0 or len(updated_tour) == 0:
+        return None
+
+    updated_tours = [tour[:heading_index] + [tour_idx[loc] for loc in updated_tour]]
+    updated_tours += tours[1:]
+    updated_timings = [tour_timings[:heading_index] + updated_timings]
+    updated_timings += timings[1:]
+    evaluation.propagate_trip_starts(updated_timings)
+    return updated_tours, updated_timings
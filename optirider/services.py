@@ -1,11 +1,34 @@
+import asyncio
+import hashlib
 import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from datetime import date, timedelta
+from functools import lru_cache
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from requests import Session
+from django.utils.module_loading import import_string
+from requests import RequestException, Session
+from pathlib import Path
 from urllib.parse import urljoin, quote
+import httpx
 import numpy as np
 
 logger = logging.getLogger(__name__)
 
+EARTH_RADIUS = 6371008.8  # Mean radius of earth, in metres.
+
+# Matrices handed in by the caller (eg. while replaying recorded traffic), used
+# in order instead of querying OSRM.
+_provided_matrices = ContextVar("provided_matrices", default=None)
+# Matrices fetched ahead of the solve (by async views), by their points.
+_prefetched_matrices = ContextVar("prefetched_matrices", default=None)
+
 
 class LiveServerSession(Session):
     def __init__(self, prefix_url):
@@ -24,18 +47,753 @@ def table_request_path(points):
     return req_path
 
 
+@contextmanager
+def provided_matrices(matrices):
+    """Serves the given matrices, in order, to `fetch_distance_matrix` calls
+    made inside the block instead of querying OSRM."""
+    token = _provided_matrices.set(iter(matrices))
+    try:
+        yield
+    finally:
+        _provided_matrices.reset(token)
+
+
+def matrices_provided():
+    return _provided_matrices.get() is not None
+
+
+def next_provided_matrix(points):
+    provided = _provided_matrices.get()
+    if provided is None:
+        return None
+    matrix = next(provided, None)
+    if matrix is None:
+        raise LookupError("No provided distance matrix left for this request")
+    if len(matrix) != len(points):
+        raise ValueError(
+            f"Provided distance matrix has {len(matrix)} rows, "
+            f"expected {len(points)}"
+        )
+    return np.rint(np.asarray(matrix)).astype(int).tolist()
+
+
+class DistanceProviderError(Exception):
+    """Raised when a provider cannot produce the matrix for the given points."""
+
+
+class CircuitBreaker:
+    """Stops calling a failing backend for a while.
+
+    After `failure_threshold` failed calls in a row, the circuit opens: calls
+    are refused straight away for `reset_timeout` seconds. A single trial call
+    is then let through, which closes the circuit if it succeeds.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def release(self):
+        """Ends a call which tells nothing of the backend (eg. cancelled), so
+        that the trial call may be made again."""
+        with self._lock:
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial = False
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+class OSRMDistanceProvider:
+    """Durations from the OSRM table service, over HTTP.
+
+    `afetch` queries OSRM without blocking the event loop, over a connection
+    pool kept alive per event loop, so one server process can wait on many
+    tables at once. Both `fetch` & `afetch` go through a circuit breaker, so
+    that an OSRM outage fails requests (or sends them to the fallback backend)
+    straight away, rather than after a timeout each.
+    """
+
+    def __init__(
+        self,
+        base_url=None,
+        timeout=timedelta(seconds=30),
+        connect_timeout=timedelta(seconds=5),
+        max_connections=32,
+        max_keepalive_connections=8,
+        keepalive_expiry=timedelta(seconds=60),
+        failure_threshold=5,
+        reset_timeout=timedelta(seconds=30),
+    ):
+        if base_url is None:
+            base_url = settings.OPTIRIDER_SETTINGS["OSRM"]["BASE_URL"]
+        self.base_url = base_url
+        self.timeout = timeout.total_seconds()
+        self.connect_timeout = connect_timeout.total_seconds()
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry.total_seconds(),
+        )
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout.total_seconds())
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+
+    def table_request(self, points):
+        req_path = table_request_path(points)
+        req_body = ";".join([f"{pnt.coords[0]},{pnt.coords[1]}" for pnt in points])
+        return req_path, {"coordStr": req_body}
+
+    def durations(self, response):
+        response.raise_for_status()
+        durations = response.json()["durations"]
+        return np.rint(np.array(durations, dtype=float)).astype(int)
+
+    def fetch(self, points):
+        if not self.breaker.allow():
+            raise DistanceProviderError("OSRM circuit is open")
+        req_path, req_json = self.table_request(points)
+        try:
+            with LiveServerSession(prefix_url=self.base_url) as s:
+                logger.debug("Requesting OSRM table " + urljoin(s.prefix_url, req_path))
+                r = s.post(
+                    req_path,
+                    json=req_json,
+                    timeout=(self.connect_timeout, self.timeout),
+                )
+                logger.debug("Request to OSRM table done")
+                durations = self.durations(r)
+        except (RequestException, ValueError, KeyError) as e:
+            self.breaker.failure()
+            raise DistanceProviderError(f"OSRM table request failed: {e}") from e
+        except BaseException:
+            # Eg. cancelled, or interrupted.
+            self.breaker.release()
+            raise
+        self.breaker.success()
+        return durations
+
+    def get_client(self):
+        """HTTP client of the running event loop, shared by all its requests.
+
+        Clients of event loops which have been closed since (eg. one per
+        request under WSGI) are dropped.
+        """
+        loop = asyncio.get_running_loop()
+        with self._clients_lock:
+            client = self._clients.get(loop)
+            if client is None:
+                self._clients = {
+                    other_loop: other_client
+                    for other_loop, other_client in self._clients.items()
+                    if not other_loop.is_closed()
+                }
+                client = httpx.AsyncClient(
+                    base_url=self.base_url,
+                    timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                    limits=self.limits,
+                )
+                self._clients[loop] = client
+            return client
+
+    async def afetch(self, points):
+        if not self.breaker.allow():
+            raise DistanceProviderError("OSRM circuit is open")
+        req_path, req_json = self.table_request(points)
+        try:
+            logger.debug("Requesting OSRM table " + req_path)
+            r = await self.get_client().post(req_path, json=req_json)
+            logger.debug("Request to OSRM table done")
+            durations = self.durations(r)
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            self.breaker.failure()
+            raise DistanceProviderError(f"OSRM table request failed: {e}") from e
+        except BaseException:
+            # Eg. cancelled, or interrupted.
+            self.breaker.release()
+            raise
+        self.breaker.success()
+        return durations
+
+
+def point_arrays(points):
+    coords = np.array([pnt.coords for pnt in points], dtype=float).reshape(-1, 2)
+    return coords[:, 0], coords[:, 1]
+
+
+class EstimatedDistanceProvider:
+    """Durations estimated from the coordinates alone, with no network access.
+
+    :param metric: Either "haversine" (great circle) or "manhattan" distance.
+    :param speed: Average speed of a rider, in metres per second.
+    """
+
+    def __init__(self, metric="haversine", speed=5.0):
+        if metric not in ("haversine", "manhattan"):
+            raise ValueError(f"Unknown distance metric {metric}")
+        self.metric = metric
+        self.speed = speed
+
+    def distances(self, points):
+        longitude, latitude = point_arrays(points)
+        lon = np.radians(longitude)
+        lat = np.radians(latitude)
+        d_lon = lon[:, np.newaxis] - lon[np.newaxis, :]
+        d_lat = lat[:, np.newaxis] - lat[np.newaxis, :]
+
+        if self.metric == "haversine":
+            a = (
+                np.sin(d_lat / 2) ** 2
+                + np.cos(lat)[:, np.newaxis]
+                * np.cos(lat)[np.newaxis, :]
+                * np.sin(d_lon / 2) ** 2
+            )
+            return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+        mean_lat = (lat[:, np.newaxis] + lat[np.newaxis, :]) / 2
+        return EARTH_RADIUS * (np.abs(d_lat) + np.abs(d_lon) * np.cos(mean_lat))
+
+    def fetch(self, points):
+        return np.rint(self.distances(points) / self.speed).astype(int)
+
+
+class MatrixFileDistanceProvider:
+    """Durations looked up from a precomputed matrix.
+
+    The matrix (N x N) and its coordinates (N x 2, longitude & latitude) are
+    stored as `.npy` files. The matrix is memory mapped, so only the rows
+    needed for a request are read from disk.
+    """
+
+    def __init__(self, matrix_path, coords_path):
+        self.matrix = np.load(matrix_path, mmap_mode="r")
+        coords = np.load(coords_path)
+        self.index = {
+            coord_key(longitude, latitude): idx
+            for idx, (longitude, latitude) in enumerate(coords)
+        }
+
+    def fetch(self, points):
+        try:
+            indices = np.array(
+                [self.index[coord_key(*pnt.coords)] for pnt in points], dtype=int
+            )
+        except KeyError as e:
+            raise DistanceProviderError(f"Point {e} is not in the matrix file") from e
+        return np.asarray(self.matrix[np.ix_(indices, indices)]).astype(int)
+
+
+def coord_key(longitude, latitude):
+    return round(float(longitude), 6), round(float(latitude), 6)
+
+
+def save_matrix_file(matrix_path, coords_path, points, matrix):
+    """Stores a matrix in the format read by `MatrixFileDistanceProvider`."""
+    longitude, latitude = point_arrays(points)
+    np.save(coords_path, np.stack([longitude, latitude], axis=1))
+    np.save(matrix_path, np.asarray(matrix, dtype=np.int32))
+
+
+DISTANCE_PROVIDERS = {
+    "osrm": OSRMDistanceProvider,
+    "estimate": EstimatedDistanceProvider,
+    "matrix_file": MatrixFileDistanceProvider,
+}
+
+
+@lru_cache(maxsize=None)
+def get_distance_provider(name):
+    """Builds the provider registered under `name`, configured from the
+    `DISTANCE_PROVIDER` options in `OPTIRIDER_SETTINGS`."""
+    options = settings.OPTIRIDER_SETTINGS["DISTANCE_PROVIDER"]["OPTIONS"].get(name, {})
+    provider_class = DISTANCE_PROVIDERS.get(name)
+    if provider_class is None:
+        provider_class = import_string(name)
+    return provider_class(**{key.lower(): value for key, value in options.items()})
+
+
+def fetch_matrix(points):
+    """Fetches the matrix as a NumPy array from the configured backend,
+    switching to the fallback backend (if any) when the backend fails. Points
+    which a matrix was prewarmed for are served from the prewarmed cache."""
+    prewarmed = get_prewarmed_matrices().load(points)
+    if prewarmed is not None:
+        return prewarmed
+    provider_settings = settings.OPTIRIDER_SETTINGS["DISTANCE_PROVIDER"]
+    try:
+        return get_distance_provider(provider_settings["BACKEND"]).fetch(points)
+    except DistanceProviderError:
+        if not provider_settings["FALLBACK"]:
+            raise
+        logger.exception(
+            "Distance backend failed, falling back to " + provider_settings["FALLBACK"]
+        )
+        return get_distance_provider(provider_settings["FALLBACK"]).fetch(points)
+
+
+async def afetch_from(provider, points):
+    """Fetches from the provider without blocking the event loop, providers
+    with no `afetch` coroutine being run on a thread."""
+    if hasattr(provider, "afetch"):
+        return await provider.afetch(points)
+    return await sync_to_async(provider.fetch, thread_sensitive=False)(points)
+
+
+async def afetch_matrix(points):
+    """`fetch_matrix`, for the event loop."""
+    # The prewarmed cache is looked up on disk.
+    prewarmed = await sync_to_async(
+        get_prewarmed_matrices().load, thread_sensitive=False
+    )(points)
+    if prewarmed is not None:
+        return prewarmed
+    provider_settings = settings.OPTIRIDER_SETTINGS["DISTANCE_PROVIDER"]
+    try:
+        return await afetch_from(
+            get_distance_provider(provider_settings["BACKEND"]), points
+        )
+    except DistanceProviderError:
+        if not provider_settings["FALLBACK"]:
+            raise
+        logger.exception(
+            "Distance backend failed, falling back to " + provider_settings["FALLBACK"]
+        )
+        return await afetch_from(
+            get_distance_provider(provider_settings["FALLBACK"]), points
+        )
+
+
+def points_key(points):
+    return tuple(coord_key(*pnt.coords) for pnt in points)
+
+
+async def prefetch_distance_matrices(points_list):
+    """Fetches the matrices of several point sets concurrently, for
+    `prefetched_matrices`."""
+    matrices = await asyncio.gather(*(afetch_matrix(points) for points in points_list))
+    return {points_key(points): matrix for points, matrix in zip(points_list, matrices)}
+
+
+class TiledMatrixPrefetch:
+    """Fetches the matrix of points as they come (eg. while a request is being
+    read), from the event loop, in tiles between blocks of `tile_size` points.
+
+    Each pair of blocks is fetched as one table over both, as soon as the later
+    block is complete: about twice the work of a single table, but spread over
+    the reading, and in tables of 2 * `tile_size` points at most. Failed fetches
+    are logged, and leave the matrix to be fetched as usual.
+
+    :param max_concurrency: Number of tables fetched at once (None for any).
+    """
+
+    def __init__(self, tile_size, max_concurrency=None):
+        self.tile_size = tile_size
+        self.provider = get_distance_provider(
+            settings.OPTIRIDER_SETTINGS["DISTANCE_PROVIDER"]["BACKEND"]
+        )
+        self.semaphore = None
+        if max_concurrency is not None:
+            self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.points = []
+        self.tiles = {}
+        self.tasks = []
+
+    def block(self, index):
+        return self.points[index * self.tile_size : (index + 1) * self.tile_size]
+
+    def add(self, point):
+        self.points.append(point)
+        if len(self.points) % self.tile_size == 0:
+            self.fetch_tiles(len(self.points) // self.tile_size - 1)
+
+    def fetch_tiles(self, index):
+        """Starts fetching the tiles between the block & those before it."""
+        for other in range(index):
+            self.tasks.append(asyncio.create_task(self.fetch_pair(index, other)))
+
+    async def fetch(self, points):
+        if self.semaphore is None:
+            return await afetch_from(self.provider, points)
+        async with self.semaphore:
+            return await afetch_from(self.provider, points)
+
+    async def fetch_pair(self, index, other):
+        block = self.block(index)
+        matrix = await self.fetch(block + self.block(other))
+        size = len(block)
+        self.tiles[index, index] = matrix[:size, :size]
+        self.tiles[index, other] = matrix[:size, size:]
+        self.tiles[other, index] = matrix[size:, :size]
+        self.tiles[other, other] = matrix[size:, size:]
+
+    async def matrices(self, points):
+        """Prefetched matrices (as `prefetch_distance_matrices`) once all the
+        points are added, if they are the points given."""
+        if points_key(points) != points_key(self.points):
+            self.cancel()
+            return {}
+        num_blocks = -(-len(self.points) // self.tile_size)
+        if len(self.points) % self.tile_size != 0:
+            self.fetch_tiles(num_blocks - 1)
+        try:
+            await asyncio.gather(*self.tasks)
+            if num_blocks == 1:
+                self.tiles[0, 0] = await self.fetch(self.block(0))
+        except DistanceProviderError:
+            logger.exception("Tiled matrix prefetch failed")
+            self.cancel()
+            return {}
+        matrix = np.block(
+            [
+                [self.tiles[row, col] for col in range(num_blocks)]
+                for row in range(num_blocks)
+            ]
+        )
+        return {points_key(points): matrix}
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+
+@contextmanager
+def prefetched_matrices(matrices):
+    """Serves the prefetched matrices to the `fetch_distance_matrix` calls
+    made inside the block on the same points. Other points are fetched."""
+    token = _prefetched_matrices.set(matrices)
+    try:
+        yield
+    finally:
+        _prefetched_matrices.reset(token)
+
+
 def fetch_distance_matrix(points):
-    OSRM_BASE_URL = settings.OPTIRIDER_SETTINGS["OSRM"]["BASE_URL"]
-    req_path = table_request_path(points)
-    req_body = ";".join([f"{pnt.coords[0]},{pnt.coords[1]}" for pnt in points])
-    with LiveServerSession(prefix_url=OSRM_BASE_URL) as s:
-        logger.debug("Requesting OSRM table " + urljoin(s.prefix_url, req_path))
-        r = s.post(
-            req_path,
-            json={
-                "coordStr": req_body,
-            },
-        )
-        logger.debug("Request to OSRM table done")
-        adj_matrix = np.rint(np.array(r.json()["durations"])).astype(int).tolist()
-    return adj_matrix
+    adj_matrix = next_provided_matrix(points)
+    if adj_matrix is not None:
+        return adj_matrix
+    prefetched = _prefetched_matrices.get()
+    if prefetched is not None and points_key(points) in prefetched:
+        return prefetched[points_key(points)].tolist()
+    return fetch_matrix(points).tolist()
+
+
+def fetch_distance_matrices(points_list, fetch=fetch_distance_matrix):
+    """Fetches the matrices of several point sets concurrently, with `fetch`
+    (eg. `fetch_time_dependent_matrices`)."""
+    if _provided_matrices.get() is not None:
+        # Provided matrices are served in the order they were asked for.
+        return [fetch(points) for points in points_list]
+    with ThreadPoolExecutor(max_workers=max(1, len(points_list))) as executor:
+        # Each fetch sees the prefetched matrices of the request.
+        futures = [
+            executor.submit(copy_context().run, fetch, points) for points in points_list
+        ]
+        return [future.result() for future in futures]
+
+
+class TimeSlotMatrixCache:
+    """Time dependent durations, as a (time slots x N x N) tensor.
+
+    Slot k holds the free flow durations scaled by the factor of the slot (eg.
+    2.0 during the evening peak). Tensors are stored as memory mapped `.npy`
+    files next to their free flow matrix, under one directory per day, keyed
+    by the points & the slots. Directories of previous days are removed.
+    """
+
+    def __init__(self, directory, slots, dtype="int32"):
+        self.directory = Path(directory)
+        self.slot_starts = [int(start.total_seconds()) for start, _ in slots]
+        self.factors = np.array([factor for _, factor in slots], dtype=float)
+        self.dtype = np.dtype(dtype)
+
+    def day_directory(self):
+        return self.directory / date.today().isoformat()
+
+    def key(self, points):
+        longitude, latitude = point_arrays(points)
+        digest = hashlib.sha1()
+        digest.update(np.round(np.stack([longitude, latitude]), 6).tobytes())
+        digest.update(np.array(self.slot_starts, dtype=np.int64).tobytes())
+        digest.update(self.factors.tobytes())
+        digest.update(self.dtype.str.encode())
+        return digest.hexdigest()
+
+    def paths(self, points):
+        key = self.key(points)
+        day_directory = self.day_directory()
+        return day_directory / f"{key}.npy", day_directory / f"{key}.slots.npy"
+
+    def load(self, points):
+        """Returns the cached free flow matrix & tensor, or None."""
+        matrix_path, tensor_path = self.paths(points)
+        if not tensor_path.exists():
+            return None
+        return np.load(matrix_path, mmap_mode="r"), np.load(tensor_path, mmap_mode="r")
+
+    def store(self, points, matrix):
+        """Builds the tensor from the free flow matrix, and caches both."""
+        matrix_path, tensor_path = self.paths(points)
+        day_directory = matrix_path.parent
+        if not day_directory.exists():
+            self.remove_previous_days()
+            day_directory.mkdir(parents=True, exist_ok=True)
+
+        # Written under temporary names, then renamed, so readers (which may
+        # have the files mapped) never see a partial entry. The tensor is
+        # renamed last, as it marks a complete entry.
+        suffix = f".{os.getpid()}.{threading.get_ident()}.partial"
+        matrix = np.asarray(matrix)
+        partial_matrix_path = matrix_path.with_name(matrix_path.name + suffix)
+        with open(partial_matrix_path, "wb") as matrix_file:
+            np.save(matrix_file, matrix.astype(self.dtype))
+        partial_tensor_path = tensor_path.with_name(tensor_path.name + suffix)
+        tensor = np.lib.format.open_memmap(
+            partial_tensor_path,
+            mode="w+",
+            dtype=self.dtype,
+            shape=(len(self.factors),) + matrix.shape,
+        )
+        for slot, factor in enumerate(self.factors):
+            tensor[slot] = np.rint(matrix * factor)
+        tensor.flush()
+        del tensor
+        partial_matrix_path.replace(matrix_path)
+        partial_tensor_path.replace(tensor_path)
+        return self.load(points)
+
+    def remove_previous_days(self):
+        if not self.directory.exists():
+            return
+        today = self.day_directory().name
+        for day_directory in self.directory.iterdir():
+            if day_directory.is_dir() and day_directory.name != today:
+                shutil.rmtree(day_directory, ignore_errors=True)
+
+
+@lru_cache(maxsize=None)
+def get_time_slot_cache():
+    time_slot_settings = settings.OPTIRIDER_SETTINGS["TIME_SLOTS"]
+    return TimeSlotMatrixCache(
+        time_slot_settings["CACHE_DIRECTORY"],
+        time_slot_settings["SLOTS"],
+        time_slot_settings["DTYPE"],
+    )
+
+
+def fetch_time_dependent_matrices(points):
+    """Returns the free flow matrix & the time slot tensor of the points,
+    only querying the backend when they are not cached for today yet."""
+    cache = get_time_slot_cache()
+    # Provided matrices take the place of the backend, not of the cache.
+    if _provided_matrices.get() is None:
+        cached = cache.load(points)
+        if cached is not None:
+            return cached
+    return cache.store(points, fetch_distance_matrix(points))
+
+
+class PrewarmedMatrixCache:
+    """Matrices fetched ahead of the requests needing them (eg. hours before
+    the start day), stored with the coordinates of their points as memory
+    mapped `.npy` files, under one directory per day. A matrix serves any
+    points which are all among its own points, in any order. Directories of
+    previous days are removed.
+    """
+
+    def __init__(self, directory, dtype="int32"):
+        self.directory = Path(directory)
+        self.dtype = np.dtype(dtype)
+        self._indices = {}
+        self._lock = threading.Lock()
+
+    def day_directory(self):
+        return self.directory / date.today().isoformat()
+
+    def key(self, points):
+        longitude, latitude = point_arrays(points)
+        digest = hashlib.sha1()
+        digest.update(np.round(np.stack([longitude, latitude]), 6).tobytes())
+        return digest.hexdigest()
+
+    def paths(self, points):
+        key = self.key(points)
+        day_directory = self.day_directory()
+        return day_directory / f"{key}.npy", day_directory / f"{key}.coords.npy"
+
+    def coords_index(self, matrix_path):
+        """Index of each point of a cached matrix, by its coordinates."""
+        with self._lock:
+            index = self._indices.get(matrix_path)
+        if index is None:
+            coords_path = matrix_path.with_name(
+                matrix_path.name[: -len(".npy")] + ".coords.npy"
+            )
+            index = {
+                coord_key(longitude, latitude): idx
+                for idx, (longitude, latitude) in enumerate(np.load(coords_path))
+            }
+            with self._lock:
+                self._indices[matrix_path] = index
+        return index
+
+    def find(self, points):
+        """Returns the path of a cached matrix holding all the points, & their
+        indices in it, or None."""
+        day_directory = self.day_directory()
+        if not day_directory.exists():
+            return None
+        keys = [coord_key(*pnt.coords) for pnt in points]
+        for matrix_path in day_directory.glob("*.npy"):
+            if matrix_path.name.endswith(".coords.npy"):
+                continue
+            index = self.coords_index(matrix_path)
+            if all(key in index for key in keys):
+                return matrix_path, [index[key] for key in keys]
+        return None
+
+    def contains(self, points):
+        return self.find(points) is not None
+
+    def load(self, points):
+        """Returns the matrix of the points, from a cached matrix, or None."""
+        found = self.find(points)
+        if found is None:
+            return None
+        matrix_path, indices = found
+        matrix = np.load(matrix_path, mmap_mode="r")
+        return np.asarray(matrix[np.ix_(indices, indices)]).astype(int)
+
+    def store(self, points, matrix):
+        matrix_path, coords_path = self.paths(points)
+        day_directory = matrix_path.parent
+        if not day_directory.exists():
+            self.remove_previous_days()
+            day_directory.mkdir(parents=True, exist_ok=True)
+
+        # Written under temporary names, then renamed, the matrix last as it
+        # marks a complete entry.
+        suffix = f".{os.getpid()}.{threading.get_ident()}.partial"
+        longitude, latitude = point_arrays(points)
+        partial_coords_path = coords_path.with_name(coords_path.name + suffix)
+        with open(partial_coords_path, "wb") as coords_file:
+            np.save(coords_file, np.stack([longitude, latitude], axis=1))
+        partial_matrix_path = matrix_path.with_name(matrix_path.name + suffix)
+        with open(partial_matrix_path, "wb") as matrix_file:
+            np.save(matrix_file, np.asarray(matrix).astype(self.dtype))
+        partial_coords_path.replace(coords_path)
+        partial_matrix_path.replace(matrix_path)
+
+    def remove_previous_days(self):
+        if not self.directory.exists():
+            return
+        today = self.day_directory().name
+        for day_directory in self.directory.iterdir():
+            if day_directory.is_dir() and day_directory.name != today:
+                shutil.rmtree(day_directory, ignore_errors=True)
+        with self._lock:
+            self._indices = {
+                matrix_path: index
+                for matrix_path, index in self._indices.items()
+                if matrix_path.parent.name == today
+            }
+
+
+@lru_cache(maxsize=None)
+def get_prewarmed_matrices():
+    prewarm_settings = settings.OPTIRIDER_SETTINGS["PREWARM"]
+    return PrewarmedMatrixCache(
+        prewarm_settings["CACHE_DIRECTORY"], prewarm_settings["DTYPE"]
+    )
+
+
+class PrewarmQueueFull(Exception):
+    """Raised when as many matrices as allowed are queued to be prewarmed."""
+
+
+class MatrixPrewarmer:
+    """Fills the prewarmed matrix cache in the background, one set of points
+    at a time, each fetched as a `TiledMatrixPrefetch`. At most `max_pending`
+    matrices are queued (or being fetched) at once.
+
+    Matrices are only cached when the configured backend returns them, never
+    from the fallback backend.
+    """
+
+    def __init__(self, cache, tile_size, max_concurrency, max_pending):
+        self.cache = cache
+        self.tile_size = tile_size
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prewarm")
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def submit(self, points):
+        """Queues the matrix of the points, unless it is cached or queued
+        already. Returns whether it was queued.
+
+        :raises PrewarmQueueFull: If `max_pending` matrices are queued already.
+        """
+        key = self.cache.key(points)
+        with self._lock:
+            if key in self._pending or self.cache.contains(points):
+                return False
+            if len(self._pending) >= self.max_pending:
+                raise PrewarmQueueFull(
+                    f"{len(self._pending)} matrices are queued to be prewarmed"
+                )
+            self._pending.add(key)
+        self.executor.submit(self.prewarm, key, points)
+        return True
+
+    def prewarm(self, key, points):
+        try:
+            matrix = asyncio.run(self.fetch(points))
+            if matrix is None:
+                logger.warning(f"Could not prewarm the matrix of {len(points)} points")
+            else:
+                self.cache.store(points, matrix)
+        except Exception:
+            logger.exception("Matrix prewarm failed")
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    async def fetch(self, points):
+        prefetch = TiledMatrixPrefetch(self.tile_size, self.max_concurrency)
+        for point in points:
+            prefetch.add(point)
+        return (await prefetch.matrices(points)).get(points_key(points))
+
+
+@lru_cache(maxsize=None)
+def get_matrix_prewarmer():
+    prewarm_settings = settings.OPTIRIDER_SETTINGS["PREWARM"]
+    return MatrixPrewarmer(
+        get_prewarmed_matrices(),
+        prewarm_settings["TILE_SIZE"],
+        prewarm_settings["MAX_CONCURRENCY"],
+        prewarm_settings["MAX_PENDING"],
+    )
@@ -1,10 +1,11 @@
+import bisect
 import numpy as np
 
+from optirider import evaluation
 from optirider.constants import (
     LATE_DELIVERY_PENALTY_PER_SEC,
     MAX_TRIP_TIME,
     GLOBAL_END_TIME,
-    MISS_PENALTY,
 )
 
 
@@ -98,15 +99,40 @@ def generate_data(option):
     )
 
 
-def gen_time_callback(data):
+def gen_time_callback(data, slot=None):
+    """Travel (and service) time callback, on the durations of time slot
+    `slot` if given, or on data['time_matrix']."""
+    if slot is not None:
+        time_matrix = data["time_tensor"][slot]
+
+        def slot_time_callback(manager, from_index, to_index):
+            from_node = manager.IndexToNode(from_index)
+            to_node = manager.IndexToNode(to_index)
+            return (
+                int(time_matrix[from_node][to_node]) + data["service_time"][from_node]
+            )
+
+        return slot_time_callback
+
     def time_callback(manager, from_index, to_index):
         from_node = manager.IndexToNode(from_index)
         to_node = manager.IndexToNode(to_index)
-        return data["time_matrix"][from_node][to_node] + data["service_time"][from_node]
+        return (
+            int(data["time_matrix"][from_node][to_node])
+            + data["service_time"][from_node]
+        )
 
     return time_callback
 
 
+def get_time_slot(data, time):
+    """Time slot (of data['time_tensor']) which `time` falls in, or None when
+    durations do not depend on time."""
+    if "time_tensor" not in data:
+        return None
+    return max(0, bisect.bisect_right(data["time_slots"], time) - 1)
+
+
 def create_volume_evaluator(data):
 
     volume = data["package_volume"]
@@ -134,14 +160,23 @@ def add_capacity_constraints(
     )
 
 
-def add_start_time_constraint(routing, data, time_evaluator_index, time_dimension_name):
+def add_start_time_constraint(
+    routing, data, time_evaluator_indices, time_dimension_name, end_time=None
+):
+    """Adds the time dimension, each vehicle starting at its start time.
 
-    trip_end_time = [
-        min(GLOBAL_END_TIME, start_time + MAX_TRIP_TIME)
-        for start_time in data["start_time"]
-    ]
-    routing.AddDimensionWithVehicleCapacity(
-        time_evaluator_index,
+    :param end_time: Time by which each vehicle must be back, defaults to the
+        end of a trip of MAX_TRIP_TIME (or GLOBAL_END_TIME).
+    """
+    trip_end_time = end_time
+    if trip_end_time is None:
+        trip_end_time = [
+            min(GLOBAL_END_TIME, start_time + MAX_TRIP_TIME)
+            for start_time in data["start_time"]
+        ]
+    routing.AddDimensionWithVehicleTransitAndCapacity(
+        # Time callback of each vehicle.
+        time_evaluator_indices,
         0,  # Does not allow waiting time.
         trip_end_time,  # Global maximum time for a vehicle.
         False,  # Time will not start from 0.
@@ -159,11 +194,59 @@ def add_start_time_constraint(routing, data, time_evaluator_index, time_dimensio
         time_dimension.CumulVar(index).SetRange(x, x)
 
 
+def get_depots(data):
+    """Depot nodes of the problem.
+
+    With several depots (data["depots"]), the depots must be the first nodes,
+    and data["starts"] & data["ends"] give the depot of each vehicle.
+    """
+    return data.get("depots", [data["depot"]])
+
+
+def add_neighbour_pruning(
+    routing,
+    manager,
+    time_matrix,
+    num_depots,
+    num_vehicles,
+    num_neighbours,
+    reload_nodes=(),
+):
+    """Only allows travelling from an order to its `num_neighbours` nearest
+    orders, or back to a depot. Greatly shrinks the search space on large
+    instances.
+
+    :param time_matrix: Durations between the nodes of the model, depots first.
+    :param reload_nodes: Depot copies, placed after the orders, which may
+        always be travelled to.
+    """
+    time_matrix = np.asarray(time_matrix)
+    back_to_depot = [routing.End(vehicle_id) for vehicle_id in range(num_vehicles)]
+    back_to_depot += [manager.NodeToIndex(node) for node in reload_nodes]
+    num_orders = len(time_matrix) - num_depots - len(reload_nodes)
+    if num_orders <= num_neighbours + 1:
+        return
+
+    # Orders follow the depots, so the order nodes are a contiguous slice.
+    orders = slice(num_depots, num_depots + num_orders)
+    order_matrix = time_matrix[orders, orders]
+    nearest = np.argpartition(order_matrix, num_neighbours, axis=1)
+    for order_idx in range(num_orders):
+        node = order_idx + num_depots
+        index = manager.NodeToIndex(node)
+        allowed = [index] + back_to_depot  # Staying on itself means dropped.
+        for neighbour in nearest[order_idx, : num_neighbours + 1]:
+            if neighbour != order_idx:
+                allowed.append(manager.NodeToIndex(int(neighbour) + num_depots))
+        routing.NextVar(index).SetValues(allowed)
+
+
 def add_delivery_time_constraint(routing, manager, data, time_dimension_name):
     time_dimension = routing.GetDimensionOrDie(time_dimension_name)
+    depots = get_depots(data)
 
     for location_idx, delivery_time in enumerate(data["delivery_time"]):
-        if location_idx == data["depot"]:
+        if location_idx in depots:
             continue
         index = manager.NodeToIndex(location_idx)
         time_dimension.SetCumulVarSoftUpperBound(
@@ -305,14 +388,20 @@ def add_single_delivery_time_constraint(routing, manager, data, time_dimension_n
 
 
 def extract_data(data, points_to_take, vehicles, start_time):
-    updated_data = {
-        "time_matrix": [
+    if isinstance(data["time_matrix"], np.ndarray):
+        time_matrix = data["time_matrix"][
+            np.ix_(points_to_take, points_to_take)
+        ].tolist()
+    else:
+        time_matrix = [
             [
                 data["time_matrix"][point_src][point_dest]
                 for point_dest in points_to_take
             ]
             for point_src in points_to_take
-        ],
+        ]
+    updated_data = {
+        "time_matrix": time_matrix,
         "num_locations": len(points_to_take),
         "num_vehicles": len(vehicles),
         "depot": data["depot"],  # This doesn't make much sense.
@@ -325,6 +414,18 @@ def extract_data(data, points_to_take, vehicles, start_time):
         "service_time": [data["service_time"][point] for point in points_to_take],
         "penalty": [data["penalty"][point] for point in points_to_take],
     }
+    if "time_tensor" in data:
+        updated_data["time_tensor"] = np.asarray(data["time_tensor"])[
+            np.ix_(range(len(data["time_tensor"])), points_to_take, points_to_take)
+        ]
+        updated_data["time_slots"] = data["time_slots"]
+    if "depots" in data:
+        # Depots stay the first points, so their indices do not change.
+        updated_data["depots"] = data["depots"]
+        updated_data["starts"] = [data["starts"][vehicle_id] for vehicle_id in vehicles]
+        updated_data["ends"] = [data["ends"][vehicle_id] for vehicle_id in vehicles]
+    if "neighbour_limit" in data:
+        updated_data["neighbour_limit"] = data["neighbour_limit"]
 
     return updated_data
 
@@ -335,28 +436,4 @@ def late_penalty_add(late_time):
 
 
 def get_penalty(tours, timings, data):
-    penalty = 0
-
-    # All points except depot is counted as missed.
-    missed_points = data["num_locations"] - 1
-
-    for vehicle_id in range(data["num_vehicles"]):
-        for tour_id in range(len(tours[vehicle_id])):
-            prev_order = -1
-            missed_points -= (
-                len(tours[vehicle_id][tour_id]) - 2
-            )  # Start and end are at depot.
-
-            for order_id in range(len(tours[vehicle_id][tour_id])):
-                cur_order = tours[vehicle_id][tour_id][order_id]
-                if prev_order != -1:
-                    penalty += data["time_matrix"][prev_order][cur_order]
-                if cur_order > 0:
-                    penalty += late_penalty_add(
-                        timings[vehicle_id][tour_id][order_id]
-                        - data["delivery_time"][cur_order]
-                    )
-                prev_order = cur_order
-
-    penalty += missed_points * MISS_PENALTY
-    return penalty
+    return evaluation.plan_penalty(evaluation.flatten_plan(tours, timings), data)
@@ -1,33 +1,45 @@
 import math
-from functools import partial
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
 from optirider.constants import (
     MISS_PENALTY,
-    TIME_DIMENSION_NAME,
-    CAPACITY_DIMENSION_NAME,
     DEFAULT_TIME_LIMIT,
 )
 
 from optirider import setup
 from optirider import solution as optisolver
+from optirider.model_builder import RoutingModelBuilder
+
+
+def get_initial_routes(initial_tours, trip_no, nodes, num_depots):
+    """Routes of trip `trip_no` from `initial_tours`, in terms of the positions
+    of the nodes of the current iteration. Nodes already served are left out."""
+    node_to_local = {node: loc for loc, node in enumerate(nodes)}
+    initial_routes = []
+    for vehicle_tours in initial_tours:
+        route = []
+        if trip_no < len(vehicle_tours):
+            for node in vehicle_tours[trip_no]:
+                loc = node_to_local.get(node)
+                if loc is not None and loc >= num_depots:
+                    route.append(loc)
+        initial_routes.append(route)
+    return initial_routes
+
+
+def get_expected_loops(data):
+    """Number of trips per rider needed to carry all deliveries."""
+    expected_loops = math.ceil(
+        sum(max(loads, 0) for loads in data["package_volume"])
+        / sum(capacity for capacity in data["vehicle_capacity"])
+    )
+    return max(1, expected_loops)
 
 
-def start_day(data, drop_penalty, time_to_limit=DEFAULT_TIME_LIMIT):
-    tours = [[] for _ in range(data["num_vehicles"])]
-    timings = [[] for _ in range(data["num_vehicles"])]
-
-    total_penalty = 0
-    points_to_map = [loc for loc in range(data["num_locations"])]
-
-    drop_penalty = [penalty for penalty in data["penalty"]]
-
-    if data["num_locations"] == 0:
-        return tours, timings, total_penalty
-
-    # Setting first solution heuristic.
+def get_search_parameters(data, time_limit):
     search_parameters = pywrapcp.DefaultRoutingSearchParameters()
 
+    # Setting first solution heuristic.
     solution_strategy = "PATH_CHEAPEST_ARC"
     if "first_solution_strategy" in data.keys():
         solution_strategy = data["first_solution_strategy"]
@@ -39,83 +51,84 @@ def start_day(data, drop_penalty, time_to_limit=DEFAULT_TIME_LIMIT):
         search_parameters.local_search_metaheuristic = data[
             "local_search_metaheuristic"
         ]
+    search_parameters.time_limit.FromMilliseconds(math.ceil(time_limit * 1000))
+    return search_parameters
+
+
+def start_day(
+    data,
+    drop_penalty,
+    time_to_limit=DEFAULT_TIME_LIMIT,
+    initial_tours=None,
+    stop_when=None,
+):
+    """Plans all trips of all riders, one trip per rider at a time.
+
+    The routing model of each trip is built over the nodes not served yet by
+    a `RoutingModelBuilder`, made once for the day.
+
+    :param initial_tours: Tours (as returned by this function) to warm start
+        each trip's search from, eg. a plan made on estimated durations.
+    :param stop_when: Callable checked at every solution found, the search
+        (and the planning of further trips) stops once it returns True.
+    """
+    tours = [[] for _ in range(data["num_vehicles"])]
+    timings = [[] for _ in range(data["num_vehicles"])]
 
-    # Logic_0: Distribute the time_to_limit among all iteration uniformly.
-    expected_loops = math.ceil(
-        sum(max(loads, 0) for loads in data["package_volume"])
-        / sum(capacity for capacity in data["vehicle_capacity"])
-    )
-    expected_loops = max(1, expected_loops)
-    search_parameters.time_limit.seconds = math.ceil(time_to_limit / (expected_loops))
-
-    while True:
-        # Create routing manager
-        manager = pywrapcp.RoutingIndexManager(
-            data["num_locations"], data["num_vehicles"], data["depot"]
-        )
-
-        # Create route model
-        routing = pywrapcp.RoutingModel(manager)
+    total_penalty = 0
+    # Depots are always the first nodes.
+    num_depots = len(setup.get_depots(data))
 
-        # Create volume evaluator, which gives the change in volume in transit
-        volume_evaluator_index = routing.RegisterUnaryTransitCallback(
-            partial(setup.create_volume_evaluator(data), manager)
-        )
+    drop_penalty = [penalty for penalty in data["penalty"]]
 
-        # Adding the bag capacity constraint (hard constraint, should never be violated)
-        setup.add_capacity_constraints(
-            routing, data, volume_evaluator_index, CAPACITY_DIMENSION_NAME
-        )
+    if data["num_locations"] == 0:
+        return tours, timings, total_penalty
 
-        # Adds time as the metric which model will try to minimize.
-        transit_callback_index = routing.RegisterTransitCallback(
-            partial(setup.gen_time_callback(data), manager)
-        )
+    # Logic_0: Distribute the time_to_limit among all iteration uniformly.
+    expected_loops = get_expected_loops(data)
+    search_parameters = get_search_parameters(data, time_to_limit / expected_loops)
+
+    builder = RoutingModelBuilder(data)
+    # Problem nodes left to plan (depots first), and the state of the riders.
+    nodes = [loc for loc in range(data["num_locations"])]
+    trip_state = {
+        "num_vehicles": data["num_vehicles"],
+        "start_time": list(data["start_time"]),
+    }
+
+    trip_no = 0
+    while True:
+        manager, routing = builder.build(nodes, trip_state["start_time"], drop_penalty)
 
-        # Set arc cost as time taken for travel.
-        routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
+        if stop_when is not None:
 
-        # Adds the constraint that different vechiles may start at different times (for further trips).
-        setup.add_start_time_constraint(
-            routing, data, transit_callback_index, TIME_DIMENSION_NAME
-        )
+            def stop_search():
+                if stop_when():
+                    routing.solver().FinishCurrentSearch()
 
-        # Adds expected delivery_time constriant (soft constraint, late delivery may happen, but that attracts penalty)
-        setup.add_delivery_time_constraint(routing, manager, data, TIME_DIMENSION_NAME)
+            routing.AddAtSolutionCallback(stop_search)
 
-        # Allow to drop nodes (in worst cases) Make penalty very high (greater than penalty for all late delivery combined)
-        for drop_point in range(1, data["num_locations"]):
-            routing.AddDisjunction(
-                [manager.NodeToIndex(drop_point)], drop_penalty[drop_point]
+        solution = None
+        if initial_tours is not None:
+            routing.CloseModelWithParameters(search_parameters)
+            initial_solution = routing.ReadAssignmentFromRoutes(
+                get_initial_routes(initial_tours, trip_no, nodes, num_depots), True
             )
-
-        solution = routing.SolveWithParameters(search_parameters)
+            # Initial routes may be infeasible on the actual durations.
+            if initial_solution:
+                solution = routing.SolveFromAssignmentWithParameters(
+                    initial_solution, search_parameters
+                )
+        if not solution:
+            solution = routing.SolveWithParameters(search_parameters)
+        trip_no += 1
 
         if not solution:
 
             break
 
-        answer, timing, data, drop_penalty = optisolver.get_solution(
-            data, manager, routing, solution, drop_penalty
-        )
-
-        new_points_to_map = [loc for loc in range(data["num_locations"])]
-        points_to_take = [0]
-
-        new_drop_penalty = [0]
-        for location_idx, penalty in enumerate(drop_penalty):
-            if penalty > 0:
-                new_points_to_map[len(points_to_take)] = points_to_map[location_idx]
-                points_to_take.append(location_idx)
-                new_drop_penalty.append(penalty)
-
-        drop_penalty = [new_miss_penalty for new_miss_penalty in new_drop_penalty]
-
-        data = setup.extract_data(
-            data,
-            points_to_take,
-            [vehicle_id for vehicle_id in range(data["num_vehicles"])],
-            data["start_time"],
+        answer, timing, trip_state, drop_penalty = optisolver.get_solution(
+            trip_state, manager, routing, solution, drop_penalty
         )
 
         # Cannot directly add, visited point may be added to miss penalty multiple times.
@@ -128,14 +141,25 @@ def start_day(data, drop_penalty, time_to_limit=DEFAULT_TIME_LIMIT):
                 can_continue = 1
                 timings[vehicle_id].append(timing[vehicle_id])
 
-                actual_tour = [points_to_map[loc] for loc in tour]
+                actual_tour = [nodes[loc] for loc in tour]
                 tours[vehicle_id].append(actual_tour)
 
             vehicle_id += 1
 
-        points_to_map = new_points_to_map
+        # Keep the depots, and the nodes which were dropped.
+        remaining = [loc for loc in range(num_depots)]
+        remaining += [
+            loc for loc in range(num_depots, len(nodes)) if drop_penalty[loc] > 0
+        ]
+        nodes = [nodes[loc] for loc in remaining]
+        drop_penalty = [0] * num_depots + [
+            drop_penalty[loc] for loc in remaining[num_depots:]
+        ]
+
         if len(drop_penalty) == 0 or max(drop_penalty) == 0 or can_continue == 0:
             break
+        if stop_when is not None and stop_when():
+            break
 
     # total penalty will always be zero.
     return tours, timings, total_penalty
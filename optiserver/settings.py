@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 from datetime import timedelta
 import environ
@@ -22,8 +23,28 @@ env = environ.Env(
     ),
     ALLOWED_HOSTS=(list, []),
     OSRM_BASE_URL=(str, "http://router.project-osrm.org"),
+    OPTIRIDER_DISTANCE_BACKEND=(str, "osrm"),
+    OPTIRIDER_DISTANCE_FALLBACK=(str, ""),
+    OPTIRIDER_MATRIX_PATH=(str, ""),
+    OPTIRIDER_MATRIX_COORDS_PATH=(str, ""),
+    OPTIRIDER_SPECULATIVE_START_DAY=(bool, False),
+    OPTIRIDER_TIME_SLOTS=(bool, False),
+    OPTIRIDER_START_DAY_ENGINE=(str, "iterative"),
+    OPTIRIDER_PLANNING_HORIZON=(bool, True),
+    OPTIRIDER_BACKGROUND_REOPTIMISATION=(bool, True),
+    OPTIRIDER_TIME_SLOT_CACHE_DIR=(str, "/tmp/optirider-time-slots"),
+    OPTIRIDER_PREWARM_CACHE_DIR=(str, "/tmp/optirider-prewarmed"),
+    OPTIRIDER_SHARED_MATRIX_DIR=(
+        str,
+        "/dev/shm/optirider-matrices"
+        if os.path.isdir("/dev/shm")
+        else "/tmp/optirider-matrices",
+    ),
     ROOT_LOG_LEVEL=(str, "WARNING"),
     DJANGO_LOG_LEVEL=(str, "INFO"),
+    OPTIRIDER_PROFILE_DIR=(str, "/tmp/optirider-profiles"),
+    OPTIRIDER_RECORD_SOLVES=(bool, False),
+    OPTIRIDER_RECORDING_DIR=(str, "/tmp/optirider-recordings"),
 )
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -67,6 +88,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "solver.middleware.SolveRecordingMiddleware",
 ]
 
 ROOT_URLCONF = "optiserver.urls"
@@ -206,4 +228,190 @@ OPTIRIDER_SETTINGS = {
     "OSRM": {
         "BASE_URL": env("OSRM_BASE_URL"),
     },
+    # Source of the duration matrix: "osrm", "estimate", "matrix_file" or the
+    # dotted path to a provider class. The fallback (if set) is used when the
+    # backend fails, eg. during an OSRM outage.
+    "DISTANCE_PROVIDER": {
+        "BACKEND": env("OPTIRIDER_DISTANCE_BACKEND"),
+        "FALLBACK": env("OPTIRIDER_DISTANCE_FALLBACK"),
+        "OPTIONS": {
+            # Connections to OSRM are pooled & kept alive per event loop. After
+            # FAILURE_THRESHOLD failed requests in a row, OSRM is not queried
+            # for RESET_TIMEOUT (the fallback backend is used meanwhile).
+            "osrm": {
+                "TIMEOUT": timedelta(seconds=30),
+                "CONNECT_TIMEOUT": timedelta(seconds=5),
+                "MAX_CONNECTIONS": 32,
+                "MAX_KEEPALIVE_CONNECTIONS": 8,
+                "KEEPALIVE_EXPIRY": timedelta(seconds=60),
+                "FAILURE_THRESHOLD": 5,
+                "RESET_TIMEOUT": timedelta(seconds=30),
+            },
+            "estimate": {
+                "METRIC": "haversine",  # or "manhattan"
+                "SPEED": 5.0,  # metres per second
+            },
+            "matrix_file": {
+                "MATRIX_PATH": env("OPTIRIDER_MATRIX_PATH"),
+                "COORDS_PATH": env("OPTIRIDER_MATRIX_COORDS_PATH"),
+            },
+        },
+    },
+    # How start day plans the trips of the riders: "iterative" (one trip of
+    # every rider at a time) or "single_model" (the whole day in one model,
+    # allowing EXTRA_TRIPS trips per rider more than needed). Requests may
+    # pick the engine.
+    "START_DAY_ENGINE": {
+        "DEFAULT": env("OPTIRIDER_START_DAY_ENGINE"),
+        "EXTRA_TRIPS": 1,
+    },
+    # Start day plans the orders due within HORIZON in the routing model. The
+    # orders due later (with penalties reduced by MISS_PENALTY_REDUCER) are
+    # left out of the matrix & the model, and only slotted into the room left
+    # in the plan, never making another order later.
+    "PLANNING_HORIZON": {
+        "ENABLED": env("OPTIRIDER_PLANNING_HORIZON"),
+        "HORIZON": timedelta(days=1),
+    },
+    # Time dependent durations: the free flow durations scaled by the factor of
+    # the time slot a trip starts in. Slots are (start, factor) pairs, by start.
+    # The per slot matrices are cached (memory mapped) per day.
+    "TIME_SLOTS": {
+        "ENABLED": env("OPTIRIDER_TIME_SLOTS"),
+        "CACHE_DIRECTORY": env("OPTIRIDER_TIME_SLOT_CACHE_DIR"),
+        "SLOTS": [
+            (timedelta(hours=0), 1.0),
+            (timedelta(hours=8), 1.3),  # Morning peak
+            (timedelta(hours=11), 1.0),
+            (timedelta(hours=17), 2.0),  # Evening peak
+            (timedelta(hours=21), 1.0),
+        ],
+        "DTYPE": "int32",
+    },
+    # Matrices prewarmed (`prewarm/`) ahead of the start day are fetched in the
+    # background, one at a time, in tiles between blocks of TILE_SIZE points,
+    # MAX_CONCURRENCY tables at once. They are cached for the day, and serve
+    # any request whose points they all hold. Prewarm requests are rejected
+    # while MAX_PENDING matrices are queued already.
+    "PREWARM": {
+        "CACHE_DIRECTORY": env("OPTIRIDER_PREWARM_CACHE_DIR"),
+        "TILE_SIZE": 256,
+        "MAX_CONCURRENCY": 4,
+        "MAX_PENDING": 16,
+        "DTYPE": "int32",
+    },
+    # Start planning on estimated durations while the OSRM table is fetched,
+    # then warm start the actual solve from the estimate-based plan.
+    "SPECULATIVE_START_DAY": {
+        "ENABLED": env("OPTIRIDER_SPECULATIVE_START_DAY"),
+        # Share of the runtime the estimate-based search may use at most.
+        "ESTIMATE_SHARE": 0.5,
+    },
+    # Admission control of solve requests, per server process
+    "ADMISSION": {
+        "MAX_CONCURRENT_SOLVES": env.int(
+            "OPTIRIDER_MAX_CONCURRENT_SOLVES", default=os.cpu_count() or 1
+        ),
+        # Solves predicted to run for HEAVY_SOLVE_TIME or more are heavy.
+        "MAX_HEAVY_SOLVES": env.int("OPTIRIDER_MAX_HEAVY_SOLVES", default=1),
+        "HEAVY_SOLVE_TIME": timedelta(seconds=30),
+        "MAX_QUEUE": 32,
+        "MAX_WAIT": timedelta(seconds=30),
+        # Model building cost, on top of the search time limits.
+        "SECONDS_PER_MILLION_ARCS": 2.0,
+        "PREDICTION_SMOOTHING": 0.2,
+    },
+    # City-wide start day over several depots in one routing model
+    "MULTI_DEPOT": {
+        # Orders may only be followed by their nearest NEIGHBOUR_LIMIT orders.
+        "NEIGHBOUR_LIMIT": 30,
+    },
+    # Add order requests with a `maxLatency` answer by then with the best plan
+    # found: the upcoming tours re-solve keeps UPCOMING_SHARE of the time, and
+    # no solve is started with less than MIN_SOLVE_TIME. Each new order is only
+    # offered to the SHORTLIST_SIZE riders whose current tours pass nearest to
+    # it (None for all riders).
+    "ADD_ORDER": {
+        "UPCOMING_SHARE": 0.5,
+        "MIN_SOLVE_TIME": timedelta(milliseconds=50),
+        "SHORTLIST_SIZE": 3,
+    },
+    # Once an add order request has inserted its orders, stops move between the
+    # current tours of riders (relocate, cross exchange of segments of up to
+    # MAX_SEGMENT_LENGTH stops, 2-opt*) for TIME_LIMIT at most. Each step
+    # evaluates the CANDIDATES moves of each kind saving the most travel time,
+    # out of all the moves it screens. Plans with more than MAX_SCREEN_SIZE
+    # moves to screen (some 45M are screened per second) are left as they are.
+    "EXCHANGE": {
+        "TIME_LIMIT": timedelta(milliseconds=100),
+        "MAX_SEGMENT_LENGTH": 2,
+        "CANDIDATES": 32,
+        "MAX_SCREEN_SIZE": 2_000_000,
+    },
+    # The plan made by an add / delete order request keeps being improved in
+    # the background (on the solver pool), for DURATION at most, in rounds of
+    # ROUND_TIME run while no request is being solved (checked every
+    # IDLE_WAIT). Each move plans the upcoming tours of up to NEIGHBOURHOOD_SIZE
+    # riders again, for MOVE_TIME at most. The next add / delete order request
+    # made on the very same plan, within TTL, picks the improved plan up. At
+    # most MAX_PLANS plans are kept, per server process.
+    "REOPTIMISATION": {
+        "ENABLED": env("OPTIRIDER_BACKGROUND_REOPTIMISATION"),
+        "DURATION": timedelta(minutes=30),
+        "ROUND_TIME": timedelta(seconds=5),
+        "MOVE_TIME": timedelta(seconds=1),
+        "NEIGHBOURHOOD_SIZE": 3,
+        "IDLE_WAIT": timedelta(seconds=1),
+        "TTL": timedelta(minutes=30),
+        "MAX_PLANS": 256,
+    },
+    # Rider progress updates (`progress/`) only shift the schedule, unless a
+    # stop gets later than planned by more than REPLAN_LATENESS.
+    "PROGRESS": {
+        "REPLAN_LATENESS": timedelta(minutes=10),
+    },
+    # Rider re-plans (`rider/`) plan the upcoming tours of the rider again for
+    # DEFAULT_RUNTIME at most, unless the request sets its own runtime.
+    "RIDER_REPLAN": {
+        "DEFAULT_RUNTIME": timedelta(seconds=10),
+    },
+    # Start day uploads (`startday/upload/`) fetch the matrix in tiles between
+    # blocks of TILE_SIZE points while their orders are read, and stop reading
+    # once MAX_ROW_ERRORS rows are invalid.
+    "START_DAY_UPLOAD": {
+        "TILE_SIZE": 256,
+        "MAX_ROW_ERRORS": 100,
+    },
+    # Solve views fetch their matrices from the event loop, then solve on a
+    # pool of SOLVE_THREADS threads, enough for every admitted & queued solve.
+    "ASYNC_VIEWS": {
+        "SOLVE_THREADS": env.int(
+            "OPTIRIDER_SOLVE_THREADS", default=(os.cpu_count() or 1) + 32
+        ),
+    },
+    # Process pool running solves in parallel (eg. batch startday)
+    "WORKERS": {
+        "MAX_PROCESSES": env.int(
+            "OPTIRIDER_SOLVER_PROCESSES", default=os.cpu_count() or 1
+        ),
+    },
+    # Matrices of problems over MIN_NODES nodes or more are handed to the
+    # solver processes as memory mapped files in DIRECTORY (RAM backed, where
+    # /dev/shm is available), rather than pickled into every task.
+    "SHARED_MATRICES": {
+        "DIRECTORY": env("OPTIRIDER_SHARED_MATRIX_DIR"),
+        "MIN_NODES": 200,
+        "DTYPE": "int32",
+    },
+    # Opt-in, staff-only profiling of single solve requests
+    "PROFILING": {
+        "DIRECTORY": env("OPTIRIDER_PROFILE_DIR"),
+        "HEADER": "X-Optirider-Profile",
+        "QUERY_PARAM": "profile",
+    },
+    # Append-only log of solve traffic, replayed by `manage.py replay_solves`
+    "RECORDING": {
+        "ENABLED": env("OPTIRIDER_RECORD_SOLVES"),
+        "DIRECTORY": env("OPTIRIDER_RECORDING_DIR"),
+    },
 }
@@ -0,0 +1,256 @@
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import lru_cache
+from django.conf import settings
+from rest_framework.exceptions import APIException
+
+from optirider.constants import DEFAULT_TIME_LIMIT
+from optirider.add_multiple_pickup import (
+    single_vehicle_vrp_default_runtime,
+    upcoming_tour_runtime,
+)
+
+# Lanes are served in this order, a lane is admitted only while the lanes
+# before it have nobody waiting.
+LANES = ["progress", "rider", "delorder", "addorder", "startday"]
+
+
+class ServiceSaturated(APIException):
+    status_code = 503
+    default_detail = "The solver is saturated, try again later."
+    default_code = "service_saturated"
+
+    def __init__(self, wait, detail=None, code=None):
+        super().__init__(detail, code)
+        # Sent as the `Retry-After` header by the DRF exception handler.
+        self.wait = wait
+
+
+def solve_size(validated_data):
+    """Returns the number of nodes, riders & the runtime of a solve request."""
+    # A batch request is as large as all its problems together.
+    problems = validated_data.get("problems", [validated_data])
+    num_nodes = 0
+    num_riders = 0
+    for problem in problems:
+        num_nodes += 1 + len(problem.get("orders", []))
+        num_nodes += len(problem.get("newOrders", []))
+        num_riders += len(problem.get("riders", []))
+    # Progress updates have no runtime, they seldom solve.
+    runtime = validated_data.get("runtime", timedelta()).total_seconds()
+    return num_nodes, num_riders, runtime
+
+
+def runtime_upper_bound(lane, num_nodes, num_riders, runtime, max_latency=None):
+    """Time limits the solver will run for, at most, on a request.
+
+    Building the model costs time quadratic in the number of nodes on top of
+    the search time limits. Requests with a max latency are answered by then.
+    """
+    upper_bound = _runtime_upper_bound(lane, num_nodes, num_riders, runtime)
+    if max_latency is not None:
+        return min(upper_bound, max_latency)
+    return upper_bound
+
+
+def _runtime_upper_bound(lane, num_nodes, num_riders, runtime):
+    admission_settings = settings.OPTIRIDER_SETTINGS["ADMISSION"]
+    model_time = admission_settings["SECONDS_PER_MILLION_ARCS"] * num_nodes**2 / 1e6
+    if lane == "startday":
+        return runtime + model_time
+    if lane == "progress":
+        # At most the ongoing tour of a rider is re-sequenced.
+        return single_vehicle_vrp_default_runtime + model_time
+    if lane == "rider":
+        # Only the orders of the rider are solved over, at most all of them.
+        return single_vehicle_vrp_default_runtime + runtime + model_time
+    if lane == "addorder":
+        return (
+            num_riders * single_vehicle_vrp_default_runtime
+            + upcoming_tour_runtime
+            + model_time
+        )
+    # Deleting a pickup outside current tours re-plans upcoming tours.
+    return DEFAULT_TIME_LIMIT + model_time
+
+
+class RuntimePredictor:
+    """Predicts the runtime of a request from its time limits.
+
+    The solver often stops well before its time limits, so the ratio between
+    the observed runtime and the upper bound is learnt per lane, as an
+    exponential moving average.
+    """
+
+    def __init__(self, smoothing):
+        self.smoothing = smoothing
+        self.ratio = {lane: 1.0 for lane in LANES}
+
+    def predict(self, lane, upper_bound):
+        return upper_bound * self.ratio[lane]
+
+    def observe(self, lane, upper_bound, elapsed):
+        if upper_bound <= 0:
+            return
+        observed_ratio = min(1.0, elapsed / upper_bound)
+        self.ratio[lane] += self.smoothing * (observed_ratio - self.ratio[lane])
+
+
+class AdmissionController:
+    """Admits solve requests of this process in priority order.
+
+    At most `max_concurrent` solves run at once, of which at most `max_heavy`
+    may be heavy (predicted to run for `heavy_seconds` or more). Requests wait
+    for their turn up to `max_wait` seconds, and are rejected straight away
+    when `max_queue` requests are already waiting.
+    """
+
+    def __init__(
+        self, max_concurrent, max_heavy, heavy_seconds, max_queue, max_wait, smoothing
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_heavy = max_heavy
+        self.heavy_seconds = heavy_seconds
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.predictor = RuntimePredictor(smoothing)
+
+        self._condition = threading.Condition()
+        self._queues = {lane: deque() for lane in LANES}
+        # Expected end time of each running solve, keyed by its ticket.
+        self._running = {}
+        self._running_heavy = 0
+        self._stats = {
+            lane: {"admitted": 0, "rejected": 0, "totalWait": 0.0, "maxWait": 0.0}
+            for lane in LANES
+        }
+
+    def _can_run(self, lane, ticket, heavy):
+        if self._queues[lane][0] is not ticket:
+            return False
+        for other_lane in LANES[: LANES.index(lane)]:
+            if self._queues[other_lane]:
+                return False
+        if len(self._running) >= self.max_concurrent:
+            return False
+        return not heavy or self._running_heavy < self.max_heavy
+
+    def _retry_after(self):
+        if not self._running:
+            return 1
+        return max(1, math.ceil(min(self._running.values()) - time.monotonic()))
+
+    def _reject(self, lane):
+        self._stats[lane]["rejected"] += 1
+        raise ServiceSaturated(wait=self._retry_after())
+
+    def check_queue(self, lane):
+        """Rejects a request straight away when the queue is full already, eg.
+        before fetching its matrix."""
+        with self._condition:
+            if sum(len(queue) for queue in self._queues.values()) >= self.max_queue:
+                self._reject(lane)
+
+    @contextmanager
+    def admit(self, lane, num_nodes, num_riders, runtime, max_latency=None):
+        upper_bound = runtime_upper_bound(
+            lane, num_nodes, num_riders, runtime, max_latency
+        )
+        predicted = self.predictor.predict(lane, upper_bound)
+        heavy = predicted >= self.heavy_seconds
+        ticket = object()
+
+        with self._condition:
+            if sum(len(queue) for queue in self._queues.values()) >= self.max_queue:
+                self._reject(lane)
+
+            queued_at = time.monotonic()
+            deadline = queued_at + self.max_wait
+            self._queues[lane].append(ticket)
+            try:
+                while not self._can_run(lane, ticket, heavy):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject(lane)
+                    self._condition.wait(remaining)
+            finally:
+                self._queues[lane].remove(ticket)
+                # Lanes behind this one may be able to go now.
+                self._condition.notify_all()
+
+            started_at = time.monotonic()
+            wait = started_at - queued_at
+            self._running[ticket] = started_at + predicted
+            self._running_heavy += heavy
+            stats = self._stats[lane]
+            stats["admitted"] += 1
+            stats["totalWait"] += wait
+            stats["maxWait"] = max(stats["maxWait"], wait)
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                del self._running[ticket]
+                self._running_heavy -= heavy
+                self.predictor.observe(lane, upper_bound, time.monotonic() - started_at)
+                self._condition.notify_all()
+
+    def busy(self):
+        """Whether any solve is running or waiting."""
+        with self._condition:
+            return len(self._running) > 0 or any(self._queues.values())
+
+    def metrics(self):
+        with self._condition:
+            return {
+                "running": len(self._running),
+                "runningHeavy": self._running_heavy,
+                "lanes": {
+                    lane: {
+                        "queueDepth": len(self._queues[lane]),
+                        "admitted": stats["admitted"],
+                        "rejected": stats["rejected"],
+                        "averageWait": stats["totalWait"] / max(1, stats["admitted"]),
+                        "maxWait": stats["maxWait"],
+                        "runtimeRatio": self.predictor.ratio[lane],
+                    }
+                    for lane, stats in self._stats.items()
+                },
+            }
+
+
+@lru_cache(maxsize=None)
+def get_admission_controller():
+    admission_settings = settings.OPTIRIDER_SETTINGS["ADMISSION"]
+    return AdmissionController(
+        max_concurrent=admission_settings["MAX_CONCURRENT_SOLVES"],
+        max_heavy=admission_settings["MAX_HEAVY_SOLVES"],
+        heavy_seconds=admission_settings["HEAVY_SOLVE_TIME"].total_seconds(),
+        max_queue=admission_settings["MAX_QUEUE"],
+        max_wait=admission_settings["MAX_WAIT"].total_seconds(),
+        smoothing=admission_settings["PREDICTION_SMOOTHING"],
+    )
+
+
+class AdmissionControlMixin:
+    """Runs the solve only once the admission controller lets it through."""
+
+    lane = None
+
+    def check_admission(self):
+        get_admission_controller().check_queue(self.lane)
+
+    def perform_create(self, serializer):
+        num_nodes, num_riders, runtime = solve_size(serializer.validated_data)
+        max_latency = serializer.validated_data.get("maxLatency")
+        if max_latency is not None:
+            max_latency = max_latency.total_seconds()
+        with get_admission_controller().admit(
+            self.lane, num_nodes, num_riders, runtime, max_latency
+        ):
+            serializer.save()
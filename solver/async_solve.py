@@ -0,0 +1,148 @@
+import asyncio
+import cProfile
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import lru_cache
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from rest_framework import status
+from rest_framework.response import Response
+
+from optirider.services import (
+    get_time_slot_cache,
+    matrices_provided,
+    prefetch_distance_matrices,
+    prefetched_matrices,
+)
+from solver.models import Point, speculative_start_day_enabled, split_by_horizon
+from solver.profiling import PROFILE_ID_HEADER, profiling_requested, save_profile
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def get_solve_executor():
+    """Threads (shared by the whole server process) the async views solve on.
+
+    Solves waiting for their turn in the admission controller hold a thread as
+    well, so there should be enough for all admitted & queued solves.
+    """
+    return ThreadPoolExecutor(
+        max_workers=settings.OPTIRIDER_SETTINGS["ASYNC_VIEWS"]["SOLVE_THREADS"],
+        thread_name_prefix="solve",
+    )
+
+
+def get_points(depots, orders):
+    """Points of the matrix a solve fetches, from its validated data: the
+    depots first, then the orders."""
+    return [Point(**location["point"]) for location in list(depots) + list(orders)]
+
+
+def start_day_points(problem):
+    """Points of a start day problem, the orders beyond the planning horizon
+    left out, unless the time slot matrices of its points are cached already
+    (the free flow matrix is then not fetched), or the start day is speculative
+    (the matrix is then fetched while the estimate-based plan is solved)."""
+    if speculative_start_day_enabled():
+        return None
+    orders, _ = split_by_horizon(
+        problem["orders"], expected_time=lambda order: order["expectedTime"]
+    )
+    points = get_points([problem["depot"]], orders)
+    if (
+        settings.OPTIRIDER_SETTINGS["TIME_SLOTS"]["ENABLED"]
+        and get_time_slot_cache().load(points) is not None
+    ):
+        return None
+    return points
+
+
+class AsyncSolveMixin:
+    """Serves solve requests from the event loop.
+
+    The duration matrices of the request are fetched with the asyncio distance
+    client, holding no thread while OSRM answers. Only then is the solve run,
+    through the admission controller, on the solve executor, so that one server
+    process can have many requests waiting on OSRM at once. Staff users may ask
+    for the solve to be profiled, as with `ProfiledSolveMixin`.
+    """
+
+    def matrix_points(self, validated_data):
+        """Point sets of the matrices to fetch before the solve (None for those
+        the solve fetches itself)."""
+        return []
+
+    async def dispatch(self, request, *args, **kwargs):
+        """`APIView.dispatch`, awaiting the handler. Authentication, permission
+        & throttle checks run on a thread, as they may query the database."""
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(
+                    self, request.method.lower(), self.http_method_not_allowed
+                )
+            else:
+                handler = self.http_method_not_allowed
+            response = handler(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    async def post(self, request, *args, **kwargs):
+        serializer = await sync_to_async(self.validate, thread_sensitive=False)(request)
+        # Requests bound to be rejected fetch no matrix.
+        self.check_admission()
+        matrices = {}
+        points_list = [
+            points
+            for points in self.matrix_points(serializer.validated_data)
+            if points is not None
+        ]
+        # Replays provide the matrices the solve was recorded with.
+        if len(points_list) > 0 and not matrices_provided():
+            matrices = await prefetch_distance_matrices(points_list)
+        return await self.solve_response(request, serializer, matrices)
+
+    async def solve_response(self, request, serializer, matrices):
+        """Solves on the executor, once the matrices are fetched."""
+        profiler = cProfile.Profile() if profiling_requested(request) else None
+        data = await asyncio.get_running_loop().run_in_executor(
+            get_solve_executor(),
+            copy_context().run,
+            self.solve,
+            serializer,
+            matrices,
+            profiler,
+        )
+
+        headers = self.get_success_headers(data)
+        if profiler is not None:
+            artifact_id = save_profile(profiler)
+            logger.info("Stored solve profile " + artifact_id)
+            headers[PROFILE_ID_HEADER] = artifact_id
+        return Response(data, status=status.HTTP_201_CREATED, headers=headers)
+
+    def validate(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return serializer
+
+    def solve(self, serializer, matrices, profiler=None):
+        """Solves the request & renders its response data, on the executor."""
+        if profiler is not None:
+            return profiler.runcall(self.solve, serializer, matrices)
+        with prefetched_matrices(matrices):
+            self.perform_create(serializer)
+            return serializer.data
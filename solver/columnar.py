@@ -0,0 +1,364 @@
+from datetime import timedelta
+import numpy as np
+from django.conf import settings
+from rest_framework import serializers
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
+
+# Columnar wire format of the solve requests & responses, an alternative to the
+# default JSON objects. Lists of orders & riders are laid out as one array per
+# attribute, durations are integer seconds, and the tours of the riders are
+# arrays of nodes (0 for the depot, i + 1 for the i-th order of the plan: the
+# orders of the request, then its new orders) split by offset arrays:
+#
+#   orders: {id, orderType, longitude, latitude, expectedTime, volume,
+#            serviceTime}
+#   riders: {id, capacity, startTime | headingTo, tourOffsets, stopOffsets,
+#            stops, timings}
+#
+# Rider r does the tours tourOffsets[r]:tourOffsets[r + 1], and tour t visits
+# stops[stopOffsets[t]:stopOffsets[t + 1]], `timings` being the time from the
+# previous stop (the time itself for the first stop). The arrays are validated
+# with NumPy, rather than one field at a time. All other fields are as in JSON.
+
+COLUMNAR_MEDIA_TYPE = "application/vnd.optirider.columnar+json"
+
+DEFAULT_START_TIME = settings.OPTIRIDER_SETTINGS["CONSTANTS"]["GLOBAL_START_TIME"]
+ORDER_TYPES = ["delivery", "pickup"]
+
+
+class ColumnarParser(JSONParser):
+    media_type = COLUMNAR_MEDIA_TYPE
+
+
+class ColumnarRenderer(JSONRenderer):
+    media_type = COLUMNAR_MEDIA_TYPE
+    format = "columnar"
+
+
+def columnar_request(request):
+    return request is not None and request.content_type.split(";")[0].strip() == (
+        COLUMNAR_MEDIA_TYPE
+    )
+
+
+def columnar_response(request):
+    return isinstance(getattr(request, "accepted_renderer", None), ColumnarRenderer)
+
+
+def to_seconds(durations):
+    return [int(round(duration.total_seconds())) for duration in durations]
+
+
+class ColumnsField(serializers.Field):
+    """A list of objects, as one array per attribute."""
+
+    default_error_messages = {
+        "invalid": "Expected an object of arrays.",
+        "required": "This field is required.",
+        "not_a_list": "Expected a list of values.",
+        "wrong_length": "Expected a list of {length} values.",
+        "invalid_values": "Expected {kind} values.",
+        "min_value": "Ensure all values are greater than or equal to {min_value}.",
+        "max_value": "Ensure all values are less than or equal to {max_value}.",
+        "invalid_choice": "Expected values among {choices}.",
+        "invalid_offsets": "Expected non decreasing offsets, from 0.",
+    }
+
+    def column_error(self, name, key, **kwargs):
+        return serializers.ValidationError(
+            {name: [self.error_messages[key].format(**kwargs)]}
+        )
+
+    def get_list(self, data, name, length=None, default=None):
+        """The column `name`, of `length` values (any number, if None), or
+        `default` for each row when missing (required, if None)."""
+        if name not in data:
+            if default is None:
+                raise self.column_error(name, "required")
+            return [default] * length
+        values = data[name]
+        if not isinstance(values, list):
+            raise self.column_error(name, "not_a_list")
+        if length is not None and len(values) != length:
+            raise self.column_error(name, "wrong_length", length=length)
+        return values
+
+    def get_strings(self, data, name, length=None, allow_null=False):
+        if allow_null and name not in data:
+            return [None] * length
+        values = self.get_list(data, name, length)
+        for value in values:
+            if not isinstance(value, str) and not (allow_null and value is None):
+                raise self.column_error(name, "invalid_values", kind="string")
+        return values
+
+    def get_numbers(
+        self,
+        data,
+        name,
+        length=None,
+        integer=True,
+        min_value=None,
+        max_value=None,
+        default=None,
+    ):
+        kind = "integer" if integer else "number"
+        try:
+            values = np.asarray(self.get_list(data, name, length, default))
+        except (ValueError, TypeError):
+            # Eg. ragged nested lists.
+            raise self.column_error(name, "invalid_values", kind=kind)
+        kinds = "iu" if integer else "iuf"
+        if values.ndim != 1 or (len(values) > 0 and values.dtype.kind not in kinds):
+            raise self.column_error(name, "invalid_values", kind=kind)
+        if min_value is not None and (values < min_value).any():
+            raise self.column_error(name, "min_value", min_value=min_value)
+        if max_value is not None and (values > max_value).any():
+            raise self.column_error(name, "max_value", max_value=max_value)
+        return values
+
+    def get_offsets(self, data, name, length):
+        """Offsets of `length` groups of values, into the array of values."""
+        offsets = self.get_numbers(data, name, length + 1)
+        if offsets[0] != 0 or (np.diff(offsets) < 0).any():
+            raise self.column_error(name, "invalid_offsets")
+        return offsets
+
+    def to_internal_value(self, data):
+        if not isinstance(data, dict):
+            self.fail("invalid")
+        return self.decode(data)
+
+
+class OrderColumnsField(ColumnsField):
+    def decode(self, data):
+        ids = self.get_strings(data, "id")
+        length = len(ids)
+        order_types = self.get_strings(data, "orderType", length)
+        if not set(order_types) <= set(ORDER_TYPES):
+            raise self.column_error("orderType", "invalid_choice", choices=ORDER_TYPES)
+        longitudes = self.get_numbers(
+            data, "longitude", length, integer=False, min_value=-180, max_value=180
+        )
+        latitudes = self.get_numbers(
+            data, "latitude", length, integer=False, min_value=-90, max_value=90
+        )
+        expected_times = self.get_numbers(data, "expectedTime", length, min_value=0)
+        volumes = self.get_numbers(data, "volume", length, min_value=0)
+        service_times = self.get_numbers(
+            data, "serviceTime", length, min_value=0, default=0
+        )
+        return [
+            {
+                "id": id,
+                "orderType": order_type,
+                "point": {"longitude": longitude, "latitude": latitude},
+                "expectedTime": timedelta(seconds=expected_time),
+                "package": {"volume": volume},
+                "serviceTime": timedelta(seconds=service_time),
+            }
+            for id, order_type, longitude, latitude, expected_time, volume, service_time in zip(
+                ids,
+                order_types,
+                longitudes.tolist(),
+                latitudes.tolist(),
+                expected_times.tolist(),
+                volumes.tolist(),
+                service_times.tolist(),
+            )
+        ]
+
+    def to_representation(self, orders):
+        return {
+            "id": [order.id for order in orders],
+            "orderType": [order.orderType for order in orders],
+            "longitude": [order.point.longitude for order in orders],
+            "latitude": [order.point.latitude for order in orders],
+            "expectedTime": to_seconds(order.expectedTime for order in orders),
+            "volume": [order.package.volume for order in orders],
+            "serviceTime": to_seconds(order.serviceTime for order in orders),
+        }
+
+
+class RiderColumnsField(ColumnsField):
+    """Riders, and the tours they are given (or which are planned for them)."""
+
+    def decode_tours(self, data, num_riders):
+        """Tours of each rider, as lists of stops."""
+        node_ids = getattr(self.parent, "node_ids", None)
+        if node_ids is None:
+            raise self.column_error("stops", "invalid_values", kind="known node")
+        tour_offsets = self.get_offsets(data, "tourOffsets", num_riders)
+        stop_offsets = self.get_offsets(data, "stopOffsets", int(tour_offsets[-1]))
+        num_stops = int(stop_offsets[-1])
+        stops = self.get_numbers(
+            data, "stops", num_stops, min_value=0, max_value=len(node_ids) - 1
+        )
+        timings = self.get_numbers(data, "timings", num_stops, min_value=0)
+
+        order_ids = [node_ids[node] for node in stops.tolist()]
+        timings = [timedelta(seconds=timing) for timing in timings.tolist()]
+        stop_offsets = stop_offsets.tolist()
+        tours = [
+            [
+                {"orderId": order_id, "timing": timing}
+                for order_id, timing in zip(
+                    order_ids[stop_offsets[tour] : stop_offsets[tour + 1]],
+                    timings[stop_offsets[tour] : stop_offsets[tour + 1]],
+                )
+            ]
+            for tour in range(len(stop_offsets) - 1)
+        ]
+        tour_offsets = tour_offsets.tolist()
+        return [
+            tours[tour_offsets[rider] : tour_offsets[rider + 1]]
+            for rider in range(num_riders)
+        ]
+
+    def encode_tours(self, riders):
+        node_index = self.parent.node_index
+        tour_offsets = [0]
+        stop_offsets = [0]
+        stops = []
+        timings = []
+        for rider in riders:
+            for tour in rider.tours:
+                stops.extend(node_index[stop.orderId] for stop in tour)
+                timings.extend(to_seconds(stop.timing for stop in tour))
+                stop_offsets.append(len(stops))
+            tour_offsets.append(len(stop_offsets) - 1)
+        return {
+            "tourOffsets": tour_offsets,
+            "stopOffsets": stop_offsets,
+            "stops": stops,
+            "timings": timings,
+        }
+
+
+class RiderStartColumnsField(RiderColumnsField):
+    def decode(self, data):
+        ids = self.get_strings(data, "id")
+        length = len(ids)
+        capacities = self.get_numbers(data, "capacity", length, min_value=0)
+        start_times = self.get_numbers(
+            data,
+            "startTime",
+            length,
+            min_value=0,
+            default=int(DEFAULT_START_TIME.total_seconds()),
+        )
+        return [
+            {
+                "id": id,
+                "vehicle": {"capacity": capacity},
+                "startTime": timedelta(seconds=start_time),
+            }
+            for id, capacity, start_time in zip(
+                ids, capacities.tolist(), start_times.tolist()
+            )
+        ]
+
+    def to_representation(self, riders):
+        return {
+            "id": [rider.id for rider in riders],
+            "capacity": [rider.vehicle.capacity for rider in riders],
+            "startTime": to_seconds(rider.startTime for rider in riders),
+            **self.encode_tours(riders),
+        }
+
+
+class RiderUpdateColumnsField(RiderColumnsField):
+    def decode(self, data):
+        ids = self.get_strings(data, "id")
+        length = len(ids)
+        capacities = self.get_numbers(data, "capacity", length, min_value=0)
+        heading_to = self.get_strings(data, "headingTo", length, allow_null=True)
+        tours = self.decode_tours(data, length)
+        return [
+            {
+                "id": id,
+                "vehicle": {"capacity": capacity},
+                "tours": rider_tours,
+                "headingTo": rider_heading_to,
+            }
+            for id, capacity, rider_tours, rider_heading_to in zip(
+                ids, capacities.tolist(), tours, heading_to
+            )
+        ]
+
+    def to_representation(self, riders):
+        return {
+            "id": [rider.id for rider in riders],
+            "capacity": [rider.vehicle.capacity for rider in riders],
+            "headingTo": [rider.headingTo for rider in riders],
+            "updatedCurrentTour": [rider.updatedCurrentTour for rider in riders],
+            **self.encode_tours(riders),
+        }
+
+
+class ColumnarSerializerMixin:
+    """Serializes the lists of orders & riders in the columnar format, for
+    requests sent in it. Responses are in the format the client accepts.
+
+    :cvar columnar_fields: Columns field class of each list field.
+    """
+
+    columnar_fields = {}
+
+    @property
+    def columnar(self):
+        if "columnar" in self.context:
+            return self.context["columnar"]
+        return columnar_request(self.context.get("request"))
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if self.columnar:
+            for name, field_class in self.columnar_fields.items():
+                field = fields[name]
+                fields[name] = field_class(
+                    read_only=field.read_only,
+                    write_only=field.write_only,
+                    required=field.required,
+                )
+        return fields
+
+    def to_internal_value(self, data):
+        if self.columnar:
+            # Tours refer to the depot & orders by node index.
+            try:
+                self.node_ids = [data["depot"]["id"]] + list(data["orders"]["id"])
+            except (KeyError, TypeError):
+                self.node_ids = None
+        return super().to_internal_value(data)
+
+    def to_representation(self, instance):
+        columnar = columnar_response(self.context.get("request"))
+        if columnar != self.columnar:
+            return type(self)(
+                instance, context=dict(self.context, columnar=columnar)
+            ).data
+        if columnar:
+            self.node_index = {instance.depot.id: 0}
+            for order_index, order in enumerate(instance.orders):
+                self.node_index[order.id] = order_index + 1
+        return super().to_representation(instance)
+
+
+class ColumnarViewMixin:
+    """Accepts & renders the columnar format, besides the defaults. Requests
+    in the columnar format are answered in it, unless the client asks for
+    another format."""
+
+    parser_classes = [*api_settings.DEFAULT_PARSER_CLASSES, ColumnarParser]
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, ColumnarRenderer]
+
+    def perform_content_negotiation(self, request, force=False):
+        if columnar_request(request) and request.META.get("HTTP_ACCEPT", "*/*") in (
+            "",
+            "*/*",
+        ):
+            return ColumnarRenderer(), COLUMNAR_MEDIA_TYPE
+        return super().perform_content_negotiation(request, force)
@@ -0,0 +1,139 @@
+import random
+import time
+from django.core.management.base import BaseCommand
+
+from optirider import evaluation
+from optirider.services import get_distance_provider
+from solver import recording
+from solver.models import START_DAY_ENGINES, StartDayMeta, get_start_day_engine
+from solver.serializers import StartDaySerializer
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the start day engines on recorded start day requests, or on "
+        "random instances (estimated durations), for objective & wall-clock."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--directory",
+            help="Recording directory to take the start day requests from.",
+        )
+        parser.add_argument(
+            "--limit", type=int, help="Benchmark at most this many requests."
+        )
+        parser.add_argument(
+            "--instances", type=int, default=3, help="Number of random instances."
+        )
+        parser.add_argument("--orders", type=int, default=200)
+        parser.add_argument("--riders", type=int, default=10)
+        parser.add_argument("--capacity", type=int, default=40)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--runtime", type=int, help="Time limit (seconds) of each solve."
+        )
+        parser.add_argument(
+            "--engine",
+            action="append",
+            choices=list(START_DAY_ENGINES),
+            help="Engine to benchmark (all engines by default).",
+        )
+
+    def handle(self, *args, **options):
+        engines = options["engine"] or list(START_DAY_ENGINES)
+        if options["directory"]:
+            instances = self.recorded_instances(options)
+        else:
+            instances = self.random_instances(options)
+
+        totals = {engine: {"penalty": 0, "elapsed": 0.0} for engine in engines}
+        for name, problem, time_matrix in instances:
+            runtime = options["runtime"] or int(problem.runtime.total_seconds())
+            for engine in engines:
+                data, penalty = problem.get_data()
+                data["time_matrix"] = time_matrix
+
+                start = time.perf_counter()
+                tours, timings, _ = get_start_day_engine(engine)(
+                    data, penalty, time_to_limit=runtime
+                )
+                elapsed = time.perf_counter() - start
+
+                plan = evaluation.flatten_plan(tours, timings)
+                plan_penalty = evaluation.plan_penalty(plan, data)
+                missed = len(evaluation.missed_orders(plan, data["num_locations"]))
+                violations = sum(
+                    len(tour_ids)
+                    for tour_ids in evaluation.check_plan(plan, data).values()
+                )
+                self.stdout.write(
+                    f"{name} {engine}: penalty {plan_penalty}, "
+                    f"{elapsed:.3f}s, {plan.num_tours} trips, {missed} missed, "
+                    f"{violations} constraint violations"
+                )
+                totals[engine]["penalty"] += plan_penalty
+                totals[engine]["elapsed"] += elapsed
+
+        for engine, total in totals.items():
+            self.stdout.write(
+                f"{engine}: total penalty {total['penalty']}, "
+                f"total {total['elapsed']:.3f}s"
+            )
+
+    def recorded_instances(self, options):
+        solve_log = recording.SolveLog(options["directory"])
+        count = 0
+        for record in solve_log:
+            if options["limit"] is not None and count >= options["limit"]:
+                break
+            if not record["path"].endswith("/startday/"):
+                continue
+            serializer = StartDaySerializer(data=record["request"])
+            if not serializer.is_valid():
+                self.stderr.write(
+                    f"{record['id']}: request no longer valid: {serializer.errors}"
+                )
+                continue
+            problem = StartDayMeta(**serializer.validated_data, solve=False)
+            # The last matrix is the one the solve ran on.
+            yield record["id"], problem, solve_log.load_matrices(record)[-1]
+            count += 1
+
+    def random_instances(self, options):
+        rng = random.Random(options["seed"])
+
+        def point():
+            return {
+                "longitude": 77.55 + rng.random() * 0.15,
+                "latitude": 12.9 + rng.random() * 0.15,
+            }
+
+        for instance in range(options["instances"]):
+            request = {
+                "riders": [
+                    {
+                        "id": f"rider-{rider}",
+                        "vehicle": {"capacity": options["capacity"]},
+                    }
+                    for rider in range(options["riders"])
+                ],
+                "orders": [
+                    {
+                        "id": f"order-{order}",
+                        "orderType": "delivery",
+                        "point": point(),
+                        "expectedTime": f"{rng.randint(10, 20)}:00:00",
+                        "package": {"volume": rng.randint(1, 5)},
+                        "serviceTime": "00:02:00",
+                    }
+                    for order in range(options["orders"])
+                ],
+                "depot": {"id": "depot", "point": point()},
+            }
+            serializer = StartDaySerializer(data=request)
+            serializer.is_valid(raise_exception=True)
+            problem = StartDayMeta(**serializer.validated_data, solve=False)
+            points = [problem.depot.point] + [order.point for order in problem.orders]
+            time_matrix = get_distance_provider("estimate").fetch(points)
+            yield f"random-{instance}", problem, time_matrix
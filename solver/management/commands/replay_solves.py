@@ -0,0 +1,103 @@
+import time
+from django.core.management.base import BaseCommand
+from django.urls import resolve
+
+from optirider.services import provided_matrices
+from solver import recording
+from solver.models import DELTA_RESPONSE, FULL_RESPONSE
+
+# Lanes which fetch the matrix over the orders of the requested rider alone,
+# so only that rider can be evaluated on it.
+SINGLE_RIDER_LANES = {"progress", "rider"}
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-runs recorded solve requests offline, serving the recorded OSRM "
+        "matrices, and compares latency & objective against the recording."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--directory",
+            help="Recording directory (defaults to the RECORDING setting).",
+        )
+        parser.add_argument(
+            "--limit", type=int, help="Replay at most this many requests."
+        )
+        parser.add_argument(
+            "--path", help="Only replay requests made to this route path."
+        )
+
+    def handle(self, *args, **options):
+        solve_log = recording.SolveLog(options["directory"])
+        replayed = 0
+        total_recorded_latency = 0.0
+        total_replayed_latency = 0.0
+        regressions = 0
+
+        for record in solve_log:
+            if options["limit"] is not None and replayed >= options["limit"]:
+                break
+            if options["path"] and record["path"] != options["path"]:
+                continue
+
+            view_class = resolve(record["path"]).func.view_class
+            serializer_class = view_class.serializer_class
+            matrices = solve_log.load_matrices(record)
+
+            with provided_matrices(matrices):
+                start = time.perf_counter()
+                # Replies are evaluated on the whole plan.
+                serializer = serializer_class(
+                    data=dict(record["request"], responseFormat=FULL_RESPONSE),
+                    context={"columnar": record.get("requestColumnar", False)},
+                )
+                if not serializer.is_valid():
+                    self.stderr.write(
+                        f"{record['id']}: request no longer valid: {serializer.errors}"
+                    )
+                    continue
+                # Validated data holds the riders as dicts in either format.
+                request = serializer.validated_data
+                serializer.save()
+                response = serializer.data
+                latency = time.perf_counter() - start
+
+            recorded_response = record["response"]
+            if view_class.lane in SINGLE_RIDER_LANES:
+                response = recording.rider_payload(response, request)
+                recorded_response = recording.rider_payload(recorded_response, request)
+
+            # Requests which solved nothing (eg. deleting an unknown order)
+            # fetched no matrix to evaluate them on.
+            replayed_penalty = recording.response_penalty(response, matrices)
+            recorded_penalty = None
+            # Delta responses do not hold the whole plan, and columnar ones are
+            # not evaluated.
+            whole_plan = record["request"].get("responseFormat") != DELTA_RESPONSE
+            if (
+                replayed_penalty is not None
+                and whole_plan
+                and not record.get("responseColumnar", False)
+            ):
+                recorded_penalty = recording.response_penalty(
+                    recorded_response, matrices
+                )
+                if replayed_penalty > recorded_penalty:
+                    regressions += 1
+
+            self.stdout.write(
+                f"{record['id']} {record['path']} "
+                f"latency {record['latency']:.3f}s -> {latency:.3f}s, "
+                f"penalty {recorded_penalty} -> {replayed_penalty}"
+            )
+            replayed += 1
+            total_recorded_latency += record["latency"]
+            total_replayed_latency += latency
+
+        self.stdout.write(
+            f"Replayed {replayed} requests, "
+            f"latency {total_recorded_latency:.3f}s -> {total_replayed_latency:.3f}s, "
+            f"{regressions} with a worse objective"
+        )
@@ -0,0 +1,66 @@
+import json
+import logging
+import time
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.urls import Resolver404, resolve
+
+from solver import recording
+from solver.columnar import COLUMNAR_MEDIA_TYPE
+
+logger = logging.getLogger(__name__)
+
+
+class SolveRecordingMiddleware:
+    """Records requests to the `solver.urls` routes into the solve log.
+
+    Only JSON requests which passed validation (2xx responses) are recorded. The
+    middleware is dropped at startup when recording is disabled.
+    """
+
+    def __init__(self, get_response):
+        if not settings.OPTIRIDER_SETTINGS["RECORDING"]["ENABLED"]:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.solve_log = recording.SolveLog()
+
+    def __call__(self, request):
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return self.get_response(request)
+        if match.app_name != "solver" or request.method != "POST":
+            return self.get_response(request)
+        # Only solves (views with an admission lane) are replayed.
+        if getattr(getattr(match.func, "view_class", None), "lane", None) is None:
+            return self.get_response(request)
+        # Uploads (eg. CSV orders) are read by the view as they stream in.
+        if request.content_type not in ("application/json", COLUMNAR_MEDIA_TYPE):
+            return self.get_response(request)
+
+        # Read the body before the view consumes the request stream.
+        body = request.body
+        token = recording.start_recording()
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            latency = time.perf_counter() - start
+            matrices = recording.stop_recording(token)
+
+        if 200 <= response.status_code < 300:
+            try:
+                self.solve_log.append(
+                    request.path_info,
+                    json.loads(body),
+                    json.loads(response.content),
+                    latency,
+                    matrices,
+                    request_columnar=request.content_type == COLUMNAR_MEDIA_TYPE,
+                    response_columnar=response.get("Content-Type", "").startswith(
+                        COLUMNAR_MEDIA_TYPE
+                    ),
+                )
+            except (ValueError, OSError):
+                logger.exception("Could not record solve request")
+        return response
@@ -1,12 +1,52 @@
+import math
+import time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 from datetime import timedelta
 from django.conf import settings
 import numpy as np
 from ortools.constraint_solver import routing_enums_pb2
-from optirider.constants import MIN_MISS_PENALTY
-from optirider.services import fetch_distance_matrix
+from optirider import evaluation
+from optirider.constants import MIN_MISS_PENALTY, MISS_PENALTY
+from optirider.services import (
+    fetch_distance_matrix,
+    fetch_distance_matrices,
+    fetch_time_dependent_matrices,
+    get_distance_provider,
+    get_matrix_prewarmer,
+    get_time_slot_cache,
+)
 from optirider.start_day import start_day
+from optirider.multi_trip import start_day_single_model
 from optirider.add_multiple_pickup import add_pickup
 from optirider.delete_pickup import delete_pickup
+from optirider import horizon, improvement, progress
+from optirider.budget import TimeBudget
+from solver import recording, sessions, shared_matrices, workers
+
+
+# Ways of planning the trips of the riders at the start of the day.
+START_DAY_ENGINES = {
+    "iterative": start_day,
+    "single_model": start_day_single_model,
+}
+DEFAULT_ENGINE = settings.OPTIRIDER_SETTINGS["START_DAY_ENGINE"]["DEFAULT"]
+
+# Add / delete order responses carry all riders & orders, or (`delta`) only the
+# riders whose tours changed and the orders the request added.
+FULL_RESPONSE = "full"
+DELTA_RESPONSE = "delta"
+RESPONSE_FORMATS = [FULL_RESPONSE, DELTA_RESPONSE]
+
+
+def get_start_day_engine(engine):
+    if engine == "single_model":
+        return partial(
+            start_day_single_model,
+            extra_trips=settings.OPTIRIDER_SETTINGS["START_DAY_ENGINE"]["EXTRA_TRIPS"],
+        )
+    return START_DAY_ENGINES[engine]
 
 
 class Point:
@@ -53,6 +93,12 @@ class RiderStartMeta:
         self.tours = []
 
 
+class MultiDepotRiderStartMeta(RiderStartMeta):
+    def __init__(self, id, vehicle, startTime, depotId):
+        super().__init__(id, vehicle, startTime)
+        self.depotId = depotId
+
+
 class RiderUpdateMeta:
     def __init__(self, id, vehicle, tours, headingTo):
         self.id = id
@@ -60,6 +106,8 @@ class RiderUpdateMeta:
         self.tours = [[TourStop(**stop) for stop in tour] for tour in tours]
         self.headingTo = headingTo
         self.updatedCurrentTour = False
+        # Whether any of its tours changed, stops or timings.
+        self.updatedTours = False
 
 
 class TourStop:
@@ -69,36 +117,76 @@ class TourStop:
 
 
 class StartDayMeta:
-    def __init__(self, riders, orders, depot, runtime):
+    def __init__(
+        self, riders, orders, depot, runtime, engine=DEFAULT_ENGINE, solve=True
+    ):
         self.riders = [RiderStartMeta(**rider) for rider in riders]
         self.orders = [Order(**order) for order in orders]
         self.depot = Depot(**depot)
         self.runtime = runtime
-        self._start_day()
+        self.engine = engine
+        if solve:
+            self._start_day()
 
     def _start_day(self):
+        # Orders due beyond the planning horizon are kept out of the model.
+        orders, later_orders = split_by_horizon(self.orders)
+        data, penalty = self.get_data(orders)
+
+        runtime = int(self.runtime.total_seconds())
+        initial_tours = None
+        if speculative_start_day_enabled():
+            matrices, initial_tours, runtime = self._speculative_start_day(
+                data, penalty, runtime, orders
+            )
+        else:
+            matrices = self.get_time_matrices(orders)
+        set_time_matrices(data, matrices)
+
+        tours, timings, total_penalty = get_start_day_engine(self.engine)(
+            data, penalty, time_to_limit=runtime, initial_tours=initial_tours
+        )
+        if len(later_orders) > 0:
+            self._fill_in(tours, timings, data, orders, later_orders)
+        self.set_tours(tours, timings, orders + later_orders)
+
+    def _fill_in(self, tours, timings, data, orders, later_orders):
+        """Slots the orders due beyond the planning horizon into the room left
+        in the plan. Their durations are only fetched if there is room left."""
+        later_volumes = get_package_volumes(later_orders)[1:]
+        if not horizon.has_room(
+            tours, timings, data, min(abs(volume) for volume in later_volumes)
+        ):
+            return
+        all_orders = orders + later_orders
+        all_data, _ = self.get_data(all_orders)
+        set_time_matrices(all_data, self.get_time_matrices(all_orders))
+        horizon.fill_in(
+            tours,
+            timings,
+            all_data,
+            range(len(orders) + 1, len(all_orders) + 1),
+        )
+
+    def get_data(self, orders=None):
+        """Arranges the problem for `start_day`, leaving out the time matrix.
+
+        :param orders: Orders to plan, all of them by default.
+        """
+        if orders is None:
+            orders = self.orders
         depot_index = 0
-        duration_matrix = get_distance_matrix(self.depot, self.orders)
         capacities = get_capacities(self.riders)
         start_times = get_start_times(self.riders)
-        service_times = get_service_times(self.orders)
-        package_volumes = get_package_volumes(self.orders)
-        delivery_times = get_delivery_times(self.orders)
+        service_times = get_service_times(orders)
+        package_volumes = get_package_volumes(orders)
+        delivery_times = get_delivery_times(orders)
 
-        miss_penalty = settings.OPTIRIDER_SETTINGS["CONSTANTS"]["MISS_PENALTY"]
-        miss_penalty_reducer = settings.OPTIRIDER_SETTINGS["CONSTANTS"][
-            "MISS_PENALTY_REDUCER"
-        ]
-        penalty = [
-            max(MIN_MISS_PENALTY, int(miss_penalty)
-            // (miss_penalty_reducer ** int(order.expectedTime / timedelta(days=1))))
-            for order in self.orders
-        ]
-        penalty.insert(0, miss_penalty)
+        penalty = get_penalties(orders)
 
         data = {
-            "time_matrix": duration_matrix,
-            "num_locations": len(duration_matrix),
+            "time_matrix": None,
+            "num_locations": len(orders) + 1,
             "num_vehicles": len(self.riders),
             "depot": depot_index,
             "package_volume": package_volumes,
@@ -110,31 +198,206 @@ class StartDayMeta:
             "penalty": penalty,
             "local_search_metaheuristic": routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH,
         }
+        return data, penalty
+
+    def get_time_matrices(self, orders=None):
+        if orders is None:
+            orders = self.orders
+        return get_time_matrices(self.depot, orders)
+
+    def set_tours(self, tours, timings, orders=None):
+        """Sets the tours of the riders, the nodes being orders (all of them by
+        default) in that order."""
+        if orders is None:
+            orders = self.orders
+        zipped_tours = zip_tours_and_timings(tours, timings, self.depot, orders)
+        for rider_index, tours_info in enumerate(zipped_tours):
+            self.riders[rider_index].tours = tours_info
+
+    def _speculative_start_day(self, data, penalty, runtime, orders):
+        """Plans on estimated durations while the OSRM matrix is being fetched.
+
+        The estimate-based search stops as soon as the matrix arrives. Returns
+        the matrices (see `get_time_matrices`), the estimate-based tours (to
+        warm start the actual solve) and the runtime left for the actual solve.
+        """
+        estimate_share = settings.OPTIRIDER_SETTINGS["SPECULATIVE_START_DAY"][
+            "ESTIMATE_SHARE"
+        ]
+        begin = time.monotonic()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            matrix_future = executor.submit(
+                copy_context().run, self.get_time_matrices, orders
+            )
+            estimate_data = dict(
+                data, time_matrix=get_estimated_distance_matrix(self.depot, orders)
+            )
+            estimated_tours, _, _ = get_start_day_engine(self.engine)(
+                estimate_data,
+                penalty,
+                time_to_limit=max(1, int(runtime * estimate_share)),
+                stop_when=matrix_future.done,
+            )
+            matrices = matrix_future.result()
+        remaining_runtime = max(1, runtime - int(time.monotonic() - begin))
+        return matrices, estimated_tours, remaining_runtime
+
+
+class BatchStartDayMeta:
+    """Start day of several depots at once, sharing one runtime budget.
+
+    The matrices of all depots are fetched concurrently, and the depots are
+    solved in parallel on the solver worker processes.
+    """
+
+    def __init__(self, problems, runtime, engine=DEFAULT_ENGINE):
+        self.problems = [
+            StartDayMeta(**problem, runtime=runtime, engine=engine, solve=False)
+            for problem in problems
+        ]
+        self.runtime = runtime
+        self.engine = engine
+        self._start_days()
+
+    def _start_days(self):
+        begin = time.monotonic()
+        problems_data = [problem.get_data() for problem in self.problems]
+        matrices = get_several_time_matrices(
+            [(problem.depot, problem.orders) for problem in self.problems]
+        )
+
+        # Depots beyond the number of workers wait for a free worker, so the
+        # remaining budget is split among the waves of solves.
+        remaining_runtime = self.runtime.total_seconds() - (time.monotonic() - begin)
+        waves = math.ceil(len(self.problems) / workers.get_max_workers())
+        time_to_limit = max(1, int(remaining_runtime / max(1, waves)))
+
+        futures = []
+        for (data, penalty), problem_matrices in zip(problems_data, matrices):
+            set_time_matrices(data, problem_matrices)
+            # Large matrices are mapped by the workers, not pickled.
+            data, handles = shared_matrices.share_data(data)
+            try:
+                future = workers.get_solver_pool().submit(
+                    workers.solve_start_day,
+                    data,
+                    penalty,
+                    time_to_limit,
+                    self.engine,
+                )
+            except Exception:
+                shared_matrices.get_shared_matrix_registry().release(handles)
+                raise
+            shared_matrices.release_when_done(future, handles)
+            futures.append(future)
+        for problem, future in zip(self.problems, futures):
+            problem.set_tours(*future.result())
+
+
+class MultiDepotStartDayMeta:
+    """Start day of several depots in a single routing model.
+
+    Riders start and end at their own depot, but may serve any order, so
+    riders of one depot can take over orders an overflowing depot would drop.
+    """
+
+    def __init__(self, riders, orders, depots, runtime, engine=DEFAULT_ENGINE):
+        self.riders = [MultiDepotRiderStartMeta(**rider) for rider in riders]
+        self.orders = [Order(**order) for order in orders]
+        self.depots = [Depot(**depot) for depot in depots]
+        self.runtime = runtime
+        self.engine = engine
+        self._start_day()
+
+    def _start_day(self):
+        num_depots = len(self.depots)
+        depot_index = {depot.id: index for index, depot in enumerate(self.depots)}
+        rider_depots = [depot_index[rider.depotId] for rider in self.riders]
+        # Depots take the first nodes, with no service time, load or deadline.
+        depot_padding = [0] * (num_depots - 1)
 
-        tours, timings, total_penalty = start_day(
+        points = [depot.point for depot in self.depots]
+        points += [order.point for order in self.orders]
+        duration_matrix, time_tensor = fetch_time_matrices(points)
+        recording.record_matrix(duration_matrix)
+
+        penalty = get_penalties(self.orders)
+        penalty = [penalty[0]] * (num_depots - 1) + penalty
+
+        data = {
+            "time_matrix": duration_matrix,
+            "num_locations": len(duration_matrix),
+            "num_vehicles": len(self.riders),
+            "depot": 0,
+            "depots": list(range(num_depots)),
+            "starts": rider_depots,
+            "ends": rider_depots,
+            "package_volume": depot_padding + get_package_volumes(self.orders),
+            "vehicle_capacity": get_capacities(self.riders),
+            "start_time": get_start_times(self.riders),
+            "service_time": depot_padding + get_service_times(self.orders),
+            "delivery_time": depot_padding + get_delivery_times(self.orders),
+            "penalty": penalty,
+            "local_search_metaheuristic": routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH,
+            "neighbour_limit": settings.OPTIRIDER_SETTINGS["MULTI_DEPOT"][
+                "NEIGHBOUR_LIMIT"
+            ],
+        }
+        set_time_matrices(data, (duration_matrix, time_tensor))
+
+        tours, timings, total_penalty = get_start_day_engine(self.engine)(
             data, penalty, time_to_limit=int(self.runtime.total_seconds())
         )
-        zipped_tours = zip_tours_and_timings(tours, timings, self.depot, self.orders)
+        zipped_tours = zip_tours(tours, timings, get_node_ids(self.depots, self.orders))
         for rider_index, tours_info in enumerate(zipped_tours):
             self.riders[rider_index].tours = tours_info
 
 
 class AddPickupMeta:
-    def __init__(self, riders, orders, depot, newOrders, currentTime, runtime):
+    """Inserts new orders into the tours of the riders.
+
+    With a `maxLatency`, the solves share a time budget so that the request is
+    answered within it, and `truncated` tells whether any solve got less time
+    than it would have without a deadline.
+    """
+
+    def __init__(
+        self,
+        riders,
+        orders,
+        depot,
+        newOrders,
+        currentTime,
+        runtime,
+        maxLatency=None,
+        responseFormat=FULL_RESPONSE,
+        planVersion=0,
+    ):
+        self.budget = None
+        if maxLatency is not None:
+            add_order_settings = settings.OPTIRIDER_SETTINGS["ADD_ORDER"]
+            self.budget = TimeBudget(
+                maxLatency.total_seconds(),
+                add_order_settings["MIN_SOLVE_TIME"].total_seconds(),
+            )
         self.riders = [RiderUpdateMeta(**rider) for rider in riders]
         self.newOrders = [Order(**order) for order in newOrders]
         self.orders = [Order(**order) for order in orders] + self.newOrders
         self.depot = Depot(**depot)
         self.currentTime = currentTime
         self.runtime = runtime
+        self.maxLatency = maxLatency
+        self.responseFormat = responseFormat
+        self.planVersion = planVersion + 1
         self._add_pickup()
+        self.truncated = self.budget is not None and self.budget.truncated
 
     def _add_pickup(self):
         depot_index = 0
         pickup_indices = list(
             range(len(self.orders) - len(self.newOrders) + 1, len(self.orders) + 1)
         )
-        duration_matrix = get_distance_matrix(self.depot, self.orders)
+        duration_matrix, time_tensor = get_time_matrices(self.depot, self.orders)
         capacities = get_capacities(self.riders)
         service_times = get_service_times(self.orders)
         package_volumes = get_package_volumes(self.orders)
@@ -143,17 +406,13 @@ class AddPickupMeta:
         tours, timings, tour_locations = unzip_tours_timings_locations(
             self.riders, self.depot, self.orders
         )
+        sessions.apply_reoptimised(
+            self.depot, self.orders, self.riders, tours, timings, tour_locations
+        )
+        # Riders behind schedule cannot be at their next stop before now.
+        progress.catch_up(timings, tour_locations, cur_time)
 
-        miss_penalty = settings.OPTIRIDER_SETTINGS["CONSTANTS"]["MISS_PENALTY"]
-        miss_penalty_reducer = settings.OPTIRIDER_SETTINGS["CONSTANTS"][
-            "MISS_PENALTY_REDUCER"
-        ]
-        penalty = [
-            max(MIN_MISS_PENALTY, int(miss_penalty)
-            // (miss_penalty_reducer ** int(order.expectedTime / timedelta(days=1))))
-            for order in self.orders
-        ]
-        penalty.insert(0, miss_penalty)
+        penalty = get_penalties(self.orders)
 
         data = {
             "time_matrix": duration_matrix,
@@ -169,25 +428,61 @@ class AddPickupMeta:
             "cur_time": cur_time,
             "penalty": penalty,
         }
-
-        updated_tours, updated_timings = add_pickup(tours, timings, data)
+        set_time_matrices(data, (duration_matrix, time_tensor))
+
+        exchange_settings = settings.OPTIRIDER_SETTINGS["EXCHANGE"]
+        updated_tours, updated_timings = add_pickup(
+            tours,
+            timings,
+            data,
+            budget=self.budget,
+            upcoming_share=settings.OPTIRIDER_SETTINGS["ADD_ORDER"]["UPCOMING_SHARE"],
+            shortlist_size=settings.OPTIRIDER_SETTINGS["ADD_ORDER"]["SHORTLIST_SIZE"],
+            exchange_time_limit=exchange_settings["TIME_LIMIT"].total_seconds(),
+            max_segment_length=exchange_settings["MAX_SEGMENT_LENGTH"],
+            candidates=exchange_settings["CANDIDATES"],
+            max_screen_size=exchange_settings["MAX_SCREEN_SIZE"],
+        )
 
         zipped_tours = zip_tours_and_timings(
             updated_tours, updated_timings, self.depot, self.orders
         )
         for rider, tours_info in zip(self.riders, zipped_tours):
             rider.updatedCurrentTour = compare_current_tours(rider.tours, tours_info)
+            rider.updatedTours = compare_tours(rider.tours, tours_info)
             rider.tours = tours_info
+        # Upcoming tours were only re-planned where needed.
+        sessions.reoptimise_in_background(
+            self.depot,
+            self.orders,
+            self.riders,
+            updated_tours,
+            updated_timings,
+            tour_locations,
+            data,
+        )
 
 
 class DeletePickupMeta:
-    def __init__(self, riders, orders, depot, delOrderId, currentTime, runtime):
+    def __init__(
+        self,
+        riders,
+        orders,
+        depot,
+        delOrderId,
+        currentTime,
+        runtime,
+        responseFormat=FULL_RESPONSE,
+        planVersion=0,
+    ):
         self.riders = [RiderUpdateMeta(**rider) for rider in riders]
         self.orders = [Order(**order) for order in orders]
         self.depot = Depot(**depot)
         self.delOrderId = delOrderId
         self.currentTime = currentTime
         self.runtime = runtime
+        self.responseFormat = responseFormat
+        self.planVersion = planVersion + 1
         self._del_pickup()
 
     def _del_pickup(self):
@@ -200,7 +495,7 @@ class DeletePickupMeta:
         if pickup_index == -1:
             return
 
-        duration_matrix = get_distance_matrix(self.depot, self.orders)
+        duration_matrix, time_tensor = get_time_matrices(self.depot, self.orders)
         capacities = get_capacities(self.riders)
         service_times = get_service_times(self.orders)
         package_volumes = get_package_volumes(self.orders)
@@ -209,17 +504,13 @@ class DeletePickupMeta:
         tours, timings, tour_locations = unzip_tours_timings_locations(
             self.riders, self.depot, self.orders
         )
+        sessions.apply_reoptimised(
+            self.depot, self.orders, self.riders, tours, timings, tour_locations
+        )
+        # Riders behind schedule cannot be at their next stop before now.
+        progress.catch_up(timings, tour_locations, cur_time)
 
-        miss_penalty = settings.OPTIRIDER_SETTINGS["CONSTANTS"]["MISS_PENALTY"]
-        miss_penalty_reducer = settings.OPTIRIDER_SETTINGS["CONSTANTS"][
-            "MISS_PENALTY_REDUCER"
-        ]
-        penalty = [
-            max(MIN_MISS_PENALTY, int(miss_penalty)
-            // (miss_penalty_reducer ** int(order.expectedTime / timedelta(days=1))))
-            for order in self.orders
-        ]
-        penalty.insert(0, miss_penalty)
+        penalty = get_penalties(self.orders)
 
         data = {
             "time_matrix": duration_matrix,
@@ -235,6 +526,7 @@ class DeletePickupMeta:
             "cur_time": cur_time,
             "penalty": penalty,
         }
+        set_time_matrices(data, (duration_matrix, time_tensor))
 
         updated_tours, updated_timings, changed_rider = delete_pickup(
             tours, timings, data
@@ -245,14 +537,282 @@ class DeletePickupMeta:
         zipped_tours = zip_tours_and_timings(
             updated_tours, updated_timings, self.depot, self.orders
         )
-        for rider_index, tours_info in enumerate(zipped_tours):
-            self.riders[rider_index].tours = tours_info
+        for rider, tours_info in zip(self.riders, zipped_tours):
+            # The plan picked up from the background may change any rider.
+            if compare_current_tours(rider.tours, tours_info):
+                rider.updatedCurrentTour = True
+            rider.updatedTours = compare_tours(rider.tours, tours_info)
+            rider.tours = tours_info
+        sessions.reoptimise_in_background(
+            self.depot,
+            self.orders,
+            self.riders,
+            updated_tours,
+            updated_timings,
+            tour_locations,
+            data,
+        )
+
+
+class ProgressMeta:
+    """Moves the schedule of a rider along with its reported progress.
+
+    The rider is heading to headingTo, and reaches it at eta (or now, if it
+    is behind schedule). Its remaining stops & upcoming tours are shifted, and
+    its ongoing tour is re-sequenced only when a stop gets later than planned
+    by more than the REPLAN_LATENESS setting.
+    """
+
+    def __init__(
+        self, riders, orders, depot, riderId, headingTo, currentTime, eta=None
+    ):
+        self.riders = [RiderUpdateMeta(**rider) for rider in riders]
+        self.orders = [Order(**order) for order in orders]
+        self.depot = Depot(**depot)
+        self.riderId = riderId
+        self.headingTo = headingTo
+        self.currentTime = currentTime
+        self.eta = eta
+        self.replanned = False
+        self.lateness = timedelta()
+        self._update_progress()
+
+    def _update_progress(self):
+        rider_index = [rider.id for rider in self.riders].index(self.riderId)
+        rider = self.riders[rider_index]
+        rider.headingTo = self.headingTo
+
+        # Only the orders of the rider are looked at.
+        orders = get_rider_orders(rider, self.orders)
+        tours, timings, tour_locations = unzip_tours_timings_locations(
+            [rider], self.depot, orders
+        )
+        heading_index = tour_locations[0]
+        if heading_index == -1:
+            return
+
+        tours = tours[0]
+        timings = timings[0]
+        delivery_times = get_delivery_times(orders)
+        planned_lateness = progress.remaining_lateness(
+            tours, timings, heading_index, delivery_times
+        )
+
+        cur_time = int(self.currentTime.total_seconds())
+        if self.eta is not None:
+            arrival = max(int(self.eta.total_seconds()), cur_time)
+        else:
+            arrival = max(timings[0][heading_index], cur_time)
+        progress.propagate_arrival(timings, heading_index, arrival)
+        lateness = progress.remaining_lateness(
+            tours, timings, heading_index, delivery_times
+        )
+
+        added_lateness = (lateness - planned_lateness).max(initial=0)
+        replan_lateness = settings.OPTIRIDER_SETTINGS["PROGRESS"]["REPLAN_LATENESS"]
+        if added_lateness > replan_lateness.total_seconds():
+            duration_matrix, time_tensor = get_time_matrices(self.depot, orders)
+            data = {
+                "time_matrix": duration_matrix,
+                "depot": 0,
+                "service_time": get_service_times(orders),
+                "package_volume": get_package_volumes(orders),
+                "delivery_time": delivery_times,
+                "vehicle_capacity": get_capacities([rider]),
+                # Orders in the ongoing tour must not be dropped.
+                "penalty": [MISS_PENALTY] * len(duration_matrix),
+            }
+            set_time_matrices(data, (duration_matrix, time_tensor))
+            resequenced = progress.resequence_current_tour(
+                tours, timings, heading_index, data, 0
+            )
+            if resequenced is not None:
+                resequenced_lateness = progress.remaining_lateness(
+                    *resequenced, heading_index, delivery_times
+                )
+                if resequenced_lateness.sum() < lateness.sum():
+                    tours, timings = resequenced
+                    lateness = resequenced_lateness
+                    self.replanned = True
 
+        self.lateness = timedelta(seconds=int(lateness.sum()))
+        node_ids = get_node_ids([self.depot], orders)
+        zipped_tours = zip_tours([tours], [timings], node_ids)[0]
+        rider.updatedCurrentTour = compare_current_tours(rider.tours, zipped_tours)
+        rider.tours = zipped_tours
+
+
+class RiderReplanMeta:
+    """Plans the remaining stops & upcoming tours of a single rider again.
+
+    Only the orders of the rider are looked at, the matrix is fetched over
+    them alone. The rest of its ongoing tour is re-ordered (from the stop it is
+    heading to) and its upcoming tours are planned again, each kept only when
+    cheaper and leaving no order out. The other riders are left as they are.
+    """
+
+    def __init__(self, riders, orders, depot, riderId, currentTime, runtime):
+        self.riders = [RiderUpdateMeta(**rider) for rider in riders]
+        self.orders = [Order(**order) for order in orders]
+        self.depot = Depot(**depot)
+        self.riderId = riderId
+        self.currentTime = currentTime
+        self.runtime = runtime
+        self.replanned = False
+        self._replan_rider()
 
-def get_distance_matrix(depot, orders):
+    def _replan_rider(self):
+        rider = self.riders[[rider.id for rider in self.riders].index(self.riderId)]
+        orders = get_rider_orders(rider, self.orders)
+        if len(orders) == 0:
+            return
+
+        tours, timings, tour_locations = unzip_tours_timings_locations(
+            [rider], self.depot, orders
+        )
+        cur_time = int(self.currentTime.total_seconds())
+        progress.catch_up(timings, tour_locations, cur_time)
+        duration_matrix, time_tensor = get_time_matrices(self.depot, orders)
+        data = {
+            "time_matrix": duration_matrix,
+            "num_locations": len(duration_matrix),
+            "num_vehicles": 1,
+            "depot": 0,
+            "tour_location": tour_locations,
+            "service_time": get_service_times(orders),
+            "package_volume": get_package_volumes(orders),
+            "delivery_time": get_delivery_times(orders),
+            "vehicle_capacity": get_capacities([rider]),
+            "cur_time": cur_time,
+            # None of the orders of the rider may be dropped.
+            "penalty": [MISS_PENALTY] * len(duration_matrix),
+        }
+        set_time_matrices(data, (duration_matrix, time_tensor))
+
+        self.replanned = improvement.resequence_move(tours, timings, data, 0)
+        if len(tours[0]) > 1:
+            self.replanned |= improvement.replan_move(
+                tours, timings, data, [0], self.runtime.total_seconds()
+            )
+
+        zipped_tours = zip_tours(tours, timings, get_node_ids([self.depot], orders))[0]
+        rider.updatedCurrentTour = compare_current_tours(rider.tours, zipped_tours)
+        rider.tours = zipped_tours
+
+
+class PrewarmMeta:
+    """Queues the matrix of the depot & of upcoming orders (eg. known hours
+    before the start day) to be fetched in the background, so that the start
+    day finds it cached. It then serves any of these orders.
+    """
+
+    def __init__(self, depot, orders):
+        self.depot = Depot(**depot)
+        points = [self.depot.point] + [Point(**order["point"]) for order in orders]
+        self.numPoints = len(points)
+        self.queued = get_matrix_prewarmer().submit(points)
+
+
+def get_rider_orders(rider, orders):
+    """Orders visited by the tours of the rider, in the order they are given."""
+    order_ids = {stop.orderId for tour in rider.tours for stop in tour}
+    return [order for order in orders if order.id in order_ids]
+
+
+def get_points(depot, orders):
     points = [order.point for order in orders]
     points.insert(0, depot.point)
-    return fetch_distance_matrix(points)
+    return points
+
+
+def fetch_time_matrices(points):
+    """Returns the duration matrix of the points, and the durations of each
+    time slot if the TIME_SLOTS setting is enabled (None otherwise)."""
+    if settings.OPTIRIDER_SETTINGS["TIME_SLOTS"]["ENABLED"]:
+        return fetch_time_dependent_matrices(points)
+    return fetch_distance_matrix(points), None
+
+
+def get_time_matrices(depot, orders):
+    """`fetch_time_matrices` of the depot & the orders, recording the matrix."""
+    duration_matrix, time_tensor = fetch_time_matrices(get_points(depot, orders))
+    recording.record_matrix(duration_matrix)
+    return duration_matrix, time_tensor
+
+
+def set_time_matrices(data, matrices):
+    duration_matrix, time_tensor = matrices
+    # Converted once here, the solves then take sub-matrices of it as they are.
+    data["time_matrix"] = np.asarray(duration_matrix)
+    if time_tensor is not None:
+        data["time_tensor"] = time_tensor
+        data["time_slots"] = get_time_slot_cache().slot_starts
+
+
+def get_several_time_matrices(depots_orders):
+    """`get_time_matrices` of several (depot, orders) pairs, fetched
+    concurrently."""
+    matrices = fetch_distance_matrices(
+        [get_points(depot, orders) for depot, orders in depots_orders],
+        fetch=fetch_time_matrices,
+    )
+    for duration_matrix, _ in matrices:
+        recording.record_matrix(duration_matrix)
+    return matrices
+
+
+def get_estimated_distance_matrix(depot, orders):
+    return get_distance_provider("estimate").fetch(get_points(depot, orders)).tolist()
+
+
+def within_horizon(expected_time):
+    """Whether an order due at `expected_time` is within the planning horizon."""
+    horizon_settings = settings.OPTIRIDER_SETTINGS["PLANNING_HORIZON"]
+    if not horizon_settings["ENABLED"]:
+        return True
+    return expected_time < horizon_settings["HORIZON"]
+
+
+def split_by_horizon(orders, expected_time=lambda order: order.expectedTime):
+    """Splits the orders into those due within the planning horizon, and those
+    due beyond it. All orders are planned when none is due within it."""
+    if not settings.OPTIRIDER_SETTINGS["PLANNING_HORIZON"]["ENABLED"]:
+        return list(orders), []
+    within = []
+    beyond = []
+    for order in orders:
+        if within_horizon(expected_time(order)):
+            within.append(order)
+        else:
+            beyond.append(order)
+    if len(within) == 0:
+        return list(orders), []
+    return within, beyond
+
+
+def speculative_start_day_enabled():
+    return (
+        settings.OPTIRIDER_SETTINGS["SPECULATIVE_START_DAY"]["ENABLED"]
+        and settings.OPTIRIDER_SETTINGS["DISTANCE_PROVIDER"]["BACKEND"] != "estimate"
+    )
+
+
+def get_penalties(orders):
+    """Penalty for missing each order, reduced for orders due on later days."""
+    miss_penalty = settings.OPTIRIDER_SETTINGS["CONSTANTS"]["MISS_PENALTY"]
+    miss_penalty_reducer = settings.OPTIRIDER_SETTINGS["CONSTANTS"][
+        "MISS_PENALTY_REDUCER"
+    ]
+    penalty = [
+        max(
+            MIN_MISS_PENALTY,
+            int(miss_penalty)
+            // (miss_penalty_reducer ** int(order.expectedTime / timedelta(days=1))),
+        )
+        for order in orders
+    ]
+    penalty.insert(0, miss_penalty)
+    return penalty
 
 
 def get_capacities(riders):
@@ -288,29 +848,36 @@ def get_delivery_times(orders):
     return delivery_times
 
 
+def get_node_ids(depots, orders):
+    """Ids of the nodes of the problem, the depots followed by the orders."""
+    return [depot.id for depot in depots] + [order.id for order in orders]
+
+
 def zip_tours_and_timings(tours, timings, depot, orders):
+    return zip_tours(tours, timings, get_node_ids([depot], orders))
+
+
+def zip_tours(tours, timings, node_ids):
+    plan = evaluation.flatten_plan(tours, timings)
+    nodes = plan.nodes.tolist()
+    deltas = evaluation.timing_deltas(plan).tolist()
+    tour_offsets = plan.tour_offsets.tolist()
     zipped_tours = []
-    # print(tours)
     for rider_index, rider_tours in enumerate(tours):
         zipped_tours.append([])
         if len(rider_tours) == 1 and len(rider_tours[0]) == 0:
             continue
-        # print(rider_index, rider_tours)
-        for tour_index, tour in enumerate(rider_tours):
-            zipped_tours[rider_index].append([])
-            prev_time = 0
-            for stop_index, tour_stop in enumerate(tour):
-                zipped_tours[rider_index][tour_index].append(
-                    TourStop(
-                        depot.id if tour_stop == 0 else orders[tour_stop - 1].id,
-                        timedelta(
-                            seconds=(
-                                timings[rider_index][tour_index][stop_index] - prev_time
-                            )
-                        ),
+        for tour_index in range(
+            plan.rider_offsets[rider_index], plan.rider_offsets[rider_index + 1]
+        ):
+            zipped_tours[rider_index].append(
+                [
+                    TourStop(node_ids[nodes[stop]], timedelta(seconds=deltas[stop]))
+                    for stop in range(
+                        tour_offsets[tour_index], tour_offsets[tour_index + 1]
                     )
-                )
-                prev_time = timings[rider_index][tour_index][stop_index]
+                ]
+            )
     return zipped_tours
 
 
@@ -321,17 +888,16 @@ def unzip_tours_timings_locations(riders, depot, orders):
     for i, order in enumerate(orders):
         id_to_index[order.id] = i + 1
     tours = []
-    timings = []
+    # Time from the previous stop of the tour, to each stop.
+    deltas = []
     tour_locations = []
-    
+
     for rider in riders:
-        tours.append([])
-        timings.append([])
         tour_locations.append(0)
 
         if len(rider.tours) == 0:
-            tours[-1].append([])
-            timings[-1].append([])
+            tours.append([[]])
+            deltas.append([[]])
             tour_locations[-1] = -1
             continue
 
@@ -342,15 +908,19 @@ def unzip_tours_timings_locations(riders, depot, orders):
                     tour_locations[-1] = stop_index
                     break
 
-        for tour in rider.tours:
-            tours[-1].append([])
-            timings[-1].append([])
-            stop_time = 0
-            for stop in tour:
-                stop_time += int(stop.timing.total_seconds())
-                tours[-1][-1].append(id_to_index[stop.orderId])
-                timings[-1][-1].append(stop_time)
+        tours.append(
+            [[id_to_index[stop.orderId] for stop in tour] for tour in rider.tours]
+        )
+        deltas.append(
+            [
+                [int(stop.timing.total_seconds()) for stop in tour]
+                for tour in rider.tours
+            ]
+        )
 
+    plan = evaluation.flatten_plan(tours, deltas)
+    plan.times = evaluation.within_tour_cumsum(plan, plan.times)
+    tours, timings = plan.to_lists()
     return tours, timings, tour_locations
 
 
@@ -367,3 +937,16 @@ def compare_current_tours(tours1, tours2):
         if stop1.orderId != stop2.orderId:
             return True
     return False
+
+
+def compare_tours(tours1, tours2):
+    """Whether the tours differ, in any stop or timing."""
+    if len(tours1) != len(tours2):
+        return True
+    for tour1, tour2 in zip(tours1, tours2):
+        if len(tour1) != len(tour2):
+            return True
+        for stop1, stop2 in zip(tour1, tour2):
+            if stop1.orderId != stop2.orderId or stop1.timing != stop2.timing:
+                return True
+    return False
@@ -0,0 +1,54 @@
+import cProfile
+import logging
+import uuid
+from pathlib import Path
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+
+def profiling_requested(request):
+    """Checks whether a staff user asked for the request to be profiled.
+
+    Only a header and a query parameter lookup is done here, so requests
+    without the flag do not pay for profiling at all.
+    """
+    profiling_settings = settings.OPTIRIDER_SETTINGS["PROFILING"]
+    flag = request.headers.get(profiling_settings["HEADER"]) or request.GET.get(
+        profiling_settings["QUERY_PARAM"]
+    )
+    if flag is None or flag.lower() in ("", "0", "false", "no"):
+        return False
+    user = getattr(request, "user", None)
+    return user is not None and user.is_staff
+
+
+def save_profile(profiler):
+    """Dumps the collected stats, and returns the artifact id of the dump."""
+    directory = Path(settings.OPTIRIDER_SETTINGS["PROFILING"]["DIRECTORY"])
+    directory.mkdir(parents=True, exist_ok=True)
+    artifact_id = uuid.uuid4().hex
+    profiler.dump_stats(directory / f"{artifact_id}.prof")
+    return artifact_id
+
+
+class ProfiledSolveMixin:
+    """Runs the solve under cProfile when a staff user asks for it.
+
+    cProfile is deterministic, so the time spent in the Python callbacks that
+    OR-Tools calls into (`gen_time_callback`, `volume_evaluator`) shows up in
+    the dump as well. The artifact id is returned in the `X-Profile-Id` header.
+    """
+
+    def post(self, request, *args, **kwargs):
+        if not profiling_requested(request):
+            return super().post(request, *args, **kwargs)
+
+        profiler = cProfile.Profile()
+        response = profiler.runcall(super().post, request, *args, **kwargs)
+        artifact_id = save_profile(profiler)
+        logger.info("Stored solve profile " + artifact_id)
+        response[PROFILE_ID_HEADER] = artifact_id
+        return response
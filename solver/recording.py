@@ -0,0 +1,164 @@
+import json
+import threading
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from pathlib import Path
+from django.conf import settings
+from django.utils.dateparse import parse_duration
+import numpy as np
+
+from optirider import setup
+
+LOG_FILE_NAME = "solves.jsonl"
+
+# Matrices fetched while serving the request being recorded.
+_recorded_matrices = ContextVar("recorded_matrices", default=None)
+
+
+def start_recording():
+    return _recorded_matrices.set([])
+
+
+def stop_recording(token):
+    matrices = _recorded_matrices.get()
+    _recorded_matrices.reset(token)
+    return matrices
+
+
+def record_matrix(matrix):
+    matrices = _recorded_matrices.get()
+    if matrices is not None:
+        matrices.append(matrix)
+
+
+class SolveLog:
+    """Append-only log of solve requests.
+
+    Every solve is one JSON line in `solves.jsonl`, and every distance matrix
+    used by it is stored next to it as a `.npy` sidecar file.
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = settings.OPTIRIDER_SETTINGS["RECORDING"]["DIRECTORY"]
+        self.directory = Path(directory)
+        self.log_path = self.directory / LOG_FILE_NAME
+        self._lock = threading.Lock()
+
+    def append(
+        self,
+        path,
+        request,
+        response,
+        latency,
+        matrices,
+        request_columnar=False,
+        response_columnar=False,
+    ):
+        record_id = uuid.uuid4().hex
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        matrix_files = []
+        for matrix_index, matrix in enumerate(matrices):
+            matrix_file = f"{record_id}-{matrix_index}.npy"
+            np.save(self.directory / matrix_file, np.asarray(matrix, dtype=np.int32))
+            matrix_files.append(matrix_file)
+
+        line = json.dumps(
+            {
+                "id": record_id,
+                "path": path,
+                "recordedAt": datetime.now(timezone.utc).isoformat(),
+                "latency": latency,
+                "request": request,
+                "response": response,
+                "requestColumnar": request_columnar,
+                "responseColumnar": response_columnar,
+                "matrices": matrix_files,
+            },
+            separators=(",", ":"),
+        )
+        with self._lock, open(self.log_path, "a") as log_file:
+            log_file.write(line + "\n")
+        return record_id
+
+    def __iter__(self):
+        if not self.log_path.exists():
+            return
+        with open(self.log_path) as log_file:
+            for line in log_file:
+                if line.strip():
+                    yield json.loads(line)
+
+    def load_matrices(self, record):
+        return [
+            np.load(self.directory / matrix_file) for matrix_file in record["matrices"]
+        ]
+
+
+def plan_penalty(payload, time_matrix):
+    """Objective (`setup.get_penalty`) of a solve response payload."""
+    # Depots take the first nodes (several of them for multi depot start days).
+    depots = payload["depots"] if "depots" in payload else [payload["depot"]]
+    node_index = {depot["id"]: depot_index for depot_index, depot in enumerate(depots)}
+    delivery_time = [0] * len(depots)
+    for order_index, order in enumerate(payload["orders"]):
+        node_index[order["id"]] = order_index + len(depots)
+        delivery_time.append(int(parse_duration(order["expectedTime"]).total_seconds()))
+
+    tours = []
+    timings = []
+    for rider in payload["riders"]:
+        tours.append([])
+        timings.append([])
+        for tour in rider["tours"]:
+            stop_time = 0
+            tours[-1].append([])
+            timings[-1].append([])
+            for stop in tour:
+                stop_time += int(parse_duration(stop["timing"]).total_seconds())
+                tours[-1][-1].append(node_index[stop["orderId"]])
+                timings[-1][-1].append(stop_time)
+
+    data = {
+        "time_matrix": time_matrix,
+        "num_locations": len(time_matrix),
+        "num_vehicles": len(tours),
+        "delivery_time": delivery_time,
+    }
+    return setup.get_penalty(tours, timings, data)
+
+
+def rider_payload(payload, request):
+    """Solve payload narrowed to the rider the (validated) request is about, and
+    to the orders its requested tours visit (the ones its matrix is fetched
+    over)."""
+
+    def get_rider(riders):
+        return next(rider for rider in riders if rider["id"] == request["riderId"])
+
+    order_ids = {
+        stop["orderId"]
+        for tour in get_rider(request["riders"])["tours"]
+        for stop in tour
+    }
+    return dict(
+        payload,
+        riders=[get_rider(payload["riders"])],
+        orders=[order for order in payload["orders"] if order["id"] in order_ids],
+    )
+
+
+def response_penalty(payload, matrices):
+    """Objective of a solve response payload, on the matrices recorded with it
+    (None if none were, the request having solved nothing)."""
+    if len(matrices) == 0:
+        return None
+    if "problems" in payload:
+        # Batches fetch the matrix of each of their problems, in order.
+        return sum(
+            plan_penalty(problem, matrix)
+            for problem, matrix in zip(payload["problems"], matrices)
+        )
+    return plan_penalty(payload, matrices[-1])
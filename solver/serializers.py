@@ -1,22 +1,40 @@
 from django.conf import settings
 from rest_framework import serializers
+import copy
 from datetime import timedelta
 from solver.models import (
+    DELTA_RESPONSE,
+    FULL_RESPONSE,
+    RESPONSE_FORMATS,
+    START_DAY_ENGINES,
     Point,
     Order,
     Package,
     Vehicle,
     Depot,
     RiderStartMeta,
+    MultiDepotRiderStartMeta,
     RiderUpdateMeta,
     TourStop,
     StartDayMeta,
+    BatchStartDayMeta,
+    MultiDepotStartDayMeta,
     AddPickupMeta,
     DeletePickupMeta,
+    ProgressMeta,
+    RiderReplanMeta,
+    PrewarmMeta,
+)
+from solver.columnar import (
+    ColumnarSerializerMixin,
+    OrderColumnsField,
+    RiderStartColumnsField,
+    RiderUpdateColumnsField,
 )
 
 
 DEFAULT_START_TIME = settings.OPTIRIDER_SETTINGS["CONSTANTS"]["GLOBAL_START_TIME"]
+DEFAULT_ENGINE = settings.OPTIRIDER_SETTINGS["START_DAY_ENGINE"]["DEFAULT"]
 
 
 class PointSerializer(serializers.Serializer):
@@ -111,6 +129,18 @@ class RiderStartMetaSerializer(serializers.Serializer):
         return instance
 
 
+class MultiDepotRiderStartMetaSerializer(RiderStartMetaSerializer):
+    depotId = serializers.CharField(trim_whitespace=False)
+
+    def create(self, validated_data):
+        return MultiDepotRiderStartMeta(**validated_data)
+
+    def update(self, instance, validated_data):
+        instance = super().update(instance, validated_data)
+        instance.depotId = validated_data.get("depotId", instance.depotId)
+        return instance
+
+
 class RiderUpdateMetaSerializer(serializers.Serializer):
     id = serializers.CharField(trim_whitespace=False)
     vehicle = VehicleSerializer()
@@ -149,13 +179,21 @@ class DepotSerializer(serializers.Serializer):
         return instance
 
 
-class StartDaySerializer(serializers.Serializer):
+class StartDaySerializer(ColumnarSerializerMixin, serializers.Serializer):
+    columnar_fields = {
+        "riders": RiderStartColumnsField,
+        "orders": OrderColumnsField,
+    }
+
     riders = RiderStartMetaSerializer(many=True)
     orders = OrderSerializer(many=True)
     depot = DepotSerializer()
     runtime = serializers.DurationField(
         default=settings.OPTIRIDER_SETTINGS["CONSTANTS"]["DEFAULT_TIME_LIMIT"]
     )
+    engine = serializers.ChoiceField(
+        choices=list(START_DAY_ENGINES), default=DEFAULT_ENGINE
+    )
 
     def create(self, validated_data):
         return StartDayMeta(**validated_data)
@@ -164,7 +202,91 @@ class StartDaySerializer(serializers.Serializer):
         return instance
 
 
-class AddPickupSerializer(serializers.Serializer):
+class StartDayUploadSerializer(StartDaySerializer):
+    """Start day problem of an upload, its orders being read row by row (see
+    `solver.uploads`). Responses leave the orders out."""
+
+    orders = None
+    columnar_fields = {"riders": RiderStartColumnsField}
+
+
+class StartDayProblemSerializer(serializers.Serializer):
+    riders = RiderStartMetaSerializer(many=True)
+    orders = OrderSerializer(many=True)
+    depot = DepotSerializer()
+
+
+class BatchStartDaySerializer(serializers.Serializer):
+    problems = StartDayProblemSerializer(many=True)
+    runtime = serializers.DurationField(
+        default=settings.OPTIRIDER_SETTINGS["CONSTANTS"]["DEFAULT_TIME_LIMIT"]
+    )
+    engine = serializers.ChoiceField(
+        choices=list(START_DAY_ENGINES), default=DEFAULT_ENGINE
+    )
+
+    def create(self, validated_data):
+        return BatchStartDayMeta(**validated_data)
+
+    def update(self, instance, validated_data):
+        return instance
+
+
+class MultiDepotStartDaySerializer(serializers.Serializer):
+    riders = MultiDepotRiderStartMetaSerializer(many=True)
+    orders = OrderSerializer(many=True)
+    depots = DepotSerializer(many=True, allow_empty=False)
+    runtime = serializers.DurationField(
+        default=settings.OPTIRIDER_SETTINGS["CONSTANTS"]["DEFAULT_TIME_LIMIT"]
+    )
+    engine = serializers.ChoiceField(
+        choices=list(START_DAY_ENGINES), default=DEFAULT_ENGINE
+    )
+
+    def validate(self, data):
+        depot_ids = [depot["id"] for depot in data["depots"]]
+        if len(set(depot_ids)) != len(depot_ids):
+            raise serializers.ValidationError({"depots": "Depot ids must be unique."})
+        for rider in data["riders"]:
+            if rider["depotId"] not in depot_ids:
+                raise serializers.ValidationError(
+                    {"riders": f"Rider {rider['id']} has an unknown depotId."}
+                )
+        return data
+
+    def create(self, validated_data):
+        return MultiDepotStartDayMeta(**validated_data)
+
+    def update(self, instance, validated_data):
+        return instance
+
+
+class DeltaResponseMixin:
+    """Responses in the `delta` format carry only the riders whose tours
+    changed, and only the orders the request added, the rest being as in the
+    request. Each response bumps the `planVersion` of the plan it was made on.
+    """
+
+    def get_added_orders(self, instance):
+        return []
+
+    def to_representation(self, instance):
+        if instance.responseFormat == DELTA_RESPONSE:
+            instance = copy.copy(instance)
+            instance.riders = [rider for rider in instance.riders if rider.updatedTours]
+            instance.orders = self.get_added_orders(instance)
+        return super().to_representation(instance)
+
+
+class AddPickupSerializer(
+    ColumnarSerializerMixin, DeltaResponseMixin, serializers.Serializer
+):
+    columnar_fields = {
+        "riders": RiderUpdateColumnsField,
+        "orders": OrderColumnsField,
+        "newOrders": OrderColumnsField,
+    }
+
     riders = RiderUpdateMetaSerializer(many=True)
     orders = OrderSerializer(many=True)
     depot = DepotSerializer()
@@ -173,6 +295,17 @@ class AddPickupSerializer(serializers.Serializer):
     runtime = serializers.DurationField(
         default=settings.OPTIRIDER_SETTINGS["CONSTANTS"]["DEFAULT_TIME_LIMIT"]
     )
+    maxLatency = serializers.DurationField(
+        min_value=timedelta(), allow_null=True, default=None, write_only=True
+    )
+    truncated = serializers.BooleanField(read_only=True)
+    responseFormat = serializers.ChoiceField(
+        choices=RESPONSE_FORMATS, default=FULL_RESPONSE, write_only=True
+    )
+    planVersion = serializers.IntegerField(min_value=0, default=0)
+
+    def get_added_orders(self, instance):
+        return instance.newOrders
 
     def create(self, validated_data):
         return AddPickupMeta(**validated_data)
@@ -181,7 +314,14 @@ class AddPickupSerializer(serializers.Serializer):
         return instance
 
 
-class DeletePickupSerializer(serializers.Serializer):
+class DeletePickupSerializer(
+    ColumnarSerializerMixin, DeltaResponseMixin, serializers.Serializer
+):
+    columnar_fields = {
+        "riders": RiderUpdateColumnsField,
+        "orders": OrderColumnsField,
+    }
+
     riders = RiderUpdateMetaSerializer(many=True)
     orders = OrderSerializer(many=True)
     depot = DepotSerializer()
@@ -190,9 +330,101 @@ class DeletePickupSerializer(serializers.Serializer):
     runtime = serializers.DurationField(
         default=settings.OPTIRIDER_SETTINGS["CONSTANTS"]["DEFAULT_TIME_LIMIT"]
     )
+    responseFormat = serializers.ChoiceField(
+        choices=RESPONSE_FORMATS, default=FULL_RESPONSE, write_only=True
+    )
+    planVersion = serializers.IntegerField(min_value=0, default=0)
 
     def create(self, validated_data):
         return DeletePickupMeta(**validated_data)
 
     def update(self, instance, validated_data):
         return instance
+
+
+class ProgressSerializer(ColumnarSerializerMixin, serializers.Serializer):
+    columnar_fields = {
+        "riders": RiderUpdateColumnsField,
+        "orders": OrderColumnsField,
+    }
+
+    riders = RiderUpdateMetaSerializer(many=True)
+    orders = OrderSerializer(many=True)
+    depot = DepotSerializer()
+    riderId = serializers.CharField(trim_whitespace=False)
+    headingTo = serializers.CharField(
+        trim_whitespace=False, allow_null=True, default=None
+    )
+    currentTime = serializers.DurationField()
+    eta = serializers.DurationField(
+        min_value=timedelta(), allow_null=True, default=None, write_only=True
+    )
+    replanned = serializers.BooleanField(read_only=True)
+    lateness = serializers.DurationField(read_only=True)
+
+    def validate(self, data):
+        for rider in data["riders"]:
+            if rider["id"] == data["riderId"]:
+                break
+        else:
+            raise serializers.ValidationError({"riderId": "Unknown rider."})
+        ongoing_tour = rider["tours"][0] if len(rider["tours"]) > 0 else []
+        if data["headingTo"] is not None and not any(
+            stop["orderId"] == data["headingTo"] for stop in ongoing_tour[1:]
+        ):
+            raise serializers.ValidationError(
+                {"headingTo": "Not a stop of the rider's ongoing tour."}
+            )
+        return data
+
+    def create(self, validated_data):
+        return ProgressMeta(**validated_data)
+
+    def update(self, instance, validated_data):
+        return instance
+
+
+class RiderReplanSerializer(ColumnarSerializerMixin, serializers.Serializer):
+    columnar_fields = {
+        "riders": RiderUpdateColumnsField,
+        "orders": OrderColumnsField,
+    }
+
+    riders = RiderUpdateMetaSerializer(many=True)
+    orders = OrderSerializer(many=True)
+    depot = DepotSerializer()
+    riderId = serializers.CharField(trim_whitespace=False)
+    currentTime = serializers.DurationField()
+    runtime = serializers.DurationField(
+        default=settings.OPTIRIDER_SETTINGS["RIDER_REPLAN"]["DEFAULT_RUNTIME"]
+    )
+    replanned = serializers.BooleanField(read_only=True)
+
+    def validate(self, data):
+        if not any(rider["id"] == data["riderId"] for rider in data["riders"]):
+            raise serializers.ValidationError({"riderId": "Unknown rider."})
+        return data
+
+    def create(self, validated_data):
+        return RiderReplanMeta(**validated_data)
+
+    def update(self, instance, validated_data):
+        return instance
+
+
+class OrderLocationSerializer(serializers.Serializer):
+    id = serializers.CharField(trim_whitespace=False)
+    point = PointSerializer()
+
+
+class PrewarmSerializer(serializers.Serializer):
+    depot = DepotSerializer(write_only=True)
+    orders = OrderLocationSerializer(many=True, write_only=True)
+    numPoints = serializers.IntegerField(read_only=True)
+    queued = serializers.BooleanField(read_only=True)
+
+    def create(self, validated_data):
+        return PrewarmMeta(**validated_data)
+
+    def update(self, instance, validated_data):
+        return instance
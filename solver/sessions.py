@@ -0,0 +1,265 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from django.conf import settings
+
+from optirider import evaluation
+from solver import shared_matrices, workers
+from solver.admission import get_admission_controller
+
+logger = logging.getLogger(__name__)
+
+
+class ReoptimisedPlans:
+    """Plans improved in the background, by the plan they improve.
+
+    Plans are keyed by their tours (as order ids), so that an improvement is
+    only picked up by a request made on the very plan it was computed from.
+    Only the latest version of each is kept. Entries expire after `ttl`
+    seconds, and at most `max_plans` are kept.
+    """
+
+    def __init__(self, ttl, max_plans):
+        self.ttl = ttl
+        self.max_plans = max_plans
+        self._lock = threading.Lock()
+        self._plans = OrderedDict()
+
+    def put(self, key, version, plan):
+        with self._lock:
+            self._plans[key] = (time.monotonic() + self.ttl, version, plan)
+            self._plans.move_to_end(key)
+            while len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+
+    def pop(self, key):
+        """Returns the latest version of the improved plan, or None."""
+        with self._lock:
+            expires_at, _, plan = self._plans.pop(key, (0, 0, None))
+        if expires_at < time.monotonic():
+            return None
+        return plan
+
+
+@lru_cache(maxsize=None)
+def get_reoptimised_plans():
+    reoptimisation_settings = settings.OPTIRIDER_SETTINGS["REOPTIMISATION"]
+    return ReoptimisedPlans(
+        ttl=reoptimisation_settings["TTL"].total_seconds(),
+        max_plans=reoptimisation_settings["MAX_PLANS"],
+    )
+
+
+def plan_key(depot, riders):
+    tours = [
+        [rider.id, [[stop.orderId for stop in tour] for tour in rider.tours]]
+        for rider in riders
+    ]
+    return hashlib.sha1(json.dumps([depot.id, tours]).encode()).hexdigest()
+
+
+class ImprovementSession:
+    """Improves the live plan of a depot on the solver pool, round after round,
+    while this server process has no solve running. Every improved version
+    is published to `get_reoptimised_plans()`.
+
+    :param tours: The plan, as indices (0 being the depot, i + 1 orders[i]),
+        the current tour of each rider first (empty if it has none).
+    :param data: Problem of the plan, data['tour_location'] being the stop
+        each rider is heading to.
+    :param handles: Shared matrices of the problem, released once the session
+        is over.
+    """
+
+    def __init__(self, key, node_ids, tours, timings, data, handles=()):
+        reoptimisation_settings = settings.OPTIRIDER_SETTINGS["REOPTIMISATION"]
+        self.key = key
+        self.node_ids = node_ids
+        self.tours = tours
+        self.timings = timings
+        self.data = data
+        self.handles = list(handles)
+        self.expires_at = (
+            time.monotonic() + reoptimisation_settings["DURATION"].total_seconds()
+        )
+        self.round_time = reoptimisation_settings["ROUND_TIME"].total_seconds()
+        self.move_time = reoptimisation_settings["MOVE_TIME"].total_seconds()
+        self.neighbourhood_size = reoptimisation_settings["NEIGHBOURHOOD_SIZE"]
+        self.idle_wait = reoptimisation_settings["IDLE_WAIT"].total_seconds()
+        self.rounds = 0
+        self.version = 0
+        self.cancelled = False
+        self._handles_lock = threading.Lock()
+
+    def cancel(self):
+        self.cancelled = True
+        self.close()
+
+    def close(self):
+        with self._handles_lock:
+            handles, self.handles = self.handles, []
+            shared_matrices.get_shared_matrix_registry().release(handles)
+
+    def run_round(self):
+        if self.cancelled or time.monotonic() >= self.expires_at:
+            self.close()
+            return
+        # Requests come first, try again once they are served.
+        if get_admission_controller().busy():
+            timer = threading.Timer(self.idle_wait, self.run_round)
+            timer.daemon = True
+            timer.start()
+            return
+
+        with self._handles_lock:
+            if self.cancelled:
+                return
+            handles = self.handles
+            shared_matrices.get_shared_matrix_registry().acquire(handles)
+        try:
+            future = workers.get_solver_pool().submit(
+                workers.improve_plan,
+                self.tours,
+                self.timings,
+                self.data,
+                self.round_time,
+                neighbourhood_size=self.neighbourhood_size,
+                move_time_limit=self.move_time,
+                replan_all=self.rounds == 0,
+                seed=self.rounds,
+            )
+        except RuntimeError:
+            # The pool is shut down, along with the server.
+            shared_matrices.get_shared_matrix_registry().release(handles)
+            self.close()
+            return
+        self.rounds += 1
+        shared_matrices.release_when_done(future, handles)
+        future.add_done_callback(self._round_done)
+
+    def _round_done(self, future):
+        if future.cancelled():
+            self.close()
+            return
+        if future.exception() is not None:
+            logger.error("Could not improve plan", exc_info=future.exception())
+            self.close()
+            return
+        if self.cancelled:
+            return
+
+        if future.result() is not None:
+            self.tours, self.timings = future.result()
+            self.version += 1
+            get_reoptimised_plans().put(self.key, self.version, self.publish())
+        self.run_round()
+
+    def publish(self):
+        """The plan, as order ids, & timings of each rider."""
+        return [
+            (
+                [[self.node_ids[node] for node in tour] for tour in vehicle_tours],
+                vehicle_timings,
+            )
+            for vehicle_tours, vehicle_timings in zip(self.tours, self.timings)
+        ]
+
+
+# Improvement session of each depot, a new plan replacing the previous one.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def reoptimise_in_background(
+    depot, orders, riders, tours, timings, tour_locations, data
+):
+    """Starts improving a plan just made, for the next request made on the
+    plan to pick up.
+
+    :param riders: Riders, with the tours of the plan.
+    :param tours: The plan, as indices, riders without a current tour having
+        their upcoming tours only.
+    :param tour_locations: Stop each rider was heading to, in the request the
+        plan was made for (-1 for riders without a current tour).
+    """
+    if not settings.OPTIRIDER_SETTINGS["REOPTIMISATION"]["ENABLED"]:
+        return
+
+    session_tours = []
+    session_timings = []
+    heading_indices = []
+    for vehicle_id, heading_index in enumerate(tour_locations):
+        if len(tours[vehicle_id]) == 0:
+            session_tours.append([[]])
+            session_timings.append([[]])
+            heading_indices.append(-1)
+            continue
+        session_tours.append(tours[vehicle_id])
+        session_timings.append(timings[vehicle_id])
+        # Otherwise, the first upcoming tour is the current tour of the next
+        # request, which the rider has not begun.
+        heading_indices.append(max(heading_index, 0))
+    # Large matrices are shared with the workers once, not at every round.
+    data, handles = shared_matrices.share_data(
+        dict(data, tour_location=heading_indices)
+    )
+
+    session = ImprovementSession(
+        plan_key(depot, riders),
+        [depot.id] + [order.id for order in orders],
+        session_tours,
+        session_timings,
+        data,
+        handles,
+    )
+    with _sessions_lock:
+        previous = _sessions.get(depot.id)
+        if previous is not None:
+            previous.cancel()
+        _sessions[depot.id] = session
+    session.run_round()
+
+
+def apply_reoptimised(depot, orders, riders, tours, timings, tour_locations):
+    """Replaces the tours of the riders by their background improvement, if
+    one was made from this very plan.
+
+    The stops each rider has reached since stay as they were: the current
+    tour is only replaced if the improved one has the same stops up to the
+    stop the rider is heading to now. Upcoming tours are pushed back after
+    the current tours, if needed.
+
+    :returns: Whether the tours were replaced.
+    """
+    plan = get_reoptimised_plans().pop(plan_key(depot, riders))
+    if plan is None:
+        return False
+
+    id_to_index = {depot.id: 0}
+    for i, order in enumerate(orders):
+        id_to_index[order.id] = i + 1
+    for vehicle_id, (vehicle_tours, vehicle_timings) in enumerate(plan):
+        vehicle_tours = [
+            [id_to_index[order_id] for order_id in tour] for tour in vehicle_tours
+        ]
+        heading_index = tour_locations[vehicle_id]
+        current_tour = tours[vehicle_id][0]
+        if (
+            heading_index != -1
+            and vehicle_tours[0][:heading_index] == current_tour[:heading_index]
+        ):
+            tours[vehicle_id][0] = vehicle_tours[0]
+            timings[vehicle_id][0] = (
+                timings[vehicle_id][0][:heading_index]
+                + vehicle_timings[0][heading_index:]
+            )
+        tours[vehicle_id][1:] = vehicle_tours[1:]
+        timings[vehicle_id][1:] = [
+            list(tour_timings) for tour_timings in vehicle_timings[1:]
+        ]
+        evaluation.propagate_trip_starts(timings[vehicle_id])
+    return True
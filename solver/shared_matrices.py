@@ -0,0 +1,151 @@
+import logging
+import os
+import threading
+import uuid
+from functools import lru_cache
+from pathlib import Path
+from django.conf import settings
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Large matrices are handed to the solver worker processes as memory mapped
+# `.npy` files, rather than pickled into every task: the server process writes
+# a matrix once, and workers map it read-only, with no copy. A matrix file is
+# removed once the last task (or owner) holding it is done with it. Workers
+# still mapping it keep their mapping.
+
+SHARED_KEYS = ("time_matrix", "time_tensor")
+
+
+class SharedMatrix:
+    """Handle of a shared matrix, pickled as its path only."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def attach(self):
+        return np.load(self.path, mmap_mode="r")
+
+    def __repr__(self):
+        return f"SharedMatrix({self.path!r})"
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedMatrixRegistry:
+    """Matrices this server process shares with the solver workers, with the
+    number of references held on each.
+
+    Sharing a matrix takes a reference for the caller, tasks using it take one
+    more until they are over. Files are named after the process which wrote
+    them, so that those of server processes which died are removed.
+
+    :param min_nodes: Matrices over fewer nodes are not shared, pickling them
+        costs less than writing a file.
+    """
+
+    def __init__(self, directory, dtype="int32", min_nodes=0):
+        self.directory = Path(directory)
+        self.dtype = np.dtype(dtype)
+        self.min_nodes = min_nodes
+        self._lock = threading.Lock()
+        self._references = {}
+        self._cleaned = False
+
+    def worth_sharing(self, num_nodes):
+        return num_nodes >= self.min_nodes
+
+    def share(self, matrix):
+        if not self._cleaned:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self.remove_stale()
+            self._cleaned = True
+        path = self.directory / f"{os.getpid()}-{uuid.uuid4().hex}.npy"
+        with open(path, "wb") as matrix_file:
+            np.save(matrix_file, np.asarray(matrix).astype(self.dtype, copy=False))
+        with self._lock:
+            self._references[str(path)] = 1
+        return SharedMatrix(str(path))
+
+    def acquire(self, handles):
+        with self._lock:
+            for handle in handles:
+                self._references[handle.path] += 1
+
+    def release(self, handles):
+        removed = []
+        with self._lock:
+            for handle in handles:
+                self._references[handle.path] -= 1
+                if self._references[handle.path] == 0:
+                    del self._references[handle.path]
+                    removed.append(handle.path)
+        for path in removed:
+            Path(path).unlink(missing_ok=True)
+
+    def remove_stale(self):
+        """Removes the matrix files of server processes which are gone."""
+        for path in self.directory.glob("*.npy"):
+            pid = path.name.split("-", 1)[0]
+            if pid.isdigit() and not process_alive(int(pid)):
+                path.unlink(missing_ok=True)
+
+
+@lru_cache(maxsize=None)
+def get_shared_matrix_registry():
+    shared_settings = settings.OPTIRIDER_SETTINGS["SHARED_MATRICES"]
+    return SharedMatrixRegistry(
+        shared_settings["DIRECTORY"],
+        shared_settings["DTYPE"],
+        shared_settings["MIN_NODES"],
+    )
+
+
+def share_data(data):
+    """Copy of a problem, its large matrices being shared ones.
+
+    :returns: The problem, and the handles of its shared matrices, to release
+        once done with. Matrices which cannot be written are left as they are.
+    """
+    registry = get_shared_matrix_registry()
+    if not registry.worth_sharing(len(data["time_matrix"])):
+        return data, []
+
+    shared_data = dict(data)
+    handles = []
+    try:
+        for key in SHARED_KEYS:
+            if key in data:
+                shared_data[key] = registry.share(data[key])
+                handles.append(shared_data[key])
+    except OSError:
+        logger.exception("Could not share matrices, pickling them instead")
+        registry.release(handles)
+        return data, []
+    return shared_data, handles
+
+
+def attach_data(data):
+    """Maps the shared matrices of a problem, in a worker process."""
+    return {
+        key: value.attach() if isinstance(value, SharedMatrix) else value
+        for key, value in data.items()
+    }
+
+
+def release_when_done(future, handles):
+    """Hands the references held on the handles over to the task: they are
+    released once it is over, or cancelled."""
+    if len(handles) > 0:
+        future.add_done_callback(
+            lambda _: get_shared_matrix_registry().release(handles)
+        )
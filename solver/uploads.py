@@ -0,0 +1,186 @@
+import asyncio
+import csv
+import json
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from rest_framework import serializers
+from rest_framework.exceptions import ParseError, UnsupportedMediaType
+
+from optirider.services import (
+    TiledMatrixPrefetch,
+    get_prewarmed_matrices,
+    matrices_provided,
+    prefetch_distance_matrices,
+)
+from solver.async_solve import start_day_points
+from solver.models import Point, speculative_start_day_enabled, within_horizon
+from solver.serializers import OrderSerializer
+
+# Start day uploads are read line by line, rather than loaded whole. The first
+# line holds the problem as JSON, without its orders (riders, depot, runtime,
+# engine), and the orders follow one per row, either as NDJSON (objects as in
+# JSON requests) or as CSV: a header row, then the columns
+#
+#   id,orderType,longitude,latitude,expectedTime,volume[,serviceTime]
+#
+# (times as `[DD] [HH:[MM:]]ss[.uuuuuu]` or ISO 8601 durations).
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+CSV_MEDIA_TYPE = "text/csv"
+UPLOAD_MEDIA_TYPES = [NDJSON_MEDIA_TYPE, CSV_MEDIA_TYPE]
+
+CSV_COLUMNS = ["id", "orderType", "longitude", "latitude", "expectedTime", "volume"]
+
+
+class OrderUpload:
+    """Reads a start day upload from the request stream, validating each order
+    row as it is read.
+
+    :param max_row_errors: Number of invalid rows reading stops at.
+    """
+
+    def __init__(self, request, max_row_errors):
+        media_type = request.content_type.split(";")[0].strip()
+        if media_type not in UPLOAD_MEDIA_TYPES:
+            raise UnsupportedMediaType(media_type)
+        self.media_type = media_type
+        self.max_row_errors = max_row_errors
+        self.line_number = 0
+        # DRF gives no stream for bodies without a Content-Length (eg. chunked
+        # uploads), the underlying Django request reads them whole.
+        self.lines = self.read_lines(request._request)
+
+    def read_lines(self, stream):
+        for line in stream:
+            self.line_number += 1
+            try:
+                yield line.decode("utf-8")
+            except UnicodeDecodeError as e:
+                raise ParseError(f"Line {self.line_number}: {e}")
+
+    def read_problem(self):
+        """The problem (its first line), orders left out."""
+        for line in self.lines:
+            if line.strip():
+                try:
+                    problem = json.loads(line)
+                except ValueError as e:
+                    raise ParseError(f"Line {self.line_number}: JSON parse error - {e}")
+                if not isinstance(problem, dict):
+                    raise ParseError(f"Line {self.line_number}: Expected an object.")
+                return problem
+        raise ParseError("The upload holds no problem.")
+
+    def ndjson_rows(self):
+        for line in self.lines:
+            if line.strip():
+                try:
+                    yield self.line_number, json.loads(line)
+                except ValueError as e:
+                    yield self.line_number, serializers.ValidationError(
+                        f"JSON parse error - {e}"
+                    )
+
+    def csv_rows(self):
+        reader = csv.DictReader(self.lines)
+        if reader.fieldnames is None:
+            return
+        missing = [column for column in CSV_COLUMNS if column not in reader.fieldnames]
+        if len(missing) > 0:
+            raise ParseError(
+                f"Line {self.line_number}: CSV header lacks the columns {missing}."
+            )
+        for row in reader:
+            order = {
+                "id": row["id"],
+                "orderType": row["orderType"],
+                "point": {"longitude": row["longitude"], "latitude": row["latitude"]},
+                "expectedTime": row["expectedTime"],
+                "package": {"volume": row["volume"]},
+            }
+            if row.get("serviceTime"):
+                order["serviceTime"] = row["serviceTime"]
+            yield self.line_number, order
+
+    def read_orders(self, on_order=None):
+        """The orders validated, in the order of the upload.
+
+        :param on_order: Called with each valid order, as soon as it is read.
+        :raises ValidationError: With the errors of each invalid row, by line.
+        """
+        if self.media_type == NDJSON_MEDIA_TYPE:
+            rows = self.ndjson_rows()
+        else:
+            rows = self.csv_rows()
+        order_serializer = OrderSerializer()
+        orders = []
+        errors = {}
+        for line_number, data in rows:
+            try:
+                if isinstance(data, serializers.ValidationError):
+                    raise data
+                order = order_serializer.run_validation(data)
+            except serializers.ValidationError as e:
+                errors[line_number] = e.detail
+                if len(errors) >= self.max_row_errors:
+                    break
+                continue
+            orders.append(order)
+            if on_order is not None:
+                on_order(order)
+        if len(errors) > 0:
+            raise serializers.ValidationError({"orders": errors})
+        return orders
+
+
+async def read_start_day_upload(view, request):
+    """Validates the problem of a start day upload, then reads its orders while
+    the matrix of their points is fetched.
+
+    :returns: The serializer of the problem, orders included, & the prefetched
+        matrices.
+    """
+    upload_settings = settings.OPTIRIDER_SETTINGS["START_DAY_UPLOAD"]
+    upload = OrderUpload(request, upload_settings["MAX_ROW_ERRORS"])
+
+    def validate_problem():
+        serializer = view.get_serializer(data=upload.read_problem())
+        serializer.is_valid(raise_exception=True)
+        return serializer
+
+    serializer = await sync_to_async(validate_problem, thread_sensitive=False)()
+    # Requests bound to be rejected fetch no matrix.
+    view.check_admission()
+    # Replays provide the matrices the solve was recorded with, and speculative
+    # start days fetch theirs while solving on estimates.
+    prefetch = None
+    if not matrices_provided() and not speculative_start_day_enabled():
+        prefetch = TiledMatrixPrefetch(upload_settings["TILE_SIZE"])
+        prefetch.add(Point(**serializer.validated_data["depot"]["point"]))
+    loop = asyncio.get_running_loop()
+
+    def on_order(order):
+        # Orders beyond the planning horizon are left out of the matrix.
+        if prefetch is not None and within_horizon(order["expectedTime"]):
+            loop.call_soon_threadsafe(prefetch.add, Point(**order["point"]))
+
+    matrices = {}
+    try:
+        serializer.validated_data["orders"] = await sync_to_async(
+            upload.read_orders, thread_sensitive=False
+        )(on_order)
+        points = start_day_points(serializer.validated_data)
+        if prefetch is not None and points is not None:
+            # The tiles are of no use when no order is within the horizon, nor
+            # when the matrix was prewarmed.
+            prewarmed = await sync_to_async(
+                get_prewarmed_matrices().contains, thread_sensitive=False
+            )(points)
+            if not prewarmed:
+                matrices = await prefetch.matrices(points)
+            if len(matrices) == 0:
+                matrices = await prefetch_distance_matrices([points])
+    finally:
+        if prefetch is not None:
+            prefetch.cancel()
+    return serializer, matrices
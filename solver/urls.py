@@ -2,10 +2,19 @@ from django.urls import path
 from rest_framework.urlpatterns import format_suffix_patterns
 from solver import views
 
+app_name = "solver"
+
 urlpatterns = [
     path("startday/", views.SolutionStartDay.as_view()),
+    path("startday/upload/", views.SolutionStartDayUpload.as_view()),
+    path("startday/batch/", views.SolutionBatchStartDay.as_view()),
+    path("startday/multidepot/", views.SolutionMultiDepotStartDay.as_view()),
     path("addorder/", views.SolutionAddPickup.as_view()),
     path("delorder/", views.SolutionDeletePickup.as_view()),
+    path("progress/", views.SolutionProgress.as_view()),
+    path("rider/", views.SolutionRiderReplan.as_view()),
+    path("prewarm/", views.MatrixPrewarm.as_view()),
+    path("metrics/", views.SolverMetrics.as_view()),
 ]
 
 urlpatterns = format_suffix_patterns(urlpatterns)
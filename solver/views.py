@@ -1,18 +1,150 @@
 from solver.serializers import (
     StartDaySerializer,
+    BatchStartDaySerializer,
+    MultiDepotStartDaySerializer,
     AddPickupSerializer,
     DeletePickupSerializer,
+    ProgressSerializer,
+    RiderReplanSerializer,
+    StartDayUploadSerializer,
+    PrewarmSerializer,
 )
-from rest_framework import generics
+from solver.admission import (
+    AdmissionControlMixin,
+    ServiceSaturated,
+    get_admission_controller,
+)
+from solver.async_solve import AsyncSolveMixin, get_points, start_day_points
+from solver.columnar import ColumnarViewMixin
+from solver.profiling import ProfiledSolveMixin
+from solver.uploads import read_start_day_upload
+from optirider.services import PrewarmQueueFull
+from rest_framework import generics, status
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
 
-class SolutionStartDay(generics.CreateAPIView):
+class SolutionStartDay(
+    ColumnarViewMixin, AsyncSolveMixin, AdmissionControlMixin, generics.CreateAPIView
+):
     serializer_class = StartDaySerializer
+    lane = "startday"
+
+    def matrix_points(self, validated_data):
+        return [start_day_points(validated_data)]
+
+
+class SolutionStartDayUpload(
+    ColumnarViewMixin, AsyncSolveMixin, AdmissionControlMixin, generics.CreateAPIView
+):
+    """Start day over orders uploaded as NDJSON or CSV, read & validated row by
+    row while their matrix is fetched."""
+
+    serializer_class = StartDayUploadSerializer
+    lane = "startday"
+
+    async def post(self, request, *args, **kwargs):
+        serializer, matrices = await read_start_day_upload(self, request)
+        return await self.solve_response(request, serializer, matrices)
+
 
+class SolutionBatchStartDay(
+    AsyncSolveMixin, AdmissionControlMixin, generics.CreateAPIView
+):
+    serializer_class = BatchStartDaySerializer
+    lane = "startday"
 
-class SolutionAddPickup(generics.CreateAPIView):
+    def matrix_points(self, validated_data):
+        return [
+            get_points([problem["depot"]], problem["orders"])
+            for problem in validated_data["problems"]
+        ]
+
+
+class SolutionMultiDepotStartDay(
+    AsyncSolveMixin, AdmissionControlMixin, generics.CreateAPIView
+):
+    serializer_class = MultiDepotStartDaySerializer
+    lane = "startday"
+
+    def matrix_points(self, validated_data):
+        return [get_points(validated_data["depots"], validated_data["orders"])]
+
+
+class SolutionAddPickup(
+    ColumnarViewMixin, AsyncSolveMixin, AdmissionControlMixin, generics.CreateAPIView
+):
     serializer_class = AddPickupSerializer
+    lane = "addorder"
+
+    def matrix_points(self, validated_data):
+        orders = validated_data["orders"] + validated_data["newOrders"]
+        return [get_points([validated_data["depot"]], orders)]
 
 
-class SolutionDeletePickup(generics.CreateAPIView):
+class SolutionDeletePickup(
+    ColumnarViewMixin, AsyncSolveMixin, AdmissionControlMixin, generics.CreateAPIView
+):
     serializer_class = DeletePickupSerializer
+    lane = "delorder"
+
+    def matrix_points(self, validated_data):
+        order_ids = [order["id"] for order in validated_data["orders"]]
+        # Nothing is solved when the order is not in the plan.
+        if validated_data["delOrderId"] not in order_ids:
+            return []
+        return [get_points([validated_data["depot"]], validated_data["orders"])]
+
+
+class SolutionProgress(
+    ColumnarViewMixin, ProfiledSolveMixin, AdmissionControlMixin, generics.CreateAPIView
+):
+    serializer_class = ProgressSerializer
+    lane = "progress"
+
+
+class SolutionRiderReplan(
+    ColumnarViewMixin, AsyncSolveMixin, AdmissionControlMixin, generics.CreateAPIView
+):
+    serializer_class = RiderReplanSerializer
+    lane = "rider"
+
+    def matrix_points(self, validated_data):
+        rider = next(
+            rider
+            for rider in validated_data["riders"]
+            if rider["id"] == validated_data["riderId"]
+        )
+        order_ids = {stop["orderId"] for tour in rider["tours"] for stop in tour}
+        orders = [
+            order for order in validated_data["orders"] if order["id"] in order_ids
+        ]
+        # Nothing is solved when the rider has no orders.
+        if len(orders) == 0:
+            return []
+        return [get_points([validated_data["depot"]], orders)]
+
+
+class MatrixPrewarm(generics.CreateAPIView):
+    """Queues the matrix of upcoming orders to be fetched ahead of the start
+    day. Nothing is solved."""
+
+    serializer_class = PrewarmSerializer
+
+    def create(self, request, *args, **kwargs):
+        try:
+            response = super().create(request, *args, **kwargs)
+        except PrewarmQueueFull:
+            raise ServiceSaturated(
+                wait=None,
+                detail="Too many matrices are queued to be prewarmed, try again later.",
+            )
+        response.status_code = status.HTTP_202_ACCEPTED
+        return response
+
+
+class SolverMetrics(APIView):
+    """Admission queue depths & wait times of this server process."""
+
+    def get(self, request, format=None):
+        return Response(get_admission_controller().metrics())
@@ -0,0 +1,55 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_max_workers():
+    return settings.OPTIRIDER_SETTINGS["WORKERS"]["MAX_PROCESSES"]
+
+
+def init_worker():
+    import django
+
+    django.setup()
+
+
+def get_solver_pool():
+    """Process pool (shared by the whole server process) to run solves on.
+
+    Workers are spawned rather than forked, as forking a process with OR-Tools
+    & server threads running is unsafe.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=get_max_workers(),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+            )
+        return _pool
+
+
+def solve_start_day(data, penalty, time_to_limit, engine="iterative"):
+    from solver.models import get_start_day_engine
+    from solver.shared_matrices import attach_data
+
+    data = attach_data(data)
+    tours, timings, _ = get_start_day_engine(engine)(
+        data, penalty, time_to_limit=time_to_limit
+    )
+    return tours, timings
+
+
+def improve_plan(tours, timings, data, time_limit, **options):
+    from optirider.improvement import improve_plan
+    from solver.shared_matrices import attach_data
+
+    data = attach_data(data)
+    if improve_plan(tours, timings, data, time_limit, **options):
+        return tours, timings
+    return None